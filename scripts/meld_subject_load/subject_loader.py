@@ -1,4 +1,5 @@
 import os
+import sys
 import pandas as pd
 import json
 import SimpleITK as sitk
@@ -6,6 +7,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 import warnings
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "qc", "meld_mri_qc"))
+from image_header import probe_header
+
 
 class SubjectLoader:
     """
@@ -41,6 +45,10 @@ class SubjectLoader:
     ii) self.list_json_vars() - output callable json features
     iii) self.extract_json_var(var) - output specific value of desired feature (var)
 
+    # Image Methods:
+
+    i) self.image_header() - output image metadata (shape, spacing, ...) without loading the volume
+
     # Image Visualisation Methdos:
 
     i) display_image_seg(display_seg=False, superimpose=False, x=None, y=None, z=None,
@@ -420,6 +428,15 @@ class SubjectLoader:
         elif cohort == "H16":
             return os.path.join(anat_dir, self.subject_id_to_bids_format() + "_3T_lesion_mask.nii.gz")
 
+    def image_header(self, pth=None) -> dict:
+        """
+        Reads the image metadata from the file header only, the voxels are not loaded (same metadata as the MRI QC,
+        see image_header.probe_header).
+        :param pth: path to image file, defaults to the image of the provided subject id/ imaging modality.
+        :return: dict with dimension, shape (x, y, z), spacing, dtype and orientation (e.g. "RAS") of the image.
+        """
+        return probe_header(self.img_pth_finder() if pth is None else pth)
+
     @staticmethod
     def coords_extract(seg_array: np.array) -> tuple:
         """
@@ -428,30 +445,31 @@ class SubjectLoader:
         Chooses y coord with largest segmentation label area throughout the xz planes
         Chooses z coord with largest segmentation label area throughout the xy planes
 
-        :param seg_array: rgb np array corresponding to 1 class segmentation file.
+        :param seg_array: label or rgb np array corresponding to 1 class segmentation file.
         :return: tuple of chosen coordinated.
         """
-        x_coord = None
-        x_size = 0
-        y_coord = None
-        y_size = 0
-        z_coord = None
-        z_size = 0
-
-        for i in range(0, seg_array.shape[0]):
-            if len(seg_array[i,:,:,1].nonzero()[0]) > x_size:
-                x_coord = i
+        mask = seg_array[..., 1] != 0 if seg_array.ndim == 4 else seg_array != 0
+        if not mask.any():
+            return None, None, None
 
-        for i in range(0, seg_array.shape[1]):
-            if len(seg_array[:,i,:,1].nonzero()[0]) > y_size:
-                y_coord = i
-
-        for i in range(0, seg_array.shape[2]):
-            if len(seg_array[:,:,i,1].nonzero()[0]) > z_size:
-                z_coord = i
+        # label area of every slice along each axis, one reduction per axis
+        x_coord = int(np.argmax(mask.sum(axis=(1, 2))))
+        y_coord = int(np.argmax(mask.sum(axis=(0, 2))))
+        z_coord = int(np.argmax(mask.sum(axis=(0, 1))))
 
         return x_coord, y_coord, z_coord
 
+    @staticmethod
+    def label_slice_rgb(label_slice: np.array) -> np.ma.MaskedArray:
+        """
+        Colour a 2D label slice as sitk.LabelToRGB does for label 1, background masked out.
+        :param label_slice: 2D label array
+        :return: masked rgb array
+        """
+        rgb = np.zeros(label_slice.shape + (3,), dtype=np.uint8)
+        rgb[label_slice != 0] = (0, 205, 0)
+        return np.ma.masked_where(rgb == 0, rgb)
+
     @staticmethod
     def wl_to_lh(window: float, level: float) -> tuple:
         """
@@ -497,15 +515,20 @@ class SubjectLoader:
         img_pth = self.img_pth_finder()
         seg_pth = self.seg_pth_finder()
 
+        # array shapes are compared from the headers, before the volumes are loaded
+        img_shape = self.image_header(img_pth)["shape"][::-1]
+        seg_shape = self.image_header(seg_pth)["shape"][::-1]
+
+        if seg_shape[0:2] != img_shape[0:2]:
+            warnings.warn(f"CAUTION: There is an array size mismatch between the MR volume, {img_shape}, and the Segmentation map, {seg_shape}."
+                          f"This may affect acuracy of overlapped visualisation.")
+
         img = sitk.ReadImage(img_pth, sitk.sitkFloat32)  # convert to sitk object
-        seg = sitk.LabelToRGB(sitk.ReadImage(seg_pth, sitk.sitkInt64))
+        # the segmentation stays a uint8 label array, only the displayed slices are coloured
+        seg = sitk.ReadImage(seg_pth, sitk.sitkUInt8)
 
         img_array = sitk.GetArrayFromImage(img)
-        seg_array = sitk.GetArrayFromImage(seg)
-
-        if seg_array.shape[0:2] != img_array.shape[0:2]:
-            warnings.warn(f"CAUTION: There is an array size mismatch between the MR volume, {img_array.shape}, and the Segmentation map, {seg_array.shape}."
-                          f"This may affect acuracy of overlapped visualisation.")
+        seg_array = sitk.GetArrayViewFromImage(seg)
 
         if x is None or y is None or z is None:
             coords = self.coords_extract(seg_array)
@@ -516,7 +539,8 @@ class SubjectLoader:
             if z is None:
                 z = coords[2]
 
-        seg_array = np.ma.masked_where(seg_array == 0, seg_array)
+        seg_x, seg_y, seg_z = (self.label_slice_rgb(seg_slice)
+                               for seg_slice in (seg_array[x,:,:], seg_array[:,y,:], seg_array[:,:,z]))
 
         window = np.max(img_array) - np.min(img_array)
 
@@ -541,9 +565,9 @@ class SubjectLoader:
                 ax2.imshow(img_array[:,y,:], origin='lower', cmap=colormap)
                 ax3.imshow(img_array[:,:,z], origin='lower', cmap=colormap)
 
-                ax4.imshow(seg_array[x,:,:], cmap=colormap)
-                ax5.imshow(seg_array[:,y,:], origin='lower', cmap=colormap)
-                ax6.imshow(seg_array[:,:,z], origin='lower', cmap=colormap)
+                ax4.imshow(seg_x, cmap=colormap)
+                ax5.imshow(seg_y, origin='lower', cmap=colormap)
+                ax6.imshow(seg_z, origin='lower', cmap=colormap)
 
             else:
                 fig, ((ax1, ax2, ax3), (ax4, ax5, ax6)) = plt.subplots(2, 3, figsize=(10, 4))
@@ -555,13 +579,13 @@ class SubjectLoader:
                 ax3.imshow(img_array[:,:,z], origin='lower', cmap=colormap)
 
                 ax4.imshow(img_array[x,:,:], cmap=colormap)
-                ax4.imshow(seg_array[x,:,:], cmap="jet", alpha=0.2)
+                ax4.imshow(seg_x, cmap="jet", alpha=0.2)
 
                 ax5.imshow(img_array[:,y,:], origin='lower', cmap=colormap)
-                ax5.imshow(seg_array[:,y,:], origin='lower', cmap="jet", alpha=0.2)
+                ax5.imshow(seg_y, origin='lower', cmap="jet", alpha=0.2)
 
                 ax6.imshow(img_array[:,:,z], origin='lower', cmap=colormap)
-                ax6.imshow(seg_array[:,:,z], origin='lower', cmap="jet", alpha=0.2)
+                ax6.imshow(seg_z, origin='lower', cmap="jet", alpha=0.2)
 
         if save_name is not None:
             plt.savefig(f"{save_name}", dpi=600)
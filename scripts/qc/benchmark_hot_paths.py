@@ -0,0 +1,343 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+QC_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(QC_DIR, "meld_mri_qc"))
+sys.path.insert(0, os.path.dirname(QC_DIR))  # segment_fill.py
+
+from meld_demo_qc.qc_demographics import qc_demographics, columns as demographic_columns
+from summarise_qc import mri_qc_summary
+from segment_fill import SegmentationFill
+from synthseg_registration import SynthSegRegistration
+from displaymod import DisplayModalities
+from directory_registration import DirectoryRegistration
+from parameters import Config
+from gallery import QCGallery
+from tool_runner import ToolRunner
+
+
+BASELINES_PTH = os.path.join(QC_DIR, "benchmark_baselines.json")
+
+
+class HotPathBenchmarks:
+
+    """
+    Micro-benchmarks of the numeric and bookkeeping loops of the QC scripts, on synthetic inputs.
+
+    Every benchmark is parameterised by the edge of the volumes (voxels) or by the number of subjects of the cohort.
+    A benchmark is a method returning (setup, run): setup() prepares the inputs of one repeat outside of the timing and
+    returns the arguments of run. The result of a benchmark is the minimum and median time of the repeats.
+    """
+
+    volume_benchmarks = ["dice_calc", "coords_seg_extract", "fill_3d", "qc_montage"]
+    cohort_benchmarks = ["qc_demographics", "summarise_qc_lookup", "matrix_update", "gallery_update"]
+
+    def __init__(self, work_dir, seed=0):
+
+        self.work_dir = work_dir
+        self.rng = np.random.default_rng(seed)
+
+    def tmp_dir(self, name):
+
+        pth = os.path.join(self.work_dir, name)
+        shutil.rmtree(pth, ignore_errors=True)
+        os.makedirs(pth)
+        return pth
+
+    @staticmethod
+    def sphere(size, radius, centre=None):
+        # boolean ball in a size^3 array
+        centre = np.full(3, size / 2.) if centre is None else np.array(centre)
+        z, y, x = np.ogrid[:size, :size, :size]
+        return (z - centre[0]) ** 2 + (y - centre[1]) ** 2 + (x - centre[2]) ** 2 < radius ** 2
+
+    def segmentation(self, size, shift=0.):
+        # nested shells labelled as SynthSeg hemispheres (white matter, cortex, ventricles)
+        seg = np.zeros((size, size, size), dtype=np.int32)
+        left = np.zeros(seg.shape, dtype=bool)
+        left[..., :size // 2] = True
+        centre = np.full(3, size / 2.) + shift
+        head, inner, core = (self.sphere(size, size * r, centre) for r in (0.45, 0.35, 0.1))
+        seg[head & left], seg[head & ~left] = 3, 42
+        seg[inner & left], seg[inner & ~left] = 2, 41
+        seg[core & left], seg[core & ~left] = 4, 43
+        return seg
+
+    def dice_calc(self, size):
+
+        folder = self.tmp_dir("dice_calc")
+        helper = SynthSegRegistration(ToolRunner())
+        helper.ref_seg = os.path.join(folder, "ref_synthseg.nii.gz")
+        flo_seg_pth = os.path.join(folder, "flo_synthseg_warped.nii.gz")
+        sitk.WriteImage(sitk.GetImageFromArray(self.segmentation(size)), helper.ref_seg)
+        sitk.WriteImage(sitk.GetImageFromArray(self.segmentation(size, shift=size * 0.02)), flo_seg_pth)
+
+        return (lambda: (flo_seg_pth,)), helper.dice_calc
+
+    def coords_seg_extract(self, size):
+        # RGB lesion overlay (z, y, x, 3) as given by LabelToRGB
+        seg_array = np.zeros((size, size, size, 3), dtype=np.uint8)
+        seg_array[self.sphere(size, size * 0.1, (size * 0.4, size * 0.6, size * 0.3)), 1] = 255
+
+        return (lambda: (seg_array,)), DisplayModalities.coords_seg_extract
+
+    def fill_3d(self, size):
+
+        # lesion drawn on a few slices with holes in between, as filled by segment_fill.py
+        mask = self.sphere(size, size * 0.12) & (self.rng.random((size, size, size)) > 0.3)
+        mask[:, ::3] = False
+        fill_helper = SegmentationFill()
+        fill_helper.seg_array = mask.astype(np.int8)
+
+        return (lambda: ()), fill_helper.fill_3d
+
+    def qc_montage(self, size):
+        # 8 slice montage PNG of a modality (display_image_sag_coron without the image reading)
+        volume = self.segmentation(size).astype(np.float32) * self.rng.uniform(0.9, 1.1, (size, size, size))
+        display_helper = DisplayModalities()
+        save_name = os.path.join(self.tmp_dir("qc_montage"), "sagittal_coronal.png")
+
+        return (lambda: ()), lambda: display_helper.save_png(display_helper.montage_sag_coron(volume), save_name)
+
+    def subject_ids(self, n_subjects):
+
+        return [f"MELD_H99_{'P' if i % 3 else 'C'}_{i:04d}" for i in range(1, n_subjects + 1)]
+
+    def demographics(self, n_subjects):
+        # participants infos csv, mostly valid with a few missing or wrong values
+        ids = self.subject_ids(n_subjects)
+        df = pd.DataFrame({column: self.rng.integers(0, 2, n_subjects) for column in demographic_columns})
+        df["id"] = ids
+        df["old_id"] = [f"site_{i}" for i in range(n_subjects)]
+        df["site"] = "H99"
+        df["included"] = 1
+        df["patient_control"] = [2 if subject.split("_")[2] == "C" else 1 for subject in ids]
+        df["radiology"] = self.rng.choice([1, 5, 10, np.nan], n_subjects)
+        df["histology"] = self.rng.choice([1, 5, 10, np.nan], n_subjects)
+        df["age_at_preop_t1_3t"] = self.rng.uniform(5, 60, n_subjects).round(1)
+        df["age_at_preop_t1_15t"] = np.nan
+        df["age_at_preop_t1_7t"] = np.nan
+        df["age_at_onset"] = (df["age_at_preop_t1_3t"] * self.rng.uniform(0.1, 1.1, n_subjects)).round(1)
+        for column in ["preop_t1_yr_3t", "postop_t1_yr", "surgery_year"]:
+            df[column] = self.rng.integers(2005, 2024, n_subjects)
+        for column in ["radiology_report", "aeds", "procedure_other", "histology_other"]:
+            df[column] = self.rng.choice(["free text", np.nan], n_subjects)
+        return df
+
+    def qc_demographics(self, n_subjects):
+
+        folder = self.tmp_dir("qc_demographics")
+        csv_file = os.path.join(folder, "MELD_participants_infos_H99_2024.csv")
+        self.demographics(n_subjects).to_csv(csv_file, index=False)
+
+        return (lambda: (csv_file, "H99", csv_file.replace(".csv", "_QC.csv"))), qc_demographics
+
+    def summarise_qc_lookup(self, n_subjects):
+
+        subject_array = np.array(self.subject_ids(n_subjects), dtype=object)
+        mods = ['T1-Preop', 'FLAIR', 'T2', 'T1-Postop']
+        # QC matrix filled in by hand, a few subjects missing
+        df_mri = pd.DataFrame({"Subject": ["sub-" + subject.replace("_", "") for subject in subject_array]})
+        for mod in mods:
+            df_mri[f"{mod} Present"] = self.rng.choice([0, 1], n_subjects, p=[0.2, 0.8])
+            df_mri[f"{mod} Correct Mod."] = self.rng.choice([1., 2., 3.], n_subjects, p=[0.9, 0.05, 0.05])
+            df_mri[f"{mod} Artefact"] = self.rng.choice([1., 2., 3.], n_subjects)
+            df_mri[f"{mod} FOV"] = 1.
+            df_mri[f"{mod} Defacing"] = self.rng.choice([1., 2.], n_subjects, p=[0.9, 0.1])
+        df_mri["Mask Present"] = self.rng.choice([0, 1], n_subjects)
+        df_mri["Mask QC"] = self.rng.choice([1., 2., 3., 6.], n_subjects)
+        df_mri = df_mri[self.rng.random(n_subjects) > 0.05]
+        df_qc = pd.DataFrame({"study ID": subject_array, "need_mask": self.rng.choice([0., 1.], n_subjects)})
+
+        return (lambda: (subject_array, df_mri, df_qc, mods)), mri_qc_summary
+
+    def matrix_update(self, n_subjects):
+        # rows appended and flushed case by case, as merge_case_result does
+        config = Config()
+        subjects = ["sub-" + subject.replace("_", "") for subject in self.subject_ids(n_subjects)]
+
+        def setup():
+            config.save_dir = self.tmp_dir("matrix_update")
+            config.img_save_dir = os.path.join(config.save_dir, "qc_images")
+            config.orig_bids_folder = config.save_dir
+            config.synth_save_dir = None
+            config.tool_cache_dir = None
+            config.tool_service_socket = None
+            registration = DirectoryRegistration(config)
+            return registration, [registration.matrix_row(subject) for subject in subjects]
+
+        def run(registration, rows):
+            for row in rows:
+                registration.matrix_update(row)
+                registration.qc_matrix.flush()
+            registration.qc_matrix.compact()
+
+        return setup, run
+
+    def gallery_update(self, n_subjects):
+        # full gallery of the cohort written from scratch (replaces convert_md_to_html)
+        case_results = []
+        for subject in self.subject_ids(n_subjects):
+            case = "sub-" + subject.replace("_", "")
+            items = [{"title": f"{modality} Sagittal & Coronal",
+                      "image": f"./{case}/{case}_{modality}_sagittal_coronal.png"}
+                     for modality in ["T1", "FLAIR", "T2", "T1-postop"]]
+            items.append({"dice_avg": 0.85, "dice_std": 0.05, "dice_outliers": "0.65, 0.68"})
+            case_results.append({"case": case, "gallery": items})
+
+        def setup():
+            folder = self.tmp_dir("gallery_update")
+            return QCGallery(folder, "image_gallery_bench.html", "MELD_QC"), case_results
+
+        return setup, lambda gallery, results: gallery.update(results)
+
+    @staticmethod
+    def time_repeats(setup, run, repeats):
+
+        times = []
+        for _ in range(repeats):
+            args = setup()
+            start_time = time.perf_counter()
+            run(*args)
+            times.append(time.perf_counter() - start_time)
+        return {"min": min(times), "median": float(np.median(times)), "repeats": repeats}
+
+    def run(self, names, sizes, cohorts, repeats):
+        """
+        :return: dict "<benchmark>[<parameter>]" -> timings
+        """
+        results = {}
+        for name in names:
+            parameters = sizes if name in self.volume_benchmarks else cohorts
+            for parameter in parameters:
+                key = f"{name}[{parameter}]"
+                results[key] = self.time_repeats(*getattr(self, name)(parameter), repeats)
+                print(f"{key:35s} min {results[key]['min']:9.4f} s  median {results[key]['median']:9.4f} s")
+        return results
+
+
+def cpu_model():
+
+    try:
+        with open("/proc/cpuinfo", 'r') as file:
+            for line in file:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or "unknown cpu"
+
+
+def machine():
+    # baselines are only compared on the same hardware and python (not the host name: the nodes of a cluster share it)
+    return f"{cpu_model()} {platform.machine()} {os.cpu_count()} cpus python {platform.python_version()}"
+
+
+def compare(results, baselines, tolerance):
+    """
+    :return: keys of the benchmarks slower than their baseline by more than tolerance (fraction)
+    """
+    regressions = []
+    for key, timing in results.items():
+        if key not in baselines["results"]:
+            print(f"{key:35s} no baseline")
+            continue
+        ratio = timing["min"] / baselines["results"][key]["min"]
+        status = "REGRESSION" if ratio > 1. + tolerance else "improved" if ratio < 1. - tolerance else "ok"
+        print(f"{key:35s} {ratio:6.2f} x baseline  {status}")
+        if status == "REGRESSION":
+            regressions.append(key)
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the QC hot paths, compared to the tracked "
+                                                 "baselines of the same machine (benchmark_baselines.json)")
+    parser.add_argument("-b", "--benchmarks",
+                        help="benchmarks to run (default: all)",
+                        nargs="+",
+                        choices=HotPathBenchmarks.volume_benchmarks + HotPathBenchmarks.cohort_benchmarks,
+                        default=HotPathBenchmarks.volume_benchmarks + HotPathBenchmarks.cohort_benchmarks,
+                        )
+    parser.add_argument("--sizes",
+                        help="edges (voxels) of the volumes",
+                        type=int,
+                        nargs="+",
+                        default=[64, 128],
+                        )
+    parser.add_argument("--cohorts",
+                        help="numbers of subjects of the cohorts",
+                        type=int,
+                        nargs="+",
+                        default=[100, 500],
+                        )
+    parser.add_argument("--repeats",
+                        type=int,
+                        default=3,
+                        )
+    parser.add_argument("--baselines",
+                        help="json of the baselines",
+                        default=BASELINES_PTH,
+                        )
+    parser.add_argument("--save-baselines",
+                        help="store the results as the new baselines (of the benchmarks run)",
+                        action="store_true",
+                        )
+    parser.add_argument("--tolerance",
+                        help="slowdown (fraction of the baseline) reported as a regression",
+                        type=float,
+                        default=0.2,
+                        )
+    parser.add_argument("--check",
+                        help="fail on a regression, or if this machine has no baselines (default: only report)",
+                        action="store_true",
+                        )
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="meld_qc_hot_paths_")
+    try:
+        results = HotPathBenchmarks(work_dir).run(args.benchmarks, args.sizes, args.cohorts, args.repeats)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    # baselines of every machine they were recorded on, timings of different hardware are not comparable
+    all_baselines = {"machines": {}}
+    if os.path.exists(args.baselines):
+        with open(args.baselines, 'r') as file:
+            all_baselines = json.load(file)
+    baselines = all_baselines["machines"].setdefault(machine(), {"results": {}})
+
+    if args.save_baselines:
+        baselines["results"].update({key: {"min": round(timing["min"], 5), "median": round(timing["median"], 5)}
+                                     for key, timing in results.items()})
+        baselines["time"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        with open(args.baselines, 'w') as file:
+            json.dump(all_baselines, file, indent=4, sort_keys=True)
+        print(f"Baselines of {machine()} saved in {args.baselines}")
+        return
+
+    if not baselines["results"]:
+        message = f"No baselines for this machine ({machine()}), record them with --save-baselines"
+        if args.check:
+            sys.exit(message)
+        print(f"\n{message}")
+        return
+
+    print(f"\nCompared to the baselines of {machine()} ({baselines['time']})")
+    regressions = compare(results, baselines, args.tolerance)
+    if regressions and args.check:
+        sys.exit(f"{len(regressions)} benchmark(s) slower than their baseline: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+from parameters import Config
+from directory_registration import DirectoryRegistration
+from manifest import CaseManifest
+from fake_tools import FakeTools
+from synthetic_cohort import SyntheticCohort
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Cases per hour of the MRI QC pipeline on a synthetic cohort, with "
+                                                 "fake FreeSurfer tools (no FreeSurfer or GPU needed)")
+    parser.add_argument("-n", "--subjects",
+                        help="number of subjects of the synthetic cohort",
+                        type=int,
+                        default=10,
+                        )
+    parser.add_argument("--cohort",
+                        help="existing cohort folder to use instead of generating one",
+                        default=None,
+                        )
+    parser.add_argument("--scale",
+                        help="image size factor of the generated cohort (1: realistic sizes)",
+                        type=float,
+                        default=1.,
+                        )
+    parser.add_argument("--workers",
+                        help="number of cases registered in parallel",
+                        type=int,
+                        default=1,
+                        )
+    parser.add_argument("--render-workers",
+                        help="processes rendering the QC images in the background, 0 renders them in the stages",
+                        type=int,
+                        default=0,
+                        )
+    parser.add_argument("--delay",
+                        help="seconds per image of the fake tools, e.g. 5 or mri_synthseg=20,mri_easyreg=60",
+                        default="0",
+                        )
+    parser.add_argument("--work-dir",
+                        help="folder of the cohort and outputs (default: temporary folder, removed at the end)",
+                        default=None,
+                        )
+    parser.add_argument("--output",
+                        help="json lines file the result is appended to",
+                        default=None,
+                        )
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="meld_qc_benchmark_") if args.work_dir is None else args.work_dir
+    try:
+        bids_folder = args.cohort
+        if bids_folder is None:
+            bids_folder = os.path.join(work_dir, "MELD_H99")
+            start_time = time.time()
+            SyntheticCohort(bids_folder, scale=args.scale).generate(args.subjects)
+            print(f"Cohort written in {time.time() - start_time:.1f} s")
+
+        # the fake tools first in PATH, for the tools run by the worker processes too
+        bin_dir = os.path.join(work_dir, "fake_freesurfer")
+        FakeTools.install(bin_dir, args.delay)
+        os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+
+        config = Config()
+        config.orig_bids_folder = bids_folder
+        config.list_subjects = None
+        config.save_dir = os.path.join(work_dir, "MELD_BIDS_QC")
+        config.img_save_dir = os.path.join(config.save_dir, "qc_images")
+        config.synth_save_dir = os.path.join(config.save_dir, "synthseg")
+        config.workers = args.workers
+        config.render_workers = args.render_workers
+        config.resume = False
+        config.tool_cache_dir = None
+        config.tool_service_socket = None
+
+        start_time = time.time()
+        DirectoryRegistration(config).directory_registration()
+        seconds = time.time() - start_time
+
+        manifest = CaseManifest(os.path.join(config.save_dir, config.matrix_save_name.replace(".csv", "_manifest.json")))
+        case_results = manifest.case_results()
+        result = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "cohort": bids_folder, "cases": len(case_results),
+                  "succeeded": sum(bool(case_result["output"]) for case_result in case_results),
+                  "workers": args.workers, "render_workers": args.render_workers, "delay": args.delay, "scale": args.scale, "cpus": os.cpu_count(),
+                  "seconds": round(seconds, 1),
+                  "cases_per_hour": round(3600. * len(case_results) / seconds, 1) if seconds > 0 else None}
+
+        print(f"\n{result['cases']} cases ({result['succeeded']} succeeded) in {result['seconds']} s: "
+              f"{result['cases_per_hour']} cases per hour")
+        if args.output is not None:
+            with open(args.output, 'a') as file:
+                file.write(json.dumps(result) + "\n")
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import os
+import re
+import time
+import sqlite3
+import pandas as pd
+from contextlib import closing
+
+
+class BidsInventory:
+
+    """
+    Index of the files of a BIDS site, stored in a SQLite file next to the QC outputs.
+
+    The site is listed once with os.scandir and every file is classified with a single compiled suffix matcher
+    (modality images and their .json sidecars). On a refresh only the directories whose mtime changed are listed
+    again (adding, removing or renaming a file changes the mtime of its folder), so checking an unchanged site costs
+    one stat per directory instead of one listing per case folder.
+
+    Folder layout: bids_folder/<subject>/<folder e.g. anat, dwi>/<filename>
+    """
+
+    # directories modified less than this many seconds before the scan are listed again on the next refresh, as files
+    # added within the same mtime tick (coarse on network storage) would not change the mtime
+    racy_seconds = 2
+
+    def __init__(self, bids_folder, index_pth, tails):
+        """
+        :param bids_folder: BIDS root folder of the site
+        :param index_pth: path of the SQLite index
+        :param tails: list of (kind, filename tail e.g. "_preop_T1w.nii.gz"), in order of priority when several tails
+        match the same file. The sidecar of an image is matched by replacing .nii.gz by .json
+        """
+        self.bids_folder = bids_folder
+        self.index_pth = index_pth
+
+        self.kinds = [kind for kind, tail in tails if tail is not None]
+        branches = []
+        for kind, tail in tails:
+            if tail is not None:
+                sidecar_tail = re.sub(r"\.nii(\.gz)?$", ".json", tail)
+                branches.append(f"(?P<{kind}>.*(?:{re.escape(tail)}|{re.escape(sidecar_tail)}))")
+        self.pattern = "|".join(branches)
+        self.matcher = re.compile(self.pattern, re.IGNORECASE)
+
+        self.create_index()
+
+    def connect(self):
+
+        connection = sqlite3.connect(self.index_pth, timeout=60)
+        connection.row_factory = sqlite3.Row
+        return closing(connection)
+
+    def create_index(self):
+
+        with self.connect() as connection, connection:
+            # folder "" is the subject directory itself, subject "" is the BIDS root
+            connection.execute("CREATE TABLE IF NOT EXISTS dirs (subject TEXT, folder TEXT, mtime INTEGER, "
+                               "PRIMARY KEY (subject, folder))")
+            connection.execute("CREATE TABLE IF NOT EXISTS files (subject TEXT, folder TEXT, filename TEXT, "
+                               "kind TEXT, sidecar INTEGER, PRIMARY KEY (subject, folder, filename))")
+            connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+            # the suffixes changed in the config: classify the indexed files again, no need to list them
+            row = connection.execute("SELECT value FROM meta WHERE key = 'pattern'").fetchone()
+            if row is None or row["value"] != self.pattern:
+                for file in connection.execute("SELECT subject, folder, filename FROM files").fetchall():
+                    connection.execute("UPDATE files SET kind = ?, sidecar = ? WHERE subject = ? AND folder = ? "
+                                       "AND filename = ?", self.classify(file["filename"]) + tuple(file))
+                connection.execute("INSERT OR REPLACE INTO meta VALUES ('pattern', ?)", (self.pattern,))
+
+    def classify(self, filename):
+        """
+        :param filename: file name e.g. sub-MELDH16P0001_preop_T1w.nii.gz
+        :return: (kind e.g. "t1" or None if the file is not a modality, True if the file is a .json sidecar)
+        """
+        match = self.matcher.fullmatch(filename)
+        if match is None:
+            return None, False
+        return match.lastgroup, filename.lower().endswith(".json")
+
+    def dir_mtime(self, pth, scan_time):
+
+        mtime = os.stat(pth).st_mtime_ns
+        return None if scan_time - mtime / 1e9 < self.racy_seconds else mtime
+
+    @staticmethod
+    def list_dir(pth):
+        # (directories, files) of the folder, in one scandir pass
+        dirs, files = [], []
+        with os.scandir(pth) as entries:
+            for entry in entries:
+                (dirs if entry.is_dir() else files).append(entry.name)
+        return sorted(dirs), sorted(files)
+
+    def refresh(self):
+        """
+        Bring the index up to date with the BIDS folder, only listing the directories modified since the last refresh.
+        :return: number of directories listed
+        """
+        scan_time = time.time()
+        listed = 0
+
+        with self.connect() as connection, connection:
+            indexed = {(row["subject"], row["folder"]): row["mtime"]
+                       for row in connection.execute("SELECT subject, folder, mtime FROM dirs")}
+
+            root_mtime = self.dir_mtime(self.bids_folder, scan_time)
+            if root_mtime is not None and indexed.get(("", "")) == root_mtime:
+                subjects = sorted({subject for subject, folder in indexed if subject != ""})
+            else:
+                subjects, _ = self.list_dir(self.bids_folder)
+                listed += 1
+                for subject in sorted({subject for subject, folder in indexed if subject != ""} - set(subjects)):
+                    connection.execute("DELETE FROM dirs WHERE subject = ?", (subject,))
+                    connection.execute("DELETE FROM files WHERE subject = ?", (subject,))
+                connection.execute("INSERT OR REPLACE INTO dirs VALUES ('', '', ?)", (root_mtime,))
+
+            for subject in subjects:
+                subject_pth = os.path.join(self.bids_folder, subject)
+                subject_mtime = self.dir_mtime(subject_pth, scan_time)
+                indexed_folders = sorted(folder for indexed_subject, folder in indexed
+                                         if indexed_subject == subject and folder != "")
+
+                if subject_mtime is not None and indexed.get((subject, "")) == subject_mtime:
+                    folders = indexed_folders
+                else:
+                    folders, _ = self.list_dir(subject_pth)
+                    listed += 1
+                    for folder in set(indexed_folders) - set(folders):
+                        connection.execute("DELETE FROM dirs WHERE subject = ? AND folder = ?", (subject, folder))
+                        connection.execute("DELETE FROM files WHERE subject = ? AND folder = ?", (subject, folder))
+                    connection.execute("INSERT OR REPLACE INTO dirs VALUES (?, '', ?)", (subject, subject_mtime))
+
+                for folder in folders:
+                    folder_pth = os.path.join(subject_pth, folder)
+                    folder_mtime = self.dir_mtime(folder_pth, scan_time)
+                    if folder_mtime is not None and indexed.get((subject, folder)) == folder_mtime:
+                        continue
+
+                    _, filenames = self.list_dir(folder_pth)
+                    listed += 1
+                    connection.execute("DELETE FROM files WHERE subject = ? AND folder = ?", (subject, folder))
+                    connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                                           [(subject, folder, filename) + self.classify(filename)
+                                            for filename in filenames])
+                    connection.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (subject, folder, folder_mtime))
+
+        return listed
+
+    def subjects(self):
+
+        with self.connect() as connection:
+            return [row["subject"] for row in
+                    connection.execute("SELECT subject FROM dirs WHERE folder = '' AND subject != '' ORDER BY subject")]
+
+    def case_files(self, subject, folders=None):
+        """
+        :param subject: BIDS subject e.g. sub-MELDH16P0001
+        :param folders: only return the files of these folders e.g. ["anat", "dwi"], all folders if None
+        :return: list of dict with folder, filename, kind and sidecar, sorted by folder and filename
+        """
+        with self.connect() as connection:
+            rows = connection.execute("SELECT folder, filename, kind, sidecar FROM files WHERE subject = ? "
+                                      "ORDER BY folder, filename", (subject,)).fetchall()
+        return [dict(row) for row in rows if folders is None or row["folder"] in folders]
+
+    def dataframe(self):
+        # whole site, one row per file (e.g. to count the available modalities per site)
+        with self.connect() as connection:
+            return pd.read_sql_query("SELECT * FROM files ORDER BY subject, folder, filename", connection)
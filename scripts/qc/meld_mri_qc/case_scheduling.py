@@ -0,0 +1,123 @@
+import glob
+import json
+import time
+import threading
+import numpy as np
+
+
+# seconds of the stages of a modality before any trace is available (T1: copy, segmentation and QC image of the case)
+DEFAULT_MODALITY_SECONDS = {"T1": 120., "FLAIR": 300., "T2": 300., "T1-postop": 420., "preop_dwi": 300.,
+                            "preop_DWInegPE": 300., "mask": 10.}
+
+# stages which are not part of the work of a modality (the case stage covers all the others)
+UNTRACKED_STAGES = ["case", "merge"]
+
+
+class CaseCostModel:
+
+    """
+    Estimated cost (seconds of stage time) of a case, from the modalities it has.
+
+    The cost of a modality is the median, over the cases of previous runs, of the summed durations of its stages in
+    the stage traces (see StageTrace); stages without modality count for T1. Modalities never traced keep their
+    default cost. Stages of a case run concurrently, so the cost is a relative measure: CaseProgress calibrates it
+    against the wall time of the completed cases.
+    """
+
+    def __init__(self, trace_pths=()):
+        """
+        :param trace_pths: trace files of previous runs (e.g. every *_trace.jsonl of the site)
+        """
+        self.modality_seconds = dict(DEFAULT_MODALITY_SECONDS)
+        self.traced_cases = 0
+        self.learn(trace_pths)
+
+    @classmethod
+    def from_folder(cls, folder):
+
+        return cls(sorted(glob.glob(f"{folder}/*_trace.jsonl")))
+
+    def learn(self, trace_pths):
+
+        # (case, pid, modality) -> summed stage seconds, so that a rerun of a case counts as another sample
+        totals = {}
+        for trace_pth in trace_pths:
+            with open(trace_pth, 'r') as file:
+                for line in file:
+                    try:
+                        event = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if event["stage"] in UNTRACKED_STAGES:
+                        continue
+                    modality = event["modality"] if event["modality"] is not None else "T1"
+                    key = (event["case"], event["pid"], modality)
+                    totals[key] = totals.get(key, 0.) + event["duration"]
+
+        samples = {}
+        for (_, _, modality), seconds in totals.items():
+            samples.setdefault(modality, []).append(seconds)
+        for modality, seconds in samples.items():
+            self.modality_seconds[modality] = float(np.median(seconds))
+        self.traced_cases = len({(case, pid) for case, pid, _ in totals})
+
+    def estimate(self, modalities):
+        """
+        :param modalities: modalities of the case e.g. ["T1", "FLAIR", "mask"]
+        :return: estimated seconds
+        """
+        return sum(self.modality_seconds.get(modality, DEFAULT_MODALITY_SECONDS["FLAIR"]) for modality in modalities)
+
+
+class CaseProgress:
+
+    """
+    Live progress and ETA of a run.
+
+    The estimated costs are scaled by the ratio of wall time to estimate of the cases completed so far, and the
+    remaining work is spread over the workers (but can not end before the longest remaining case).
+    """
+
+    def __init__(self, estimates, workers):
+        """
+        :param estimates: dict case -> estimated cost of the cases to run
+        :param workers: number of cases run at once
+        """
+        self.estimates = estimates
+        self.workers = max(workers, 1)
+        self.start_time = time.time()
+        self.seconds = {}  # case -> wall time of the completed cases
+        self.lock = threading.Lock()
+
+    def done(self, case, seconds):
+        """
+        Record a completed case and print the progress.
+        """
+        with self.lock:
+            self.seconds[case] = seconds
+            print(self.report())
+
+    def eta(self):
+        # seconds left, None before the first case completes
+        if not self.seconds:
+            return None
+        ratio = sum(self.seconds.values()) / max(sum(self.estimates[case] for case in self.seconds), 1e-6)
+        remaining = [self.estimates[case] * ratio for case in self.estimates if case not in self.seconds]
+        if not remaining:
+            return 0.
+        return max(sum(remaining) / min(self.workers, len(remaining)), max(remaining))
+
+    @staticmethod
+    def format_seconds(seconds):
+
+        hours, rest = divmod(int(seconds), 3600)
+        return f"{hours}h{rest // 60:02d}m" if hours else f"{rest // 60}m{rest % 60:02d}s"
+
+    def report(self):
+
+        elapsed = time.time() - self.start_time
+        line = f"Progress: {len(self.seconds)}/{len(self.estimates)} cases in {self.format_seconds(elapsed)}"
+        eta = self.eta()
+        if eta is not None and len(self.seconds) < len(self.estimates):
+            line += f", ETA {self.format_seconds(eta)} (around {time.strftime('%H:%M', time.localtime(time.time() + eta))})"
+        return line
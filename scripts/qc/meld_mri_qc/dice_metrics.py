@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+
+
+# SynthSeg labels (FreeSurferColorLUT names), --parc replaces the cerebral cortex by the Desikan-Killiany parcels
+SYNTHSEG_LABELS = {0: "background",
+                   2: "Left-Cerebral-White-Matter", 3: "Left-Cerebral-Cortex", 4: "Left-Lateral-Ventricle",
+                   5: "Left-Inf-Lat-Vent", 7: "Left-Cerebellum-White-Matter", 8: "Left-Cerebellum-Cortex",
+                   10: "Left-Thalamus", 11: "Left-Caudate", 12: "Left-Putamen", 13: "Left-Pallidum",
+                   14: "3rd-Ventricle", 15: "4th-Ventricle", 16: "Brain-Stem", 17: "Left-Hippocampus",
+                   18: "Left-Amygdala", 24: "CSF", 26: "Left-Accumbens-area", 28: "Left-VentralDC",
+                   41: "Right-Cerebral-White-Matter", 42: "Right-Cerebral-Cortex", 43: "Right-Lateral-Ventricle",
+                   44: "Right-Inf-Lat-Vent", 46: "Right-Cerebellum-White-Matter", 47: "Right-Cerebellum-Cortex",
+                   49: "Right-Thalamus", 50: "Right-Caudate", 51: "Right-Putamen", 52: "Right-Pallidum",
+                   53: "Right-Hippocampus", 54: "Right-Amygdala", 58: "Right-Accumbens-area", 60: "Right-VentralDC"}
+
+DK_PARCELS = ["unknown", "bankssts", "caudalanteriorcingulate", "caudalmiddlefrontal", "corpuscallosum", "cuneus",
+              "entorhinal", "fusiform", "inferiorparietal", "inferiortemporal", "isthmuscingulate", "lateraloccipital",
+              "lateralorbitofrontal", "lingual", "medialorbitofrontal", "middletemporal", "parahippocampal",
+              "paracentral", "parsopercularis", "parsorbitalis", "parstriangularis", "pericalcarine", "postcentral",
+              "posteriorcingulate", "precentral", "precuneus", "rostralanteriorcingulate", "rostralmiddlefrontal",
+              "superiorfrontal", "superiorparietal", "superiortemporal", "supramarginal", "frontalpole",
+              "temporalpole", "transversetemporal", "insula"]
+
+for i, parcel in enumerate(DK_PARCELS):
+    SYNTHSEG_LABELS[1000 + i] = f"ctx-lh-{parcel}"
+    SYNTHSEG_LABELS[2000 + i] = f"ctx-rh-{parcel}"
+
+
+def label_name(label):
+
+    return SYNTHSEG_LABELS.get(int(label), f"label-{int(label)}")
+
+
+def label_overlap(ref_seg, flo_seg):
+    """
+    Volume of every label in both segmentations and of their intersection, in one bincount per count instead of
+    three boolean passes per label.
+    :param ref_seg: integer label array
+    :param flo_seg: integer label array of the same shape
+    :return: (ref volumes, flo volumes, intersections), arrays indexed by label value
+    """
+    if ref_seg.shape != flo_seg.shape:
+        raise ValueError(f"Segmentations of different shapes {ref_seg.shape} and {flo_seg.shape}")
+
+    ref_seg = ref_seg.ravel()
+    flo_seg = flo_seg.ravel()
+    n_labels = int(max(ref_seg.max(), flo_seg.max())) + 1
+
+    ref_volumes = np.bincount(ref_seg, minlength=n_labels)
+    flo_volumes = np.bincount(flo_seg, minlength=n_labels)
+    intersections = np.bincount(ref_seg[ref_seg == flo_seg], minlength=n_labels)
+
+    return ref_volumes, flo_volumes, intersections
+
+
+def dice_table(ref_seg, flo_seg):
+    """
+    :param ref_seg: reference (T1) segmentation array
+    :param flo_seg: segmentation array of the registered image
+    :return: DataFrame indexed by label name with label, ref_volume, flo_volume, intersection and dice, for every
+    label of the reference except background
+    """
+    ref_volumes, flo_volumes, intersections = label_overlap(ref_seg, flo_seg)
+
+    labels = np.nonzero(ref_volumes)[0]
+    labels = labels[labels != 0]
+
+    table = pd.DataFrame({"label": labels,
+                          "ref_volume": ref_volumes[labels],
+                          "flo_volume": flo_volumes[labels],
+                          "intersection": intersections[labels]},
+                         index=pd.Index([label_name(label) for label in labels], name="name"))
+    table["dice"] = 2. * table["intersection"] / (table["ref_volume"] + table["flo_volume"])
+
+    return table
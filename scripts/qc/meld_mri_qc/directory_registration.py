@@ -2,22 +2,59 @@ from parameters import Config
 from registration import Registration
 import os
 import shutil
-import SimpleITK as sitk
 import json
 import pandas as pd
 from displaymod import DisplayModalities
-import markdown
-import re
 import time
 import numpy as np
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from synthseg_registration import SynthSegRegistration
+from manifest import CaseManifest
+from stage_scheduler import StageScheduler
+from functools import partial
+from image_header import probe_header
+from bids_inventory import BidsInventory
+from qc_matrix import QCMatrix
+from gallery import QCGallery
+from tool_runner import ToolRunner, ServiceBackend
+from tool_cache import ToolCache
+from stage_trace import StageTrace
+from stage_profile import StageProfiler, profiled
+from shards import in_shard, shard_name
+from case_scheduling import CaseCostModel, CaseProgress
+from lesion_geometry import geometry_pth
+from volume_cache import VolumeCache
+from render_pool import RenderPool
+
+
+# per-worker DirectoryRegistration used by the parallel mode (workers are processes or threads), see _init_worker
+_worker_local = threading.local()
+
+
+def _init_worker(config):
+    # each worker gets its own registration/display helpers and per-case state
+    _worker_local.registration = DirectoryRegistration(config, is_worker=True)
+
+
+def _register_case_worker(case):
+    return _worker_local.registration.register_case(case)
 
 
 class DirectoryRegistration:
 
-    def __init__(self):
+    # (attribute prefix, modality name, BIDS folder, forward field name, is post-op) of the modalities registered to T1
+    modality_chains = [("flair", "FLAIR", "anat", "FLAIR_fwdfield.nii.gz", False),
+                       ("t2", "T2", "anat", "T2_fwdfield.nii.gz", False),
+                       ("t1_postop", "T1-postop", "anat", "T1postop_fwdfield.nii.gz", True),
+                       ("preop_dwi", "preop_dwi", "dwi", "preop_dwi_fwdfield.nii.gz", False),
+                       ("preop_DWInegPE", "preop_DWInegPE", "dwi", "preop_DWInegPE_fwdfield.nii.gz", False)]
 
-        config = Config()
+    def __init__(self, config=None, is_worker=False):
+
+        config = Config() if config is None else config
+        self.config = config
 
         self.orig_bids_folder = config.orig_bids_folder  # './MELD_H101/'
         self.list_subjects = config.list_subjects
@@ -37,12 +74,51 @@ class DirectoryRegistration:
 
         self.use_synthseg = config.use_synthseg
 
-        self.registration_helper = SynthSegRegistration() if self.use_synthseg else Registration()
+        # FreeSurfer commands of every case and modality in flight in this process share the tool limits
+        backend = ServiceBackend(config.tool_service_socket) if config.tool_service_socket is not None else None
+        # a long batch linger only pays off when the cases of the process share the runner
+        batch_linger = config.tool_batch_linger
+        if batch_linger is None:
+            batch_linger = 2. if config.worker_threads and config.workers > 1 else 0.05
+        self.tool_runner = ToolRunner.shared(config.tool_concurrency, config.tool_timeouts, config.tool_batch_sizes,
+                                             batch_linger, backend)
+
+        # outputs of the FreeSurfer tools, reused for identical inputs
+        self.tool_cache = ToolCache(config.tool_cache_dir) if config.tool_cache_dir is not None else None
+
+        self.registration_helper = SynthSegRegistration(self.tool_runner) if self.use_synthseg else Registration()
+
+        # images of the running case read once by the dice, warp and QC image stages, cleared after each case
+        self.volume_cache = VolumeCache(config.volume_cache_mb) if config.volume_cache_mb else None
+
+        self.display_helper = DisplayModalities(config.fast_qc_images, config.qc_image_width, config.overlay_contours,
+                                                self.volume_cache)
+        # opt-in cProfile / tracemalloc of chosen stages, for this process (and the workers, configured alike);
+        # without profile_stages the MELD_QC_PROFILE environment variables apply
+        if config.profile_stages:
+            StageProfiler.configure(config.profile_stages, config.profile_mode, config.profile_top)
 
-        self.display_helper = DisplayModalities()
+        # QC images rendered in background processes while the stages go on, each case waits for its images at the end
+        self.render_pool = RenderPool.shared(config.render_workers, config.fast_qc_images, config.qc_image_width,
+                                             config.overlay_contours, StageProfiler.settings()) \
+            if config.render_workers else None
 
         self.image_save_dir = config.img_save_dir
 
+        self.workers = config.workers
+        self.worker_threads = config.worker_threads
+        self.longest_first = config.longest_first
+
+        self.case_cpus = config.case_cpus
+        self.case_memory_gb = config.case_memory_gb
+        self.stage_resources = config.stage_resources
+        self.resume = config.resume
+
+        self.warp_in_process = config.warp_in_process
+        self.warp_seg_dice = config.warp_seg_dice
+        self.resegment_cases = set(config.resegment_cases)
+        self.resegment_dice_below = config.resegment_dice_below
+
         self.create_dir(self.save_dir)
         self.create_dir(self.image_save_dir)
 
@@ -61,20 +137,35 @@ class DirectoryRegistration:
         self.preop_dwi_reg = None
         self.preop_DWInegPE_reg = None
 
-        self.matrix_save_name = config.matrix_save_name
-        self.data_matrix = self.init_dataframe()
+        # with a shard (i/N) only the cases of the shard are run, into their own matrix, manifest, trace, gallery and
+        # inventory (named e.g. df_qc_hs_shard3of8.csv), merged afterwards by merge_shards.py
+        self.shard = config.shard
+        self.matrix_save_name = shard_name(config.matrix_save_name, self.shard)
 
-        markdown_file = config.markdown_file
-        html_file = config.html_file
+        # stage events of every case, appended by the parent and the workers
+        self.trace = StageTrace(os.path.join(self.save_dir, self.matrix_save_name.replace(".csv", "_trace.jsonl"))) \
+            if config.trace_stages else None
 
-        self.markdown_pth = os.path.join(self.image_save_dir, markdown_file)
-        self.html_pth = os.path.join(self.image_save_dir, html_file)
-        self.markdown_title = config.markdown_title
-        self.initialize_markdown()
+        # workers only return rows and gallery items, the parent owns the matrix, manifest and gallery files
+        if not is_worker:
+            self.qc_matrix = self.init_matrix()
+            self.manifest = CaseManifest(os.path.join(self.save_dir,
+                                                      self.matrix_save_name.replace(".csv", "_manifest.json")))
+            self.gallery = QCGallery(self.image_save_dir, shard_name(config.html_file, self.shard),
+                                     config.gallery_title, config.cases_per_page)
 
         self.synth_save_dir = config.synth_save_dir
         self.create_dir(self.synth_save_dir) if self.synth_save_dir is not None else None
 
+        # refreshed by the parent before the cases are run, workers only query it
+        self.inventory = BidsInventory(self.orig_bids_folder,
+                                       os.path.join(self.save_dir, shard_name(config.bids_index_name, self.shard)),
+                                       [("t1", self.t1_tail), ("flair", self.flair_tail), ("t2", self.t2_tail),
+                                        ("t1_postop", self.t1_postop_tail), ("mask", self.mask_tail),
+                                        ("preop_dwi", self.preop_dwi_tail),
+                                        ("preop_DWInegPE", self.preop_DWInegPE_tail),
+                                        ("flair_2d", config.flair_2d_tail)])
+
         # dice_scores, dice_average, dice_stdev
         self.flair_dice = None
         self.t2_dice = None
@@ -85,11 +176,12 @@ class DirectoryRegistration:
 
     @staticmethod
     def create_dir(dir):
-        if not os.path.exists(dir):
-            os.mkdir(dir)
-
-    def init_dataframe(self):
+        # shard jobs started together create the same folders
+        os.makedirs(dir, exist_ok=True)
 
+    def init_matrix(self):
+        # rows are appended to the csv case by case, an existing matrix is continued
+        columns, descriptions = None, []
         if not os.path.exists(os.path.join(self.save_dir, self.matrix_save_name)):
             columns = ["Subject", "T1-Preop Present", "T1-Preop Correct Mod.", "T1-Preop Artefact", "T1-Preop FOV" ,"T1-Preop Defacing",
                         "FLAIR Present", "FLAIR Register", "FLAIR Correct Mod.", "FLAIR Artefact", "FLAIR FOV", "FLAIR Defacing",
@@ -113,11 +205,9 @@ class DirectoryRegistration:
                 for key in descriptions_dict:
                     if key in column: 
                         descriptions.append(descriptions_dict[key])
-            df = pd.DataFrame(np.array([descriptions]), columns=columns)
-        else:
-            df = pd.read_csv(os.path.join(self.save_dir, self.matrix_save_name))
+            descriptions = [dict(zip(columns, descriptions))]
 
-        return df
+        return QCMatrix(os.path.join(self.save_dir, self.matrix_save_name), columns, descriptions)
 
     def file_names_init(self):
 
@@ -143,46 +233,70 @@ class DirectoryRegistration:
         self.preop_dwi_dice = None
         self.preop_DWInegPE_dice = None
 
+        self.case_outputs = []  # every file written for the case, recorded in the manifest
+
     def directory_cases(self):
         if self.list_subjects!=None:
-            print(["sub-"+ ''.join(name.split('_')) for name in pd.read_csv(self.list_subjects)['id'].values])
-            return ["sub-"+ ''.join(name.split('_')) for name in pd.read_csv(self.list_subjects)['id'].values]
+            cases = ["sub-"+ ''.join(name.split('_')) for name in pd.read_csv(self.list_subjects)['id'].values]
         else:
-            print([name for name in os.listdir(self.orig_bids_folder) if "sub" in name])
-            return [name for name in os.listdir(self.orig_bids_folder) if "sub" in name]  # this is a list names.
+            cases = [name for name in self.inventory.subjects() if "sub" in name]  # this is a list names.
+        if self.shard is not None:
+            cases = [case for case in cases if in_shard(case, self.shard)]
+        print(cases)
+        return cases
 
     def modality_check(self, case):
-        # return list of avaible modality paths + print out which modalities are and aren't avaible for case
-
-        anat_folder_pth = os.path.join(self.orig_bids_folder, case, "anat")
-        dwi_folder_pth = os.path.join(self.orig_bids_folder, case, "dwi")
+        # set the paths of the avaible modalities of the case, from the BIDS inventory (suffixes are case insensitive)
 
         self.file_names_init()
 
-        if os.path.exists(anat_folder_pth):  # make robust to capitalisation
-            for filename in os.listdir(anat_folder_pth):
-                if filename.lower().endswith(self.t1_tail.lower()):
-                    self.t1_pth = filename
-                elif filename.lower().endswith(self.flair_tail.lower()):
-                    self.flair_pth = filename
-                elif filename.lower().endswith(self.t2_tail.lower()):
-                    self.t2_pth = filename
-                elif filename.lower().endswith(self.t1_postop_tail.lower()):
-                    self.t1_postop_pth = filename
-                elif filename.lower().endswith(self.mask_tail.lower()):
-                    self.mask_pth = filename
+        anat_kinds = ["t1", "flair", "t2", "t1_postop", "mask"]
+        dwi_kinds = ["preop_dwi", "preop_DWInegPE"]
 
-        if os.path.exists(dwi_folder_pth):
-            for filename in os.listdir(dwi_folder_pth):
-                if filename.lower().endswith(self.preop_dwi_tail.lower()):
-                    self.preop_dwi_pth = filename
-                elif filename.lower().endswith(self.preop_DWInegPE_tail.lower()):
-                    self.preop_DWInegPE_pth = filename
+        for file in self.inventory.case_files(case, ["anat", "dwi"]):
+            if file["sidecar"]:
+                continue
+            if (file["folder"] == "anat" and file["kind"] in anat_kinds) or \
+                    (file["folder"] == "dwi" and file["kind"] in dwi_kinds):
+                setattr(self, file["kind"] + "_pth", file["filename"])
+
+    def case_modalities(self, case):
+        # modalities of the case, as named in the stage traces
+        self.modality_check(case)
+        modalities = ["T1"] if self.t1_pth is not None else []
+        modalities += [modality for key, modality, _, _, _ in self.modality_chains
+                       if getattr(self, f"{key}_pth") is not None]
+        return modalities + (["mask"] if self.mask_pth is not None else [])
+
+    def case_estimates(self, cases):
+        # estimated cost of each case, from the stage traces of the previous runs of the site (shards included)
+        cost_model = CaseCostModel.from_folder(self.save_dir)
+        print(f"Case costs estimated from {cost_model.traced_cases} traced cases")
+        return {case: cost_model.estimate(self.case_modalities(case)) for case in cases}
+
+    def case_input_pths(self, case):
+        # every file of the case anat and dwi folders, so that added, removed or modified files trigger a rerun
+        return [os.path.join(self.orig_bids_folder, case, file["folder"], file["filename"])
+                for file in self.inventory.case_files(case, ["anat", "dwi"])]
+
+    @staticmethod
+    def remove_outputs(output_pths):
+
+        for pth in output_pths:
+            os.remove(pth)
 
-    def three_dim_check(self, pth_1):
+    def traced(self, case, stage, modality=None):
+        # trace event of a stage run outside of the stage scheduler
+        if self.trace is None:
+            return nullcontext({})
+        return self.trace.stage(case, stage, modality)
 
-        img_1 = sitk.ReadImage(pth_1)
-        return img_1.GetDimension() == 3
+    def three_dim_check(self, pth_1, case=None, modality=None):
+        # header only, the voxels are not decompressed
+        if case is None:
+            return probe_header(pth_1)["dimension"] == 3
+        with self.traced(case, "three_dim_check", modality):
+            return probe_header(pth_1)["dimension"] == 3
 
     def register(self, fixed_img_pth, moving_img_pth, save_moving_img_pth):
 
@@ -190,19 +304,6 @@ class DirectoryRegistration:
         self.registration_helper.registation_trx(moving_img_pth)
         self.registration_helper.transform(moving_img_pth, save_moving_img_pth)
 
-    def synthseg_register(self, fixed_img_pth, moving_img_pth, save_moving_img_pth, synth_save_dir,
-                          fwd_field_pth, is_postop=False):
-
-        return self.registration_helper.register(fixed_img_pth, moving_img_pth,
-                                                 save_moving_img_pth, synth_save_dir,
-                                                 fwd_field_pth, is_postop)
-
-    def synthseg_register_label(self, moving_label_pth, save_moving_label_pth):
-
-        output = self.registration_helper.register_label(moving_label_pth, save_moving_label_pth)
-        if output==False:
-            return False
-       
     def register_label(self, fixed_img_pth, moving_img_pth, moving_label_pth, save_moving_label_pth):
 
         self.registration_helper.set_fixed_img(fixed_img_pth)
@@ -225,35 +326,38 @@ class DirectoryRegistration:
         # Write the updated dictionary back to the JSON file
         with open(json_new_pth, 'w') as file:
             json.dump(data, file, indent=4)
-
-    def matrix_update(self, case):
-
-        new_data = pd.DataFrame({"Subject": [case], "T1-Preop Present": [1 if self.t1_pth is not None else 0],
-                                 "T1-Preop Correct Mod.": None,
-                                 "T1-Preop Artefact": None, "T1-Preop FOV": None, "T1-Preop Defacing": None,
-                                 "FLAIR Present": [1 if self.flair_pth is not None else 0],
-                                 "FLAIR Register": [1 if self.flair_reg is not None else 0],
-                                 "FLAIR Correct Mod.": None,
-                                 "FLAIR Artefact": None, "FLAIR FOV": None, "FLAIR Defacing": None,
-                                 "T2 Present": [1 if self.t2_pth is not None else 0],
-                                 "T2 Register": [1 if self.t2_reg is not None else 0],
-                                 "T2 Correct Mod.": None,
-                                 "T2 Artefact": None, "T2 FOV": None, "T2 Defacing": None,
-                                 "T1-Postop Present": [1 if self.t1_postop_pth is not None else 0],
-                                 "T1-Postop Register": [1 if self.t1_postop_reg is not None else 0],
-                                 "T1-Postop Correct Mod.": None,
-                                 "T1-Postop Artefact": None, "T1-Postop FOV": None,  "T1-Postop Defacing": None,
-                                 "DWI-Preop Present": [1 if self.preop_dwi_pth is not None else 0],
-                                 "DWI-Preop Register": [1 if self.preop_dwi_reg is not None else 0],
-                                 "DWI-Preop Correct Mod.": None,
-                                 "DWI-Preop Artefact": None, "DWI-Preop FOV": None, "DWI-Preop Defacing": None,
-                                 "DWInegPE-Preop Present": [1 if self.preop_DWInegPE_pth is not None else 0],
-                                 "DWInegPE-Preop Register": [1 if self.preop_DWInegPE_reg is not None else 0],
-                                 "DWInegPE-Preop Correct Mod.": None,
-                                 "DWInegPE-Preop Artefact": None, "DWInegPE-Preop FOV": None,  "DWInegPE-Preop Defacing": None,
-                                 "Mask Present": [1 if self.mask_pth is not None else 0], "Mask QC": None})
-
-        self.data_matrix = pd.concat([self.data_matrix, new_data], ignore_index=True)
+        self.case_outputs.append(json_new_pth)
+
+    def matrix_row(self, case):
+
+        return {"Subject": case, "T1-Preop Present": 1 if self.t1_pth is not None else 0,
+                "T1-Preop Correct Mod.": None,
+                "T1-Preop Artefact": None, "T1-Preop FOV": None, "T1-Preop Defacing": None,
+                "FLAIR Present": 1 if self.flair_pth is not None else 0,
+                "FLAIR Register": 1 if self.flair_reg is not None else 0,
+                "FLAIR Correct Mod.": None,
+                "FLAIR Artefact": None, "FLAIR FOV": None, "FLAIR Defacing": None,
+                "T2 Present": 1 if self.t2_pth is not None else 0,
+                "T2 Register": 1 if self.t2_reg is not None else 0,
+                "T2 Correct Mod.": None,
+                "T2 Artefact": None, "T2 FOV": None, "T2 Defacing": None,
+                "T1-Postop Present": 1 if self.t1_postop_pth is not None else 0,
+                "T1-Postop Register": 1 if self.t1_postop_reg is not None else 0,
+                "T1-Postop Correct Mod.": None,
+                "T1-Postop Artefact": None, "T1-Postop FOV": None,  "T1-Postop Defacing": None,
+                "DWI-Preop Present": 1 if self.preop_dwi_pth is not None else 0,
+                "DWI-Preop Register": 1 if self.preop_dwi_reg is not None else 0,
+                "DWI-Preop Correct Mod.": None,
+                "DWI-Preop Artefact": None, "DWI-Preop FOV": None, "DWI-Preop Defacing": None,
+                "DWInegPE-Preop Present": 1 if self.preop_DWInegPE_pth is not None else 0,
+                "DWInegPE-Preop Register": 1 if self.preop_DWInegPE_reg is not None else 0,
+                "DWInegPE-Preop Correct Mod.": None,
+                "DWInegPE-Preop Artefact": None, "DWInegPE-Preop FOV": None,  "DWInegPE-Preop Defacing": None,
+                "Mask Present": 1 if self.mask_pth is not None else 0, "Mask QC": None}
+
+    def matrix_update(self, row):
+
+        self.qc_matrix.append(row)
 
     # def case_registration(self, case):
 
@@ -435,9 +539,7 @@ class DirectoryRegistration:
     #         self.add_case_to_markdown(case)
 
     def synthseg_case_registration(self, case):
-        
-        output = True
-        
+
         # register everything to t1
         self.file_names_init()
         self.modality_check(case)
@@ -467,352 +569,407 @@ class DirectoryRegistration:
             self.create_dir(os.path.join(self.synth_save_dir, case))  # create case folder
             self.create_dir(save_synth_dwi_folder_pth)  # create anat folder
         
-        try: 
-            fixed_img_pth = os.path.join(anat_folder_pth, self.t1_pth)
-            if (os.path.isfile(fixed_img_pth)) & (not os.path.exists(os.path.join(save_anat_folder_pth, self.t1_pth))):
-                shutil.copy(fixed_img_pth, os.path.join(save_anat_folder_pth, self.t1_pth))
-        except:
-                print(f'COPY T1 FAILED with error')
-                return False
+        with self.traced(case, "t1_copy", "T1") as record:
+            try: 
+                fixed_img_pth = os.path.join(anat_folder_pth, self.t1_pth)
+                if (os.path.isfile(fixed_img_pth)) & (not os.path.exists(os.path.join(save_anat_folder_pth, self.t1_pth))):
+                    shutil.copy(fixed_img_pth, os.path.join(save_anat_folder_pth, self.t1_pth))
+            except:
+                    print(f'COPY T1 FAILED with error')
+                    record["ok"] = False
+                    return False
             
         
-        if not self.three_dim_check(fixed_img_pth):
+        if not self.three_dim_check(fixed_img_pth, case, "T1"):
             raise Exception(f"T1 is not 3D for case: {case}")
         if not os.path.isfile(os.path.join(save_anat_folder_pth, self.t1_pth.replace(".nii.gz", ".json"))):
             shutil.copy(os.path.join(anat_folder_pth, self.t1_pth.replace(".nii.gz", ".json")),
                     os.path.join(save_anat_folder_pth, self.t1_pth.replace(".nii.gz", ".json")))
+        self.case_outputs += [os.path.join(save_anat_folder_pth, self.t1_pth),
+                              os.path.join(save_anat_folder_pth, self.t1_pth.replace(".nii.gz", ".json"))]
+
+        scheduler = StageScheduler(self.case_cpus, self.case_memory_gb, self.trace, case)
 
-        self.qc_imgs(case, fixed_img_pth, "T1")
+        scheduler.add("qc_png[T1]", partial(self.qc_imgs, case, fixed_img_pth, "T1"),
+                      **self.stage_resources["qc_png"])
 
         # copy over orig label if mask not in flair modality
         if not self.mask_in_flair:
             if self.mask_pth is not None:
                 if os.path.exists(os.path.join(anat_folder_pth, self.mask_pth)):
                     
-                    if self.three_dim_check(os.path.join(anat_folder_pth, self.mask_pth)):
+                    if self.three_dim_check(os.path.join(anat_folder_pth, self.mask_pth), case, "mask"):
                         if not os.path.exists(os.path.join(save_anat_folder_pth, self.mask_pth)):
                             shutil.copy(os.path.join(anat_folder_pth, self.mask_pth), os.path.join(save_anat_folder_pth, self.mask_pth))
 
                             shutil.copy(os.path.join(anat_folder_pth, self.mask_pth.replace(".nii.gz", ".json")),
                                     os.path.join(save_anat_folder_pth, self.mask_pth.replace(".nii.gz", ".json")))
+                        self.case_outputs += [os.path.join(save_anat_folder_pth, self.mask_pth),
+                                              os.path.join(save_anat_folder_pth, self.mask_pth.replace(".nii.gz", ".json"))]
                         self.mask_reg = 1
                     else:
                         print(f"Warning: Mask is not 3D for case: {case}")
 
-        # flair
-        if self.flair_pth is not None:
-            moving_img_pth = os.path.join(anat_folder_pth, self.flair_pth)
-
-            if self.three_dim_check(moving_img_pth):
-                save_moving_img_pth = os.path.join(save_anat_folder_pth, self.flair_pth.replace(".nii.gz", "_space-T1.nii.gz"))
-                # if not os.path.isfile(save_moving_img_pth):
-                print('register FLAIR')
-                fwd_field_pth = os.path.join(save_synth_anat_folder_pth, "FLAIR_fwdfield.nii.gz")
-                self.flair_dice = self.synthseg_register(fixed_img_pth=fixed_img_pth, moving_img_pth=moving_img_pth,
-                                                        save_moving_img_pth=save_moving_img_pth,
-                                                        synth_save_dir=save_synth_anat_folder_pth,
-                                                        fwd_field_pth=fwd_field_pth, is_postop=False)
-                if not self.flair_dice:
-                    print(f'ERROR: Process failed for FLAIR for subject {case}')
-                    output = False
-                else:
-                # else:
-                #     print('FLAIR already registered')
-                    self.json_edit(json_old_pth=os.path.join(anat_folder_pth, self.flair_pth.replace(".nii.gz", ".json")),
-                                    json_new_pth=os.path.join(save_anat_folder_pth, self.flair_pth.replace(".nii.gz", ".json")),
-                                    value=fixed_img_pth)  # edit json
-                    self.qc_imgs(case, save_moving_img_pth, "FLAIR")
-                    self.flair_reg = 1
-
-                    if self.mask_in_flair:
-                        moving_label_pth = os.path.join(anat_folder_pth, self.mask_pth)
-                        save_moving_label_pth = os.path.join(save_anat_folder_pth, self.mask_pth.replace(".nii.gz", "_space-T1.nii.gz"))
-                        # if not os.path.isfile(save_moving_label_pth):
-                        print('register lesion mask FLAIR')
-                        # self.register_label(fixed_img_pth, moving_img_pth, moving_label_pth, save_moving_label_pth)
-                        self.synthseg_register_label(moving_label_pth, save_moving_label_pth)
-                        
-                        # else:
-                        #     print('lesion mask FLAIR already registered')
-                        self.json_edit(json_old_pth=os.path.join(anat_folder_pth, self.mask_pth.replace(".nii.gz", ".json")),
-                                        json_new_pth=os.path.join(save_anat_folder_pth, self.mask_pth.replace(".nii.gz", ".json")),
-                                        value=fixed_img_pth)  # edit json
-                        self.mask_reg = 1
-            else:
-                print(f"Warning: Flair is not 3D for case: {case}")
-
-        # T2
-        if self.t2_pth is not None:
-            moving_img_pth = os.path.join(anat_folder_pth, self.t2_pth)
-
-            if self.three_dim_check(moving_img_pth):
-
-                save_moving_img_pth = os.path.join(save_anat_folder_pth, self.t2_pth.replace(".nii.gz", "_space-T1.nii.gz"))
-                # if not os.path.isfile(save_moving_img_pth):
-                print('register T2')
-                fwd_field_pth = os.path.join(save_synth_anat_folder_pth, "T2_fwdfield.nii.gz")
-                self.t2_dice = self.synthseg_register(fixed_img_pth=fixed_img_pth, moving_img_pth=moving_img_pth,
-                                                            save_moving_img_pth=save_moving_img_pth,
-                                                            synth_save_dir=save_synth_anat_folder_pth,
-                                                            fwd_field_pth=fwd_field_pth, is_postop=False)
-                if not self.t2_dice:
-                    print(f'ERROR: Process failed for T2 for subject {case}')
-                    output = False
-                else:
-                # else:
-                #     print('T2 already registered')
-                    self.json_edit(json_old_pth=os.path.join(anat_folder_pth, self.t2_pth.replace(".nii.gz", ".json")),
-                                    json_new_pth=os.path.join(save_anat_folder_pth, self.t2_pth.replace(".nii.gz", ".json")),
-                                    value=fixed_img_pth)  # edit json
-                    self.qc_imgs(case, save_moving_img_pth, "T2")
-                    self.t2_reg = 1
-
-            else:
-                print(f"Warning: T2 is not 3D for case: {case}")
-
-        # T1 post-op
-        if self.t1_postop_pth is not None:
-            moving_img_pth = os.path.join(anat_folder_pth, self.t1_postop_pth)
-
-            if self.three_dim_check(moving_img_pth):
-
-                save_moving_img_pth = os.path.join(save_anat_folder_pth, self.t1_postop_pth.replace(".nii.gz", "_space-T1.nii.gz"))
-                # if not os.path.isfile(save_moving_img_pth):
-                print('register T1 post-op')
-                fwd_field_pth = os.path.join(save_synth_anat_folder_pth, "T1postop_fwdfield.nii.gz")
-                self.t1_postop_dice = self.synthseg_register(fixed_img_pth=fixed_img_pth, moving_img_pth=moving_img_pth,
-                                                            save_moving_img_pth=save_moving_img_pth,
-                                                            synth_save_dir=save_synth_anat_folder_pth,
-                                                            fwd_field_pth=fwd_field_pth, is_postop=True)
-                if not self.t1_postop_dice:
-                    print(f'ERROR: Process failed for T1-postop for subject {case}')
-                    output = False
-                # else:
-                #     print('T1 post-op already registered')
-                else:
-                    if not os.path.exists(os.path.join(save_anat_folder_pth, self.t1_postop_pth.replace(".nii.gz", ".json"))):
-                        self.json_edit(json_old_pth=os.path.join(anat_folder_pth, self.t1_postop_pth.replace(".nii.gz", ".json")),
-                                        json_new_pth=os.path.join(save_anat_folder_pth, self.t1_postop_pth.replace(".nii.gz", ".json")),
-                                        value=fixed_img_pth)  # edit json
-                    self.qc_imgs(case, save_moving_img_pth, "T1-postop")
-                    self.t1_postop_reg = 1
-
-            else:
-                print(f"Warning: T1-postop is not 3D for case: {case}")
-
-        # preop_dwi
-        if self.preop_dwi_pth is not None:
-            moving_img_pth = os.path.join(dwi_folder_pth, self.preop_dwi_pth)
-            if self.three_dim_check(moving_img_pth):
-
-                save_moving_img_pth = os.path.join(save_dwi_folder_pth, self.preop_dwi_pth.replace(".nii.gz", "_space-T1.nii.gz"))
-                # if not os.path.isfile(save_moving_img_pth):
-                print('register DWI')
-                fwd_field_pth = os.path.join(save_synth_dwi_folder_pth, "preop_dwi_fwdfield.nii.gz")
-                self.preop_dwi_dice = self.synthseg_register(fixed_img_pth=fixed_img_pth, moving_img_pth=moving_img_pth,
-                                                            save_moving_img_pth=save_moving_img_pth,
-                                                            synth_save_dir=save_synth_dwi_folder_pth,
-                                                            fwd_field_pth=fwd_field_pth, is_postop=False)
-                if not self.preop_dwi_dice:
-                    print(f'ERROR: Process failed for DWI-preop for subject {case}')
-                    output = False
-                # else:
-                #     print('DWI already registered')
-                else:
-                    self.json_edit(json_old_pth=os.path.join(dwi_folder_pth, self.preop_dwi_pth.replace(".nii.gz", ".json")),
-                                    json_new_pth=os.path.join(save_dwi_folder_pth, self.preop_dwi_pth.replace(".nii.gz", ".json")),
-                                    value=fixed_img_pth)  # edit json
-                    self.qc_imgs(case, save_moving_img_pth, "preop_dwi")
-                    self.preop_dwi_reg = 1
-            else:
-                print(f"Warning: preop_dwi is not 3D for case: {case}")
-
-        # preop_DWInegPE
-        if self.preop_DWInegPE_pth is not None:
-            moving_img_pth = os.path.join(dwi_folder_pth, self.preop_DWInegPE_pth)
-            if self.three_dim_check(moving_img_pth):
-
-                save_moving_img_pth = os.path.join(save_dwi_folder_pth, self.preop_DWInegPE_pth.replace(".nii.gz", "_space-T1.nii.gz"))
-                # if not os.path.isfile(save_moving_img_pth):
-                print('register DWInegPE')
-                fwd_field_pth = os.path.join(save_synth_dwi_folder_pth, "preop_DWInegPE_fwdfield.nii.gz")
-                self.preop_DWInegPE_dice = self.synthseg_register(fixed_img_pth=fixed_img_pth, moving_img_pth=moving_img_pth,
-                                                                save_moving_img_pth=save_moving_img_pth,
-                                                                synth_save_dir=save_synth_dwi_folder_pth,
-                                                                fwd_field_pth=fwd_field_pth, is_postop=False)
-                if not self.preop_DWInegPE_dice:
-                    print(f'ERROR: Process failed for DWInegPE-preop for subject {case}')
-                    output = False
-                # else:
-                #     print('DWInegPE already registered')
-                else:
-                    self.json_edit(json_old_pth=os.path.join(dwi_folder_pth, self.preop_DWInegPE_pth.replace(".nii.gz", ".json")),
-                                    json_new_pth=os.path.join(save_dwi_folder_pth, self.preop_DWInegPE_pth.replace(".nii.gz", ".json")),
-                                    value=fixed_img_pth)  # edit json
-                    self.qc_imgs(case, save_moving_img_pth, "preop_DWInegPE")
-                    self.preop_DWInegPE_reg = 1
-            else:
-                print(f"Warning: preop_DWInegPE is not 3D for case: {case}")
-
-        if output == False:
-            return False
-        
-        self.matrix_update(case)
+        # the T1 segmentation is shared by all modalities (anat and dwi), it is computed once in the anat folder
+        ref_helper = self.new_registration_helper()
+        ref_helper.set_params(fixed_img_pth, None, None, save_synth_anat_folder_pth, None)
+        scheduler.add("ref_synthseg", ref_helper.ref_synthseg, **self.stage_resources["synthseg"])
+
+        folders = {"anat": (anat_folder_pth, save_anat_folder_pth, save_synth_anat_folder_pth),
+                   "dwi": (dwi_folder_pth, save_dwi_folder_pth, save_synth_dwi_folder_pth)}
+        chains = []
+        for key, modality, folder, fwd_field_name, is_postop in self.modality_chains:
+            if getattr(self, f"{key}_pth") is None:
+                continue
+
+            folder_pth, save_folder_pth, save_synth_folder_pth = folders[folder]
+            moving_img_pth = os.path.join(folder_pth, getattr(self, f"{key}_pth"))
+            if not self.three_dim_check(moving_img_pth, case, modality):
+                print(f"Warning: {modality} is not 3D for case: {case}")
+                continue
+
+            print(f'register {modality}')
+            save_moving_img_pth = os.path.join(save_folder_pth, getattr(self, f"{key}_pth").replace(".nii.gz", "_space-T1.nii.gz"))
+            helper = self.new_registration_helper()
+            helper.set_params(fixed_img_pth, moving_img_pth, save_moving_img_pth, save_synth_folder_pth,
+                              os.path.join(save_synth_folder_pth, fwd_field_name), is_postop,
+                              ref_seg_pth=ref_helper.ref_seg)
+            json_pths = (os.path.join(folder_pth, getattr(self, f"{key}_pth").replace(".nii.gz", ".json")),
+                         os.path.join(save_folder_pth, getattr(self, f"{key}_pth").replace(".nii.gz", ".json")))
+
+            chains.append((modality, self.add_modality_stages(scheduler, case, key, modality, helper,
+                                                              fixed_img_pth, json_pths)))
+
+            if self.mask_in_flair and key == "flair":
+                moving_label_pth = os.path.join(anat_folder_pth, self.mask_pth)
+                save_moving_label_pth = os.path.join(save_anat_folder_pth, self.mask_pth.replace(".nii.gz", "_space-T1.nii.gz"))
+                json_pths = (os.path.join(anat_folder_pth, self.mask_pth.replace(".nii.gz", ".json")),
+                             os.path.join(save_anat_folder_pth, self.mask_pth.replace(".nii.gz", ".json")))
+                chains.append(("lesion mask FLAIR",
+                               scheduler.add("easywarp[mask]",
+                                             partial(self.mask_stage, helper, moving_label_pth, save_moving_label_pth,
+                                                     fixed_img_pth, json_pths),
+                                             deps=[chains[-1][1]], **self.stage_resources["easywarp"])))
 
         # overlay qc: #### add option if seg is none
         if self.mask_pth is not None:
             if self.mask_in_flair:
-                self.overlay_qc(case=case,
-                                t1=os.path.join(save_anat_folder_pth, self.t1_pth),
-                                post_op=os.path.join(save_anat_folder_pth, self.t1_postop_pth.replace(".nii.gz", "_space-T1.nii.gz")
-                                                        ) if self.t1_postop_pth is not None else None,
-                                seg=os.path.join(save_anat_folder_pth, self.mask_pth.replace(".nii.gz", "_space-T1.nii.gz")))
+                seg = os.path.join(save_anat_folder_pth, self.mask_pth.replace(".nii.gz", "_space-T1.nii.gz"))
             else:
-                self.overlay_qc(case=case,
-                                t1=os.path.join(save_anat_folder_pth, self.t1_pth),
-                                post_op=os.path.join(save_anat_folder_pth, self.t1_postop_pth.replace(".nii.gz", "_space-T1.nii.gz")
-                                                        ) if self.t1_postop_pth is not None else None,
-                                seg=os.path.join(save_anat_folder_pth, self.mask_pth))
+                seg = os.path.join(save_anat_folder_pth, self.mask_pth)
+            post_op = os.path.join(save_anat_folder_pth, self.t1_postop_pth.replace(".nii.gz", "_space-T1.nii.gz")
+                                   ) if self.t1_postop_pth is not None else None
+            # as before, the overlay is only produced once every modality registered
+            chains.append(("overlay",
+                           scheduler.add("overlay", partial(self.overlay_qc, case=case,
+                                                            t1=os.path.join(save_anat_folder_pth, self.t1_pth),
+                                                            post_op=post_op, seg=seg),
+                                         deps=[stage for _, stage in chains], **self.stage_resources["qc_png"])))
         else:
             print(f"Mask QC not possible as mask not provided for case: {case}")
 
-        self.add_case_to_markdown(case)
+        scheduler.run()
+
+        output = scheduler.status["qc_png[T1]"] == "done"
+        for modality, last_stage in chains:
+            if scheduler.status[last_stage] != "done":
+                print(f'ERROR: Process failed for {modality} for subject {case}')
+                output = False
+
+        return output
+
+    def new_registration_helper(self):
+
+        helper = SynthSegRegistration(self.tool_runner)
+        helper.tool_threads = {tool: resources["cpus"] for tool, resources in self.stage_resources.items()}
+        helper.warp_in_process = self.warp_in_process
+        helper.tool_cache = self.tool_cache
+        helper.volume_cache = self.volume_cache
+        return helper
+
+    def add_modality_stages(self, scheduler, case, key, modality, helper, fixed_img_pth, json_pths):
+        # synthsr -> synthseg -> easyreg -> easywarp -> qc image, and for the dice either the floating segmentation
+        # warped with the field (warp_seg_dice) or the synthseg of the warped image
+        flo_deps = []
+        if helper.is_postop:
+            flo_deps = [scheduler.add(f"synthsr[{modality}]", helper.synthsr, **self.stage_resources["synthsr"])]
+        scheduler.add(f"flo_synthseg[{modality}]", helper.flo_synthseg, deps=flo_deps,
+                      **self.stage_resources["synthseg"])
+        scheduler.add(f"easyreg[{modality}]", helper.easyreg, deps=["ref_synthseg", f"flo_synthseg[{modality}]"],
+                      **self.stage_resources["easyreg"])
+        scheduler.add(f"easywarp[{modality}]", helper.easywarp, deps=[f"easyreg[{modality}]"],
+                      **self.stage_resources["easywarp"])
+        if self.warp_seg_dice and case not in self.resegment_cases:
+            scheduler.add(f"warp_flo_seg[{modality}]", helper.warp_flo_seg, deps=[f"easyreg[{modality}]"],
+                          **self.stage_resources["easywarp"])
+            # the warped image is needed if the dice is low enough to re-segment it
+            dice_deps = [f"warp_flo_seg[{modality}]", f"easywarp[{modality}]"]
+        else:
+            scheduler.add(f"warp_synthseg[{modality}]", helper.warp_synthseg, deps=[f"easywarp[{modality}]"],
+                          **self.stage_resources["synthseg"])
+            dice_deps = [f"warp_synthseg[{modality}]"]
+        scheduler.add(f"dice[{modality}]", partial(self.dice_stage, case, key, modality, helper), deps=dice_deps,
+                      **self.stage_resources["dice"])
+        return scheduler.add(f"qc_png[{modality}]",
+                             partial(self.modality_qc_stage, case, key, modality, helper, fixed_img_pth, json_pths),
+                             deps=[f"dice[{modality}]"], **self.stage_resources["qc_png"])
+
+    def dice_stage(self, case, key, modality, helper):
+
+        if self.warp_seg_dice and case not in self.resegment_cases:
+            dice = helper.dice_calc(helper.flo_seg_warped)
+            if self.resegment_dice_below is not None and dice[1] < self.resegment_dice_below:
+                # flagged: confirm with the segmentation of the registered image before reporting a bad registration
+                print(f"{case} {key}: average dice of the warped segmentation {dice[1]} below "
+                      f"{self.resegment_dice_below}, re-segmenting the registered image")
+                # traced on its own, within the dice stage
+                with self.traced(case, "resegment", modality) as record:
+                    record["ok"] = helper.warp_synthseg()
+                if not record["ok"]:
+                    return False
+                dice = helper.dice_calc()
+        else:
+            dice = helper.dice_calc()
+        setattr(self, f"{key}_dice", dice)
+        self.case_outputs += helper.output_pths()
+        return dice
 
-        return True
-    
-    def directory_registration(self):
+    def modality_qc_stage(self, case, key, modality, helper, fixed_img_pth, json_pths):
 
-        bids_cases = self.directory_cases()
+        self.json_edit(json_old_pth=json_pths[0], json_new_pth=json_pths[1], value=fixed_img_pth)  # edit json
+        self.qc_imgs(case, helper.save_moving_img_pth, modality)
+        self.case_outputs.append(helper.save_moving_img_pth)
+        setattr(self, f"{key}_reg", 1)
+
+    def mask_stage(self, helper, moving_label_pth, save_moving_label_pth, fixed_img_pth, json_pths):
 
+        print('register lesion mask FLAIR')
+        output = helper.register_label(moving_label_pth, save_moving_label_pth)
+        if output==False:
+            return False
+        self.case_outputs.append(save_moving_label_pth)
+        self.json_edit(json_old_pth=json_pths[0], json_new_pth=json_pths[1], value=fixed_img_pth)  # edit json
+        self.mask_reg = 1
+
+    def register_case(self, case):
+        # run one case and return its matrix row and gallery items instead of writing them,
+        # so that cases can run in separate processes and be merged afterwards
+        start_time = time.time()
+        print(f"Registration starting for case: {case}")
+        with self.traced(case, "case") as record:
+            try:
+                output = self.case_registration(case) if not self.use_synthseg else self.synthseg_case_registration(case)
+            finally:
+                if self.volume_cache is not None:
+                    record.update(self.volume_cache.stats())
+                    self.volume_cache.clear()
+            if self.render_pool is not None:
+                with self.traced(case, "render_wait"):
+                    # rendered even if the case failed, the images of the registered modalities are kept
+                    if self.render_pool.wait(case):
+                        output = False
+            record["ok"] = bool(output)
+
+        case_result = {"case": case, "output": bool(output), "row": None, "gallery": None,
+                       "outputs": self.case_outputs}
+        if not output :
+            print(f"Registration failed for case: {case}")
+        else:
+            case_result["row"] = self.matrix_row(case)
+            with self.traced(case, "gallery_items"):
+                case_result["gallery"] = self.case_gallery(case)
+            print(f"Registration complete for case: {case}")
+        end_time = time.time()
+        case_result["seconds"] = end_time - start_time
+        print(f"Time Elapsed: {end_time-start_time:.2f}\n")
+
+        return case_result
+
+    def merge_case_result(self, case_result, input_records):
+
+        case = case_result["case"]
+        with self.traced(case, "merge"):
+            if case_result["output"]:
+                # a rerun case is appended again, its previous row is dropped when the matrix is compacted
+                self.matrix_update(case_result["row"])
+                # on disk before the case is recorded as complete, a crash loses at most the running cases
+                self.qc_matrix.flush()
+                result = dict(case_result)
+                self.manifest.record(case, input_records, result.pop("outputs"), result)
+            else:
+                self.manifest.discard(case)
+            # only the fragment of the case and its page are rewritten, the gallery can be browsed during the run
+            self.gallery.update(self.manifest.case_results())
+
+    def pending_cases(self, bids_cases):
+        # split cases into completed ones (unchanged inputs, outputs present) and cases to (re)run
+        pending_cases = []
+        input_records = {}
         for bids_case in bids_cases:
-            start_time = time.time()
-            print(f"Registration starting for case: {bids_case}")
-            output = self.case_registration(bids_case) if not self.use_synthseg else self.synthseg_case_registration(bids_case)
-            if not output :
-                print(f"Registration failed for case: {bids_case}")
+            input_records[bids_case] = self.manifest.input_records(bids_case, self.case_input_pths(bids_case))
+            if self.resume and self.manifest.is_complete(bids_case, input_records[bids_case]):
+                print(f"Case already complete with unchanged inputs, skipping: {bids_case}")
+                # keep the existing (possibly already QCed) row, only restore it if the matrix lost it
+                if not self.qc_matrix.has_subject(bids_case):
+                    self.matrix_update(self.manifest.cases[bids_case]["result"]["row"])
             else:
-                print(f"Registration complete for case: {bids_case}")
-            end_time = time.time()
-            print(f"Time Elapsed: {end_time-start_time:.2f}\n")
+                # remove outputs of a previous run, otherwise the "file exists" checks would reuse them
+                self.remove_outputs(self.manifest.stale_outputs(bids_case))
+                pending_cases.append(bids_case)
+        self.manifest.save()
+        self.qc_matrix.flush()
 
-        self.convert_md_to_html()
-        self.data_matrix.to_csv(os.path.join(self.save_dir, self.matrix_save_name), index=False)
+        return pending_cases, input_records
 
-    def qc_imgs(self, case, img, modality):
+    def directory_registration(self):
+
+        print(f"BIDS inventory refreshed, {self.inventory.refresh()} folders listed")
+        bids_cases = self.directory_cases()
+        pending_cases, input_records = self.pending_cases(bids_cases)
+        print(f"{len(pending_cases)} of {len(bids_cases)} cases to register")
+
+        estimates = self.case_estimates(pending_cases)
+        progress = CaseProgress(estimates, min(self.workers, max(len(pending_cases), 1)))
+
+        if self.workers > 1 and len(pending_cases) > 1:
+            print(f"Running {len(pending_cases)} cases on {self.workers} worker "
+                  f"{'threads' if self.worker_threads else 'processes'}")
+            # the most expensive cases first, so that the run does not end on a long case started last
+            dispatch_order = sorted(pending_cases, key=lambda case: -estimates[case]) if self.longest_first \
+                else pending_cases
+            executor_class = ThreadPoolExecutor if self.worker_threads else ProcessPoolExecutor
+            with executor_class(max_workers=self.workers, initializer=_init_worker,
+                                initargs=(self.config,)) as executor:
+                futures = {executor.submit(_register_case_worker, case): case for case in dispatch_order}
+                # merged as they complete, so a case is on disk without waiting for the cases dispatched before it
+                # (sorted back into case order at the end, in the matrix and in the gallery)
+                for future in as_completed(futures):
+                    case_result = future.result()
+                    progress.done(futures[future], case_result["seconds"])
+                    self.merge_case_result(case_result, input_records[futures[future]])
+        else:
+            for bids_case in pending_cases:
+                case_result = self.register_case(bids_case)
+                progress.done(bids_case, case_result["seconds"])
+                self.merge_case_result(case_result, input_records[bids_case])
+
+        self.manifest.sort(pending_cases)
+        self.gallery.update(self.manifest.case_results())
+        self.qc_matrix.compact(order=pending_cases)
 
+    def qc_imgs(self, case, img, modality):
+        # with a render pool the image is drawn (and profiled) by a render worker
         case_img_pth = os.path.join(self.image_save_dir, case)
         self.create_dir(case_img_pth)
         save_img_sag_cor = os.path.join(case_img_pth, f"{case}_{modality}_sagittal_coronal.png")
-        self.display_helper.display_image_sag_coron(img, save_name=save_img_sag_cor)
+        if self.render_pool is not None:
+            self.render_pool.submit(case, "image", f"{case}_{modality}", img1=img, save_name=save_img_sag_cor)
+        else:
+            self.render_qc_img(case, modality, img, save_img_sag_cor)
+        self.case_outputs.append(save_img_sag_cor)
+
+    @profiled("qc_imgs", lambda self, case, modality, img, save_name: (os.path.dirname(save_name),
+                                                                      f"{case}_{modality}"))
+    def render_qc_img(self, case, modality, img, save_name):
+
+        self.display_helper.display_image_sag_coron(img, save_name=save_name)
 
     def overlay_qc(self, case, t1, post_op, seg):
 
         case_img_pth = os.path.join(self.image_save_dir, case)
         save_img_sag_cor = os.path.join(case_img_pth, f"{case}_segment_overlay_sagital_coronal.png")
-        self.display_helper.display_overlay_sag_coron(t1=t1, post_op=post_op, seg=seg, save_name=save_img_sag_cor)
-
-    def initialize_markdown(self):
+        if self.render_pool is not None:
+            self.render_pool.submit(case, "overlay", case, t1=t1, post_op=post_op, seg=seg, save_name=save_img_sag_cor)
+        else:
+            self.render_overlay(case, t1, post_op, seg, save_img_sag_cor)
+        self.case_outputs += [save_img_sag_cor, geometry_pth(seg)]
 
-        if not os.path.exists(self.markdown_pth):
-            with open(self.markdown_pth, 'w') as md_file:
-                md_file.write(f"## {self.markdown_title}\n\n")
+    @profiled("overlay_qc", lambda self, case, t1, post_op, seg, save_name: (os.path.dirname(save_name), case))
+    def render_overlay(self, case, t1, post_op, seg, save_name):
 
-    def add_dice_scores_to_markdown(self, dice_scores, avg_dice, dice_std):
+        self.display_helper.display_overlay_sag_coron(t1=t1, post_op=post_op, seg=seg, save_name=save_name)
 
-        dice_scores_str_outlier = ', '.join(str(score) for score in dice_scores if score<0.7)
-        print(dice_scores_str_outlier)
-        with open(self.markdown_pth, 'a') as md_file:
-            md_file.write(f"**Avg Dice (stdev): {avg_dice} ({dice_std})**\n\n")
-            md_file.write(f"**Dice Scores below 0.7: {dice_scores_str_outlier}**\n\n")
-
-    def add_image_to_markdown(self, image_path, description):
+    def case_qc_images(self, case):
+        # QC images of a registered case, from its outputs in save_dir: (case, image path, modality) for qc_imgs and
+        # (case, t1, post_op, seg) for overlay_qc
+        self.modality_check(case)
+        if self.t1_pth is None:
+            return [], None
+        save_anat_folder_pth = os.path.join(self.save_dir, case, "anat")
+        folders = {"anat": save_anat_folder_pth, "dwi": os.path.join(self.save_dir, case, "dwi")}
 
-        with open(self.markdown_pth, 'a') as md_file:
-            md_file.write(f"##### {description}\n\n")
-            md_file.write(f'![{description}]({image_path})\n\n')
+        t1 = os.path.join(save_anat_folder_pth, self.t1_pth)
+        images = [(case, t1, "T1")]
+        for key, modality, folder, _, _ in self.modality_chains:
+            if getattr(self, f"{key}_pth") is not None:
+                img = os.path.join(folders[folder], getattr(self, f"{key}_pth").replace(".nii.gz", "_space-T1.nii.gz"))
+                if os.path.isfile(img):
+                    images.append((case, img, modality))
 
-    def add_saggital_coronal_markdown(self, case_img_pth, case, modality):
-        save_img_sag_cor = os.path.join(case_img_pth, f"{case}_{modality}_sagittal_coronal.png")
-        self.add_image_to_markdown(save_img_sag_cor, f"{modality} Sagittal & Coronal")
-        
-    def add_saggital_markdown(self, case_img_pth, case, modality):
-        save_img_sag = os.path.join(case_img_pth, f"{case}_{modality}_sagittal.png")
-        self.add_image_to_markdown(save_img_sag, f"{modality} Sagittal")
+        overlay = None
+        if self.mask_pth is not None:
+            seg = os.path.join(save_anat_folder_pth, self.mask_pth.replace(".nii.gz", "_space-T1.nii.gz")
+                               if self.mask_in_flair else self.mask_pth)
+            post_op = os.path.join(save_anat_folder_pth, self.t1_postop_pth.replace(".nii.gz", "_space-T1.nii.gz")
+                                   ) if self.t1_postop_pth is not None else None
+            if os.path.isfile(seg):
+                overlay = (case, t1, post_op if post_op is not None and os.path.isfile(post_op) else None, seg)
+
+        return images, overlay
+
+    def render_only(self):
+        # regenerate the QC images and the gallery of the cases recorded as complete, without any registration
+        print(f"BIDS inventory refreshed, {self.inventory.refresh()} folders listed")
+        if self.render_pool is None:
+            self.render_pool = RenderPool.shared(max(self.workers, os.cpu_count() or 1), self.config.fast_qc_images,
+                                                 self.config.qc_image_width, self.config.overlay_contours,
+                                                 StageProfiler.settings())
+
+        cases = [case_result["case"] for case_result in self.manifest.case_results() if case_result["output"]]
+        print(f"Rendering the QC images of {len(cases)} cases on {self.render_pool.workers} processes")
+        for case in cases:
+            self.file_names_init()
+            images, overlay = self.case_qc_images(case)
+            for image in images:
+                self.qc_imgs(*image)
+            if overlay is not None:
+                self.overlay_qc(*overlay)
+
+        failed = [save_name for case in cases for save_name in self.render_pool.wait(case)]
+        print(f"{len(failed)} QC images failed")
+        self.gallery.update(self.manifest.case_results())
 
-    def add_coronal_markdown(self, case_img_pth, case, modality):
-        save_img_coron = os.path.join(case_img_pth, f"{case}_{modality}_coronal.png")
-        self.add_image_to_markdown(save_img_coron, f"{modality} Coronal")
+    @staticmethod
+    def dice_scores_item(dice_scores, avg_dice, dice_std):
 
-    def add_case_to_markdown(self, case):
+        dice_scores_str_outlier = ', '.join(str(score) for score in dice_scores if score<0.7)
+        print(dice_scores_str_outlier)
+        return {"dice_avg": float(avg_dice), "dice_std": float(dice_std), "dice_outliers": dice_scores_str_outlier}
 
-        with open(self.markdown_pth, 'a') as md_file:
-            md_file.write('---\n\n')  # Horizontal rule
-            md_file.write(f'### Case: {case}\n\n')  # New title
+    @staticmethod
+    def saggital_coronal_item(case_img_pth, case, modality):
+        save_img_sag_cor = os.path.join(case_img_pth, f"{case}_{modality}_sagittal_coronal.png")
+        return {"title": f"{modality} Sagittal & Coronal", "image": save_img_sag_cor}
 
-        case_img_pth = os.path.join("./", case)  # os.path.join(self.image_save_dir, case)
+    def case_gallery(self, case):
+        # images and dice scores shown for the case, in order
+        items = []
 
-        # adding sagittal & coronal on same row
-        self.add_saggital_coronal_markdown(case_img_pth, case, modality="T1") if self.t1_pth is not None else None
-        self.add_saggital_coronal_markdown(case_img_pth, case, modality="FLAIR") if self.flair_reg is not None else None
-        self.add_dice_scores_to_markdown(self.flair_dice[0], self.flair_dice[1], self.flair_dice[2]) if self.flair_dice is not None else None
-        self.add_saggital_coronal_markdown(case_img_pth, case, modality="T2") if self.t2_reg is not None else None
-        self.add_dice_scores_to_markdown(self.t2_dice[0], self.t2_dice[1], self.t2_dice[2]) if self.t2_dice is not None else None
-        self.add_saggital_coronal_markdown(case_img_pth, case, modality="T1-postop") if self.t1_postop_reg is not None else None
-        self.add_dice_scores_to_markdown(self.t1_postop_dice[0], self.t1_postop_dice[1], self.t1_postop_dice[2]) if self.t1_postop_dice is not None else None
-        self.add_saggital_coronal_markdown(case_img_pth, case, modality="preop_dwi") if self.preop_dwi_reg is not None else None
-        self.add_dice_scores_to_markdown(self.preop_dwi_dice[0], self.preop_dwi_dice[1], self.preop_dwi_dice[2]) if self.preop_dwi_dice is not None else None
-        self.add_saggital_coronal_markdown(case_img_pth, case, modality="preop_DWInegPE") if self.preop_DWInegPE_reg is not None else None
-        self.add_dice_scores_to_markdown(self.preop_DWInegPE_dice[0], self.preop_DWInegPE_dice[1], self.preop_DWInegPE_dice[2]) if self.preop_DWInegPE_dice is not None else None
+        case_img_pth = os.path.join("./", case)  # relative to the gallery pages in self.image_save_dir
 
+        if self.t1_pth is not None:
+            items.append(self.saggital_coronal_item(case_img_pth, case, modality="T1"))
+        for key, modality, _, _, _ in self.modality_chains:
+            if getattr(self, f"{key}_reg") is not None:
+                items.append(self.saggital_coronal_item(case_img_pth, case, modality=modality))
+            if getattr(self, f"{key}_dice") is not None:
+                items.append(self.dice_scores_item(*getattr(self, f"{key}_dice")))
 
         if self.mask_reg is not None:
             save_img_sag_cor = os.path.join(case_img_pth, f"{case}_segment_overlay_sagital_coronal.png")
-            self.add_image_to_markdown(save_img_sag_cor, "Sagittal & Coronal Overlay")
-
-    def convert_md_to_html(self):
-        with open(self.markdown_pth, 'r', encoding='utf-8') as file:
-            md_content = file.read()
-
-        # Preprocess the markdown to wrap images and their titles in a container
-        md_content = re.sub(
-            r'^##### (.*?)\n\n!\[\1\]\((.*?)\)$',  # Match the description header followed by the image syntax
-            r'<div class="img-container"><span class="img-title">\1</span><img src="\2" alt="\1"></div>',
-            md_content,
-            flags=re.MULTILINE  # This allows ^ and $ to match the start and end of each line
-        )
-
-        html_content = markdown.markdown(md_content)
-
-        # Add CSS styles for images, their titles, and text
-        styles = """
-        <style>
-            img {
-                max-width: 90%;
-                display: block;
-            }
-            .img-container {
-                display: flex;
-                align-items: center;
-                margin: 10px 0;
-            }
-            .img-title {
-                font-size: 1em;
-                margin-right: 10px;
-                width: 150px;  /* Fixed width for the title. Adjust as needed. */
-                overflow: hidden;
-                white-space: normal;  /* Allow line breaks */
-            }
-            body {
-                font-size: 1.5em;
-                font-family: Arial, sans-serif;
-            }
-        </style>
-        """
-
-        full_html = f"<!DOCTYPE html>\n<html>\n<head>{styles}</head>\n<body>{html_content}</body>\n</html>"
-
-        with open(self.html_pth, 'w', encoding='utf-8') as file:
-            file.write(full_html)
+            items.append({"title": "Sagittal & Coronal Overlay", "image": save_img_sag_cor})
+
+        return items
 
 
 
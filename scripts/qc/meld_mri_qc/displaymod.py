@@ -3,12 +3,34 @@ import SimpleITK as sitk
 import numpy as np
 import matplotlib.pyplot as plt
 import warnings
+import threading
+from PIL import Image
+from lesion_geometry import largest_slices, cached_lesion_geometry
+from volume_cache import read_image
+
+
+# pyplot keeps global state, stages of a case rendering in parallel threads must take turns
+_pyplot_lock = threading.Lock()
 
 
 class DisplayModalities:
 
-    def __init__(self):
-        pass
+    # colour of label 1 in sitk.LabelToRGB, and its opacity over the image
+    overlay_colour = (0, 205, 0)
+    overlay_alpha = 0.3
+
+    def __init__(self, fast_render=True, png_width=2400, overlay_contours=False, volume_cache=None):
+        """
+        :param fast_render: write the montages (display_image_sag_coron, display_overlay_sag_coron) from the numpy
+        slices, without matplotlib
+        :param png_width: width in pixels of these montages, None for one pixel per voxel
+        :param overlay_contours: only draw the outline of the lesion on the overlay montages (fast_render)
+        :param volume_cache: VolumeCache the images are read through, None to read them from disk
+        """
+        self.fast_render = fast_render
+        self.png_width = png_width
+        self.overlay_contours = overlay_contours
+        self.volume_cache = volume_cache
 
     @staticmethod
     def path_validator(path: str):
@@ -24,37 +46,115 @@ class DisplayModalities:
 
     @staticmethod
     def coords_seg_extract(seg_array: np.array) -> tuple:
-        
-        x_coord = None
-        x_size = 0
-        y_coord = None
-        y_size = 0
-        z_coord = None
-        z_size = 0
-
-        for i in range(0, seg_array.shape[0]):
-            if len(seg_array[i,:,:,1].nonzero()[0]) > x_size:
-                x_coord = i
-                x_size = len(seg_array[i,:,:,1].nonzero()[0])
-
-        for i in range(0, seg_array.shape[1]):
-            if len(seg_array[:,i,:,1].nonzero()[0]) > y_size:
-                y_coord = i
-                y_size = len(seg_array[:,i,:,1].nonzero()[0])
-
-        for i in range(0, seg_array.shape[2]):
-            if len(seg_array[:,:,i,1].nonzero()[0]) > z_size:
-                z_coord = i
-                z_size = len(seg_array[:,:,i,1].nonzero()[0])
-
-        return x_coord, y_coord, z_coord
-
-    
+        # slices with the largest lesion area along each axis, of an RGB overlay (label 1 is green) or a label array
+        mask = seg_array[..., 1] != 0 if seg_array.ndim == 4 else seg_array != 0
+        return largest_slices(mask)
+
     def display_image_sag_coron(self, img1, y=None, z=None, save_name=None): #'jet'
 
         self.path_validator(img1)
 
-        img1_array = sitk.GetArrayFromImage(sitk.ReadImage(img1, sitk.sitkFloat32))  # convert to sitk object
+        img1_array = sitk.GetArrayFromImage(read_image(img1, sitk.sitkFloat32, self.volume_cache))  # convert to sitk object
+
+        if self.fast_render:
+            if save_name is not None:
+                self.save_png(self.montage_sag_coron(img1_array, y, z), save_name)
+            return
+
+        with _pyplot_lock:
+            self.plot_image_sag_coron(img1_array, y, z, save_name)
+
+    @staticmethod
+    def sag_coron_slices(img1_array, y=None, z=None):
+        # the 4 sagittal then 4 coronal slices of plot_image_sag_coron
+        if z is None:
+            z = int(img1_array.shape[2]/2)
+        if y is None:
+            y = int(img1_array.shape[1]/2)
+
+        return [img1_array[:,:,z+i] for i in [-20, -10, 10, 20]] + [img1_array[:,y+i,:] for i in [-20, -10, 10, 20]]
+
+    @staticmethod
+    def window(slice_array: np.array) -> np.array:
+        # slice minimum to maximum -> 0 to 255, as imshow
+        low, high = float(slice_array.min()), float(slice_array.max())
+        if high <= low:
+            return np.zeros(slice_array.shape, dtype=np.uint8)
+        return ((slice_array - low) * (255. / (high - low)) + 0.5).astype(np.uint8)
+
+    def montage_sag_coron(self, img1_array, y=None, z=None) -> np.array:
+        """
+        Same layout as plot_image_sag_coron: 8 slices side by side on black, each centred in a cell of the size of the
+        largest slice (without the figure margins).
+        :return: uint8 canvas
+        """
+        panels = [self.window(slice_array)[::-1] for slice_array in self.sag_coron_slices(img1_array, y, z)]  # origin='lower'
+        return self.tile(panels, len(panels))
+
+    @staticmethod
+    def tile(panels, columns) -> np.array:
+        """
+        Panels (grey or RGB uint8) on black, row by row, each centred in a cell of the size of the largest panel.
+        :return: uint8 canvas
+        """
+        height = max(panel.shape[0] for panel in panels)
+        width = max(panel.shape[1] for panel in panels)
+        rows = -(-len(panels) // columns)
+
+        canvas = np.zeros((height * rows, width * columns) + panels[0].shape[2:], dtype=np.uint8)
+        for k, panel in enumerate(panels):
+            row, column = divmod(k, columns)
+            top = row * height + (height - panel.shape[0]) // 2
+            left = column * width + (width - panel.shape[1]) // 2
+            canvas[top:top + panel.shape[0], left:left + panel.shape[1]] = panel
+
+        return canvas
+
+    @staticmethod
+    def contour(mask: np.array) -> np.array:
+        # pixels of the 2D mask with a 4-neighbour outside of it
+        inner = mask.copy()
+        inner[1:] &= mask[:-1]
+        inner[:-1] &= mask[1:]
+        inner[:, 1:] &= mask[:, :-1]
+        inner[:, :-1] &= mask[:, 1:]
+        return mask & ~inner
+
+    def blend(self, grey: np.array, mask: np.array) -> np.array:
+        # RGB slice with the lesion colour blended over the masked pixels (opaque outline with overlay_contours)
+        rgb = np.repeat(grey[..., None], 3, axis=2)
+        mask, alpha = (self.contour(mask), 1.) if self.overlay_contours else (mask, self.overlay_alpha)
+        rgb[mask] = (rgb[mask] * (1. - alpha) + np.array(self.overlay_colour) * alpha + 0.5).astype(np.uint8)
+        return rgb
+
+    def montage_overlay(self, t1_array, postop_array, label_array, y, z) -> np.array:
+        """
+        Same layout as plot_overlay_sag_coron: for T1 (and post-op T1), a row of the slices z-3, z, z+3 (sagittal) and
+        y-3, y, y+3 (coronal), then the same row with the lesion. Only these slices of the mask are coloured.
+        :param label_array: lesion label array (0 outside of the lesion)
+        :return: uint8 RGB canvas
+        """
+        def slices(array):
+            return [array[:,:,z+i][::-1] for i in [-3, 0, 3]] + [array[:,y+i,:][::-1] for i in [-3, 0, 3]]  # origin='lower'
+
+        mask_slices = [label_slice != 0 for label_slice in slices(label_array)]
+        panels = []
+        for array in [t1_array] + ([postop_array] if postop_array is not None else []):
+            grey_slices = [self.window(slice_array) for slice_array in slices(array)]
+            panels += [np.repeat(grey[..., None], 3, axis=2) for grey in grey_slices]
+            panels += [self.blend(grey, mask_slice) for grey, mask_slice in zip(grey_slices, mask_slices)]
+
+        return self.tile(panels, 6)
+
+    def save_png(self, canvas, save_name):
+        # one PNG encoding of the canvas, resized to png_width
+        image = Image.fromarray(canvas)
+        if self.png_width is not None and canvas.shape[1] != self.png_width:
+            height = max(1, round(canvas.shape[0] * self.png_width / canvas.shape[1]))
+            image = image.resize((self.png_width, height), Image.BILINEAR)
+        image.save(save_name)
+
+    def plot_image_sag_coron(self, img1_array, y=None, z=None, save_name=None):
 
         fig, axes = plt.subplots(1, 8, figsize=(12, 3))
         
@@ -94,16 +194,36 @@ class DisplayModalities:
 
         self.path_validator(t1)
 
-        t1_array = sitk.GetArrayFromImage(sitk.ReadImage(t1, sitk.sitkFloat32))  # convert to sitk object
-        postop_array = sitk.GetArrayFromImage(sitk.ReadImage(post_op, sitk.sitkFloat32)) if post_op is not None else None
-        seg_array = sitk.GetArrayFromImage(sitk.LabelToRGB(sitk.ReadImage(seg, sitk.sitkInt64)))
-        
-        if t1_array.shape[0:3] != seg_array.shape[0:3]:
+        t1_array = sitk.GetArrayFromImage(read_image(t1, sitk.sitkFloat32, self.volume_cache))  # convert to sitk object
+        postop_array = sitk.GetArrayFromImage(read_image(post_op, sitk.sitkFloat32, self.volume_cache)) \
+            if post_op is not None else None
+        # the mask stays a uint8 label image, only the drawn slices are coloured
+        seg_image = read_image(seg, sitk.sitkUInt8, self.volume_cache)
+        label_array = sitk.GetArrayViewFromImage(seg_image)
+
+        if t1_array.shape[0:3] != label_array.shape:
             warnings.warn(f"CAUTION: There is a LABEL array size mismatch between the MR volume (1), {t1}, and {seg}."
                         f"This may affect acuracy of overlapped visualisation.")
 
-        fig, axes = plt.subplots(4, 6, figsize=(12, 10)) if post_op is not None else plt.subplots(2, 6, figsize=(12, 5))
-        arrays = [t1_array, t1_array, postop_array, postop_array] if post_op is not None else [t1_array, t1_array]
+        if y is None or z is None:
+            # slices with the largest lesion area, from the geometry sidecar of the mask
+            _, largest_y, largest_z = cached_lesion_geometry(seg, seg_image)["largest_slices"]
+            y = largest_y if y is None else y
+            z = largest_z if z is None else z
+
+        if self.fast_render:
+            if save_name is not None:
+                self.save_png(self.montage_overlay(t1_array, postop_array, label_array, y, z), save_name)
+            return
+
+        seg_array = sitk.GetArrayFromImage(sitk.LabelToRGB(seg_image))
+        with _pyplot_lock:
+            self.plot_overlay_sag_coron(t1_array, postop_array, seg_array, y, z, save_name)
+
+    def plot_overlay_sag_coron(self, t1_array, postop_array, seg_array, y=None, z=None, save_name=None):
+
+        fig, axes = plt.subplots(4, 6, figsize=(12, 10)) if postop_array is not None else plt.subplots(2, 6, figsize=(12, 5))
+        arrays = [t1_array, t1_array, postop_array, postop_array] if postop_array is not None else [t1_array, t1_array]
         
         #add sagital
         if z is None:
@@ -0,0 +1,187 @@
+import os
+import sys
+import time
+import shutil
+import numpy as np
+import SimpleITK as sitk
+
+from field_warper import FieldWarper
+
+
+class FakeTools:
+
+    """
+    Stand-in for the FreeSurfer tools, to run the pipeline (or the tool service) without FreeSurfer or a GPU.
+
+    Takes the same arguments as mri_synthsr, mri_synthseg (including text files of inputs and outputs),
+    mri_easyreg and mri_easywarp and writes outputs of the expected geometry:
+    1) synthsr copies the image
+    2) synthseg labels the head voxels by their world position, whatever the contrast (white matter and cortex of each
+       hemisphere, by distance to the centre of the head and side of it)
+    3) easyreg writes the identity field on the grid of the reference (RAS coordinates of every voxel)
+    4) easywarp resamples through the field as mri_easywarp does
+
+    Images whose name contains fail_marker make the tool fail, delay (seconds per image) simulates the run time.
+
+    The tools can also be installed as drop-in executables (see install), e.g. to put first in PATH.
+    """
+
+    COMMANDS = ["mri_synthsr", "mri_synthseg", "mri_easyreg", "mri_easywarp"]
+
+    def __init__(self, delay=0., fail_marker="FAKE_FAIL"):
+        """
+        :param delay: seconds per image, or dict command -> seconds per image e.g. {"mri_synthseg": 20.}
+        :param fail_marker: images whose name contains it make the tool fail
+        """
+        self.delay = delay
+        self.fail_marker = fail_marker
+
+    @staticmethod
+    def parse_delay(delay):
+        # "2.5" or "mri_synthseg=20,mri_easyreg=60" (commands not listed take no time)
+        if "=" not in delay:
+            return float(delay)
+        return {command: float(seconds) for command, seconds in (item.split("=") for item in delay.split(","))}
+
+    def command_delay(self, command):
+
+        if isinstance(self.delay, dict):
+            return self.delay.get(command, 0.)
+        return self.delay
+
+    @classmethod
+    def install(cls, bin_dir, delay=None):
+        """
+        Write executables mri_synthsr, mri_synthseg, mri_easyreg and mri_easywarp running the fake tools.
+        :param bin_dir: folder of the executables, to put first in PATH
+        :param delay: default of FAKE_FREESURFER_DELAY in the executables (see parse_delay)
+        """
+        os.makedirs(bin_dir, exist_ok=True)
+        for command in cls.COMMANDS:
+            pth = os.path.join(bin_dir, command)
+            with open(pth, 'w') as file:
+                file.write("#!/bin/sh\n")
+                if delay is not None:
+                    file.write(f'export FAKE_FREESURFER_DELAY="${{FAKE_FREESURFER_DELAY:-{delay}}}"\n')
+                file.write(f'exec "{sys.executable}" "{os.path.abspath(__file__)}" {command} "$@"\n')
+            os.chmod(pth, 0o755)
+
+    @staticmethod
+    def option(args, name):
+
+        return args[args.index(name) + 1] if name in args else None
+
+    @staticmethod
+    def image_pairs(input_pth, output_pth, tail):
+        # (input, output) of a single image, of text files of images, or of an image saved in an output folder
+        if input_pth.endswith(".txt"):
+            with open(input_pth, 'r') as file:
+                inputs = file.read().split()
+            with open(output_pth, 'r') as file:
+                outputs = file.read().split()
+            return list(zip(inputs, outputs))
+        if not output_pth.endswith(".nii.gz"):
+            output_pth = os.path.join(output_pth, os.path.basename(input_pth).replace(".nii.gz", tail))
+        return [(input_pth, output_pth)]
+
+    def check(self, *pths):
+
+        for pth in pths:
+            if self.fail_marker in os.path.basename(pth):
+                raise RuntimeError(f"fake failure for {pth}")
+
+    def run(self, args):
+        """
+        :param args: command as a list of arguments e.g. ["mri_synthseg", "--i", ...]
+        :return: (return code, output)
+        """
+        command = os.path.basename(args[0])
+        try:
+            if command == "mri_synthsr":
+                pairs = self.image_pairs(self.option(args, "--i"), self.option(args, "--o"), "_synthsr.nii.gz")
+                for input_pth, output_pth in pairs:
+                    self.check(input_pth)
+                    shutil.copy(input_pth, output_pth)
+            elif command == "mri_synthseg":
+                pairs = self.image_pairs(self.option(args, "--i"), self.option(args, "--o"), "_synthseg.nii.gz")
+                for input_pth, output_pth in pairs:
+                    self.check(input_pth)
+                    self.synthseg(input_pth, output_pth)
+            elif command == "mri_easyreg":
+                pairs = [(self.option(args, "--flo"), self.option(args, "--fwd_field"))]
+                self.check(self.option(args, "--ref"), pairs[0][0])
+                self.easyreg(self.option(args, "--ref"), pairs[0][1])
+            elif command == "mri_easywarp":
+                pairs = [(self.option(args, "--i"), self.option(args, "--o"))]
+                self.check(pairs[0][0])
+                FieldWarper(self.option(args, "--field")).warp(pairs[0][0], pairs[0][1],
+                                                               "nearest" if "--nearest" in args else "linear")
+            else:
+                return 127, f"{command}: fake tool not available"
+        except (RuntimeError, ValueError, OSError) as e:
+            return 1, f"{command} failed: {e}"
+
+        time.sleep(self.command_delay(command) * len(pairs))
+        return 0, f"{command}: {len(pairs)} image(s) done"
+
+    @staticmethod
+    def synthseg(input_pth, output_pth):
+        # labels from the world position of the head voxels, so that they do not depend on the contrast
+        image = sitk.ReadImage(input_pth, sitk.sitkFloat32)
+        array = sitk.GetArrayViewFromImage(image)
+        foreground = array > 0.1 * np.percentile(array, 99)
+
+        size = image.GetSize()
+        index = np.stack(np.meshgrid(*[np.arange(n, dtype=np.float32) for n in size[::-1]], indexing="ij")[::-1],
+                         axis=-1)
+        matrix = np.array(image.GetDirection()).reshape(3, 3) * np.array(image.GetSpacing())
+        points = index @ matrix.T.astype(np.float32) + np.array(image.GetOrigin(), dtype=np.float32)
+        centre = points[foreground].mean(axis=0) if foreground.any() else np.zeros(3, dtype=np.float32)
+        radius = np.sqrt(np.sum((points - centre) ** 2, axis=-1))
+        inner = radius < (np.percentile(radius[foreground], 60) if foreground.any() else 0.)
+        # LPS: left hemisphere at x > 0
+        left = points[..., 0] > centre[0]
+
+        seg = np.zeros(array.shape, dtype=np.int32)
+        seg[foreground & inner & left] = 2
+        seg[foreground & ~inner & left] = 3
+        seg[foreground & inner & ~left] = 41
+        seg[foreground & ~inner & ~left] = 42
+
+        seg = sitk.GetImageFromArray(seg)
+        seg.CopyInformation(image)
+        sitk.WriteImage(seg, output_pth)
+
+    @staticmethod
+    def easyreg(ref_pth, field_pth):
+
+        ref = sitk.ReadImage(ref_pth)
+        size = ref.GetSize()
+        index = np.stack(np.meshgrid(*[np.arange(n, dtype=np.float64) for n in size[::-1]], indexing="ij")[::-1],
+                         axis=-1)
+        matrix = np.array(ref.GetDirection()).reshape(3, 3) * np.array(ref.GetSpacing())
+        ras = (index @ matrix.T + np.array(ref.GetOrigin())) * np.array([-1., -1., 1.])
+
+        coords = []
+        for axis in range(3):
+            coord = sitk.GetImageFromArray(ras[..., axis].astype(np.float32))
+            coord.CopyInformation(ref)
+            coords.append(coord)
+        sitk.WriteImage(sitk.JoinSeries(coords), field_pth)
+
+
+def main():
+    # fake_tools.py --install BIN_DIR [DELAY] writes the executables, fake_tools.py mri_<tool> ... runs a tool
+    if len(sys.argv) > 2 and sys.argv[1] == "--install":
+        FakeTools.install(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+        print(f"Fake FreeSurfer tools written in {sys.argv[2]}")
+        return
+
+    tools = FakeTools(FakeTools.parse_delay(os.environ.get("FAKE_FREESURFER_DELAY", "0")))
+    returncode, output = tools.run(sys.argv[1:])
+    print(output)
+    sys.exit(returncode)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import os
+import numpy as np
+import SimpleITK as sitk
+from volume_cache import read_image
+
+
+INTERPOLATORS = {"nearest": sitk.sitkNearestNeighbor, "linear": sitk.sitkLinear}
+
+
+class FieldWarper:
+
+    """
+    Warps images with an EasyReg forward field in process, instead of one mri_easywarp command per image.
+
+    The field (fwd_field.nii.gz) is a 4D image on the grid of the reference: for every voxel, the RAS coordinates of
+    the corresponding point of the floating image. It is read once and converted to a SimpleITK displacement field
+    (LPS point of the floating image - LPS point of the voxel), every image is then resampled through the same
+    transform onto the grid of the field, as mri_easywarp does.
+    """
+
+    def __init__(self, field_pth, volume_cache=None):
+        """
+        :param field_pth: EasyReg forward field
+        :param volume_cache: VolumeCache the moving images are read through and the warped images stored in
+        """
+        self.field_pth = field_pth
+        self.volume_cache = volume_cache
+
+        field = sitk.ReadImage(field_pth)
+        dimension = field.GetDimension()
+        if dimension == 4 and field.GetSize()[3] == 3:
+            coords = sitk.GetArrayViewFromImage(field)  # (3, z, y, x), RAS
+        elif dimension == 3 and field.GetNumberOfComponentsPerPixel() == 3:
+            # field saved as a vector image
+            coords = np.moveaxis(sitk.GetArrayViewFromImage(field), -1, 0)
+        else:
+            raise ValueError(f"{field_pth} is not a deformation field (size {field.GetSize()})")
+
+        # 3D grid of the field (the 4th axis holds the coordinates), the warped images are resampled on it
+        self.grid = sitk.Image(field.GetSize()[:3], sitk.sitkUInt8)
+        self.grid.SetOrigin(field.GetOrigin()[:3])
+        self.grid.SetSpacing(field.GetSpacing()[:3])
+        self.grid.SetDirection(np.array(field.GetDirection()).reshape(dimension, dimension)[:3, :3].ravel().tolist())
+
+        displacement = np.empty(coords.shape[1:] + (3,), dtype=np.float64)
+        points = self.grid_points()
+        for axis, sign in enumerate([-1., -1., 1.]):  # RAS -> LPS
+            displacement[..., axis] = sign * coords[axis] - points[..., axis]
+
+        displacement = sitk.GetImageFromArray(displacement, isVector=True)
+        displacement.CopyInformation(self.grid)
+        self.transform = sitk.DisplacementFieldTransform(displacement)
+
+    def grid_points(self):
+        # LPS physical point of every voxel of the grid, (z, y, x, 3)
+        size = self.grid.GetSize()
+        direction = np.array(self.grid.GetDirection()).reshape(3, 3)
+        matrix = direction * np.array(self.grid.GetSpacing())
+        index = np.stack(np.meshgrid(*[np.arange(n, dtype=np.float64) for n in size[::-1]], indexing="ij")[::-1],
+                         axis=-1)
+        return index @ matrix.T + np.array(self.grid.GetOrigin())
+
+    def warp(self, moving_pth, save_pth, interpolation="linear"):
+        """
+        :param moving_pth: image of the floating space (e.g. the FLAIR or its lesion mask)
+        :param save_pth: warped image, on the grid of the field
+        :param interpolation: "nearest" (labels) or "linear"
+        """
+        moving = read_image(moving_pth, volume_cache=self.volume_cache)
+        warped = sitk.Resample(moving, self.grid, self.transform, INTERPOLATORS[interpolation], 0.,
+                               moving.GetPixelID())
+
+        # written under a temporary name, a partial output would be reused by the "file exists" check of the next run
+        tmp_pth = os.path.join(os.path.dirname(save_pth), "tmp_" + os.path.basename(save_pth))
+        sitk.WriteImage(warped, tmp_pth)
+        os.replace(tmp_pth, save_pth)
+        if self.volume_cache is not None:
+            # read next by the dice or the QC image
+            self.volume_cache.put(save_pth, warped)
@@ -0,0 +1,190 @@
+import os
+import json
+import html
+import hashlib
+
+
+STYLES = """
+<style>
+    img {
+        max-width: 90%;
+        display: block;
+    }
+    .img-container {
+        display: flex;
+        align-items: center;
+        margin: 10px 0;
+    }
+    .img-title {
+        font-size: 1em;
+        margin-right: 10px;
+        width: 150px;  /* Fixed width for the title. Adjust as needed. */
+        overflow: hidden;
+        white-space: normal;  /* Allow line breaks */
+    }
+    .nav {
+        margin: 10px 0;
+    }
+    .nav a {
+        margin-right: 20px;
+    }
+    body {
+        font-size: 1.5em;
+        font-family: Arial, sans-serif;
+    }
+</style>
+"""
+
+
+class QCGallery:
+
+    """
+    Paginated HTML QC gallery.
+
+    Every case is rendered to its own HTML fragment (gallery_fragments/<case>.html) when it completes. The fragments
+    are assembled into pages of cases_per_page cases (<html_file>_page<n>.html) and html_file is the navigation index
+    linking to every case. A state json keeps a digest of every fragment and page, so an update only rewrites the
+    fragments of changed cases and the pages containing them.
+
+    The pages are written in the image folder, the image paths of the cases are relative to it (e.g. ./<case>/...).
+    """
+
+    def __init__(self, gallery_dir, html_file, title, cases_per_page=50):
+
+        self.gallery_dir = gallery_dir
+        self.title = title
+        self.cases_per_page = cases_per_page
+
+        self.index_pth = os.path.join(gallery_dir, html_file)
+        self.page_file = html_file.replace(".html", "_page{}.html")
+        self.fragment_dir = os.path.join(gallery_dir, "gallery_fragments")
+        self.state_pth = os.path.join(gallery_dir, html_file.replace(".html", "_state.json"))
+
+        os.makedirs(self.fragment_dir, exist_ok=True)
+        self.state = self.load_state()
+
+    def load_state(self):
+
+        try:
+            with open(self.state_pth, 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"fragments": {}, "pages": {}, "index": None}
+
+    def save_state(self):
+
+        self.write_file(self.state_pth, json.dumps(self.state, indent=4))
+
+    @staticmethod
+    def write_file(pth, content):
+        # the gallery may be open in a browser while it is updated
+        tmp_pth = pth + ".tmp"
+        with open(tmp_pth, 'w', encoding='utf-8') as file:
+            file.write(content)
+        os.replace(tmp_pth, pth)
+
+    @staticmethod
+    def digest(content):
+
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def fragment_pth(self, case):
+
+        return os.path.join(self.fragment_dir, f"{case}.html")
+
+    def case_html(self, case, items):
+        """
+        :param case: BIDS case name
+        :param items: list of images {"title", "image"} and dice scores {"dice_avg", "dice_std", "dice_outliers"}
+        :return: html fragment of the case
+        """
+        case = html.escape(case)
+        fragment = f'<div class="case" id="{case}">\n<hr>\n<h3>Case: {case}</h3>\n'
+        for item in items:
+            if "image" in item:
+                title = html.escape(item["title"])
+                fragment += (f'<div class="img-container"><span class="img-title">{title}</span>'
+                             f'<img src="{html.escape(item["image"])}" alt="{title}" loading="lazy"></div>\n')
+            else:
+                fragment += (f'<p><strong>Avg Dice (stdev): {item["dice_avg"]} ({item["dice_std"]})</strong></p>\n'
+                             f'<p><strong>Dice Scores below 0.7: {item["dice_outliers"]}</strong></p>\n')
+        return fragment + '</div>\n'
+
+    def write_case(self, case, items):
+        """
+        Write the fragment of a case, only if its content changed.
+        :return: digest of the fragment
+        """
+        fragment = self.case_html(case, items)
+        digest = self.digest(fragment)
+        if self.state["fragments"].get(case) != digest or not os.path.exists(self.fragment_pth(case)):
+            self.write_file(self.fragment_pth(case), fragment)
+            self.state["fragments"][case] = digest
+        return digest
+
+    def page_html(self, page, cases, has_next):
+
+        nav = f'<div class="nav"><a href="{os.path.basename(self.index_pth)}">Index</a>'
+        if page > 0:
+            nav += f'<a href="{self.page_file.format(page)}">Previous</a>'
+        if has_next:
+            nav += f'<a href="{self.page_file.format(page + 2)}">Next</a>'
+        nav += '</div>\n'
+
+        content = f'<h2>{html.escape(self.title)} - page {page + 1}</h2>\n' + nav
+        for case in cases:
+            with open(self.fragment_pth(case), 'r', encoding='utf-8') as file:
+                content += file.read()
+        content += nav
+
+        return f"<!DOCTYPE html>\n<html>\n<head>{STYLES}</head>\n<body>{content}</body>\n</html>"
+
+    def index_html(self, pages):
+
+        content = f'<h2>{html.escape(self.title)}</h2>\n'
+        for page, cases in enumerate(pages):
+            page_file = self.page_file.format(page + 1)
+            content += f'<h3><a href="{page_file}">Page {page + 1}</a></h3>\n<p>\n'
+            content += ' |\n'.join(f'<a href="{page_file}#{html.escape(case)}">{html.escape(case)}</a>'
+                                   for case in cases)
+            content += '\n</p>\n'
+
+        return f"<!DOCTYPE html>\n<html>\n<head>{STYLES}</head>\n<body>{content}</body>\n</html>"
+
+    def update(self, case_results):
+        """
+        Bring the gallery up to date, only rewriting the fragments and pages which changed.
+        :param case_results: list of {"case", "gallery"}, in gallery order
+        """
+        cases = []
+        for case_result in case_results:
+            self.write_case(case_result["case"], case_result["gallery"])
+            cases.append(case_result["case"])
+
+        pages = [cases[i:i + self.cases_per_page] for i in range(0, len(cases), self.cases_per_page)]
+        page_digests = {}
+        for page, page_cases in enumerate(pages):
+            page_file = self.page_file.format(page + 1)
+            has_next = page + 1 < len(pages)
+            page_digests[page_file] = self.digest(json.dumps([has_next] + [[case, self.state["fragments"][case]]
+                                                                           for case in page_cases]))
+            if (self.state["pages"].get(page_file) != page_digests[page_file]
+                    or not os.path.exists(os.path.join(self.gallery_dir, page_file))):
+                self.write_file(os.path.join(self.gallery_dir, page_file), self.page_html(page, page_cases, has_next))
+
+        # pages and fragments of cases which left the gallery
+        for page_file in set(self.state["pages"]) - set(page_digests):
+            if os.path.exists(os.path.join(self.gallery_dir, page_file)):
+                os.remove(os.path.join(self.gallery_dir, page_file))
+        for case in set(self.state["fragments"]) - set(cases):
+            if os.path.exists(self.fragment_pth(case)):
+                os.remove(self.fragment_pth(case))
+            del self.state["fragments"][case]
+        self.state["pages"] = page_digests
+
+        index_digest = self.digest(json.dumps(pages))
+        if self.state["index"] != index_digest or not os.path.exists(self.index_pth):
+            self.write_file(self.index_pth, self.index_html(pages))
+            self.state["index"] = index_digest
+
+        self.save_state()
@@ -0,0 +1,128 @@
+import gzip
+import struct
+import numpy as np
+import SimpleITK as sitk
+
+
+# NIfTI-1 datatype codes
+NIFTI_DTYPES = {2: "uint8", 4: "int16", 8: "int32", 16: "float32", 32: "complex64", 64: "float64", 128: "rgb24",
+                256: "int8", 512: "uint16", 768: "uint32", 1024: "int64", 1280: "uint64", 1792: "complex128"}
+
+SITK_DTYPES = {sitk.sitkUInt8: "uint8", sitk.sitkInt8: "int8", sitk.sitkUInt16: "uint16", sitk.sitkInt16: "int16",
+               sitk.sitkUInt32: "uint32", sitk.sitkInt32: "int32", sitk.sitkUInt64: "uint64", sitk.sitkInt64: "int64",
+               sitk.sitkFloat32: "float32", sitk.sitkFloat64: "float64",
+               sitk.sitkVectorUInt8: "uint8", sitk.sitkVectorInt8: "int8", sitk.sitkVectorUInt16: "uint16",
+               sitk.sitkVectorInt16: "int16", sitk.sitkVectorUInt32: "uint32", sitk.sitkVectorInt32: "int32",
+               sitk.sitkVectorUInt64: "uint64", sitk.sitkVectorInt64: "int64", sitk.sitkVectorFloat32: "float32",
+               sitk.sitkVectorFloat64: "float64"}
+
+
+def axis_codes(ras_axes: np.array) -> str:
+    """
+    Orientation of the voxel axes e.g. "RAS", "LIA".
+    :param ras_axes: 3x3 matrix whose columns are the voxel axes in RAS world coordinates
+    :return: for each voxel axis, the world direction it points to
+    """
+    codes = ""
+    for column in np.asarray(ras_axes).T:
+        world_axis = int(np.argmax(np.abs(column)))
+        codes += ("RAS" if column[world_axis] > 0 else "LPI")[world_axis]
+    return codes
+
+
+def itk_dimension(dim: tuple) -> int:
+    """
+    Number of dimensions as reported by the ITK NIfTI reader (i.e. by the former full read with sitk.ReadImage).
+    A time axis of size 1 is dropped, vector images (dim[0] = 5) drop all trailing axes of size 1.
+    :param dim: dim field of the NIfTI header
+    :return: dimension
+    """
+    dimension = min(dim[0], 4)
+    min_dimension = 1 if dim[0] >= 5 else 3
+    while dimension > min_dimension and dim[dimension] == 1:
+        dimension -= 1
+    return dimension
+
+
+def read_nifti_header(pth: str) -> dict:
+    """
+    Parse the 348 bytes NIfTI-1 header of a .nii or .nii.gz file (only the header is decompressed).
+    :param pth: path to the nifti file
+    :return: dict with dimension, shape, spacing, dtype and orientation
+    """
+    opener = gzip.open if pth.endswith(".gz") else open
+    with opener(pth, 'rb') as file:
+        header = file.read(348)
+
+    if len(header) < 348:
+        raise ValueError(f"{pth} is too short to be a NIfTI file")
+    endian = "<" if struct.unpack("<i", header[0:4])[0] == 348 else ">"
+    if struct.unpack(endian + "i", header[0:4])[0] != 348:
+        raise ValueError(f"{pth} is not a NIfTI-1 file")
+
+    dim = struct.unpack(endian + "8h", header[40:56])
+    datatype = struct.unpack(endian + "h", header[70:72])[0]
+    pixdim = struct.unpack(endian + "8f", header[76:108])
+    qform_code, sform_code = struct.unpack(endian + "2h", header[252:256])
+    quatern_b, quatern_c, quatern_d = struct.unpack(endian + "3f", header[256:268])
+    srow = np.array(struct.unpack(endian + "12f", header[280:328])).reshape(3, 4)
+
+    # dim[5] holds vector components, which ITK reads as pixel components rather than an extra axis
+    dimension = itk_dimension(dim)
+    dims = dim[1:dimension + 1]
+
+    if sform_code > 0:
+        ras_axes = srow[:, :3]
+    elif qform_code > 0:
+        b, c, d = quatern_b, quatern_c, quatern_d
+        a = np.sqrt(max(0., 1. - (b * b + c * c + d * d)))
+        ras_axes = np.array([[a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+                             [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+                             [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b]])
+        ras_axes[:, 2] *= -1 if pixdim[0] < 0 else 1
+    else:
+        ras_axes = np.eye(3)
+
+    return {"dimension": dimension,
+            "shape": tuple(dims),
+            "spacing": tuple(float(spacing) for spacing in pixdim[1:dimension + 1]),
+            "dtype": NIFTI_DTYPES.get(datatype, str(datatype)),
+            "orientation": axis_codes(ras_axes) if dimension >= 3 else None}
+
+
+def read_sitk_header(pth: str) -> dict:
+    """
+    Read the image information with SimpleITK without reading the voxels (any format ITK can read e.g. .mgz).
+    :param pth: path to the image file
+    :return: dict with dimension, shape, spacing, dtype and orientation
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(pth)
+    reader.ReadImageInformation()
+
+    dimension = reader.GetDimension()
+    orientation = None
+    if dimension >= 3:
+        # ITK directions are in LPS
+        lps_axes = np.array(reader.GetDirection()).reshape(dimension, dimension)[:3, :3]
+        orientation = axis_codes(np.diag([-1, -1, 1]) @ lps_axes)
+
+    return {"dimension": dimension,
+            "shape": tuple(reader.GetSize()),
+            "spacing": tuple(reader.GetSpacing()),
+            "dtype": SITK_DTYPES.get(reader.GetPixelID(), sitk.GetPixelIDValueAsString(reader.GetPixelID())),
+            "orientation": orientation}
+
+
+def probe_header(pth: str) -> dict:
+    """
+    Image metadata without reading (or decompressing) the voxel data.
+    :param pth: path to the image file
+    :return: dict with dimension, shape, spacing, dtype and orientation (e.g. "RAS")
+    """
+    if pth.endswith(".nii") or pth.endswith(".nii.gz"):
+        try:
+            return read_nifti_header(pth)
+        except ValueError:
+            pass  # e.g. NIfTI-2, let ITK handle it
+    return read_sitk_header(pth)
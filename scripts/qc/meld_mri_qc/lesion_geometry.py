@@ -0,0 +1,92 @@
+import os
+import json
+import numpy as np
+import SimpleITK as sitk
+
+
+def area_profiles(mask: np.array) -> list:
+    """
+    Lesion area of every slice along each array axis, one reduction per axis.
+    :param mask: boolean (z, y, x) array
+    :return: [areas of the slices along axis 0, axis 1, axis 2]
+    """
+    return [mask.sum(axis=tuple(other for other in range(3) if other != axis)) for axis in range(3)]
+
+
+def largest_slices(mask: np.array) -> tuple:
+    """
+    Along each array axis, the first slice with the largest lesion area (None without lesion).
+    """
+    if not mask.any():
+        return None, None, None
+    return tuple(int(np.argmax(areas)) for areas in area_profiles(mask))
+
+
+def lesion_geometry(mask: np.array, image: sitk.Image = None) -> dict:
+    """
+    :param mask: boolean (z, y, x) array of the lesion
+    :param image: sitk image of the mask, for the volume, world centroid and hemisphere (None for voxel units only)
+    :return: dict with shape, voxel count, largest slices, bounding box (first and last slice of each array axis),
+    centroid (array indices), and with the image volume_ml, centroid_mm (LPS x, y, z) and hemisphere of the centroid
+    relative to the centre of the image
+    """
+    profiles = area_profiles(mask)
+    voxels = int(profiles[0].sum())
+    geometry = {"shape": list(mask.shape), "voxels": voxels, "largest_slices": [None, None, None],
+                "bbox": None, "centroid": None, "volume_ml": None, "centroid_mm": None, "hemisphere": None}
+    if voxels == 0:
+        return geometry
+
+    geometry["largest_slices"] = [int(np.argmax(areas)) for areas in profiles]
+    geometry["bbox"] = [[int(np.flatnonzero(areas)[0]), int(np.flatnonzero(areas)[-1])] for areas in profiles]
+    # centroid from the profiles, the voxels are not listed
+    centroid = [float(np.dot(np.arange(len(areas)), areas) / voxels) for areas in profiles]
+    geometry["centroid"] = [round(value, 2) for value in centroid]
+
+    if image is not None:
+        geometry["volume_ml"] = round(voxels * float(np.prod(image.GetSpacing())) / 1000., 4)
+        centroid_mm = image.TransformContinuousIndexToPhysicalPoint(centroid[::-1])  # sitk index is (x, y, z)
+        centre_mm = image.TransformContinuousIndexToPhysicalPoint([(size - 1) / 2. for size in image.GetSize()])
+        geometry["centroid_mm"] = [round(value, 2) for value in centroid_mm]
+        # LPS: x increases towards the left
+        geometry["hemisphere"] = "left" if centroid_mm[0] > centre_mm[0] else "right"
+
+    return geometry
+
+
+def geometry_pth(mask_pth):
+    # sidecar next to the mask e.g. sub-X_lesion_mask_space-T1.nii.gz -> sub-X_lesion_mask_space-T1_geometry.json
+    stem = mask_pth[:-len(".nii.gz")] if mask_pth.endswith(".nii.gz") else os.path.splitext(mask_pth)[0]
+    return stem + "_geometry.json"
+
+
+def mask_signature(mask_pth):
+
+    stat = os.stat(mask_pth)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def cached_lesion_geometry(mask_pth, image: sitk.Image = None) -> dict:
+    """
+    Geometry of a lesion mask (voxels != 0), from its sidecar if the mask is unchanged, otherwise computed and saved in
+    the sidecar.
+    :param mask_pth: path to the mask
+    :param image: the mask already read, otherwise it is only read if the sidecar is missing or stale
+    """
+    sidecar_pth = geometry_pth(mask_pth)
+    signature = mask_signature(mask_pth)
+    if os.path.exists(sidecar_pth):
+        try:
+            with open(sidecar_pth, 'r') as file:
+                sidecar = json.load(file)
+            if sidecar.get("mask") == signature:
+                return sidecar["geometry"]
+        except (json.JSONDecodeError, KeyError):
+            pass
+
+    image = sitk.ReadImage(mask_pth, sitk.sitkUInt8) if image is None else image
+    geometry = lesion_geometry(sitk.GetArrayViewFromImage(image) != 0, image)
+    with open(sidecar_pth, 'w') as file:
+        json.dump({"mask": signature, "geometry": geometry}, file, indent=4)
+
+    return geometry
@@ -1,11 +1,84 @@
+import argparse
+
 from directory_registration import DirectoryRegistration
+from parameters import Config
+from stage_profile import PROFILED_STAGES, PROFILE_MODES
+from shards import parse_shard
 
 
 def main():
 
+    parser = argparse.ArgumentParser(description="Register and QC the MRI modalities of a MELD BIDS site")
+    parser.add_argument("--workers",
+                        help="number of cases registered in parallel (overrides parameters.py)",
+                        type=int,
+                        default=None,
+                        )
+    parser.add_argument("--force",
+                        help="ignore the completion manifest and re-run every case",
+                        action="store_true",
+                        )
+    parser.add_argument("--resegment",
+                        help="compute the dice on a SynthSeg segmentation of every registered image instead of the "
+                             "warped floating segmentation",
+                        action="store_true",
+                        )
+    parser.add_argument("--profile",
+                        help="stages to profile for every case, e.g. qc_imgs dice_calc (or all), overrides "
+                             "parameters.py",
+                        nargs="+",
+                        choices=PROFILED_STAGES + ["all"],
+                        default=None,
+                        )
+    parser.add_argument("--profile-mode",
+                        help="cProfile, tracemalloc allocation reports or both",
+                        choices=PROFILE_MODES,
+                        default=None,
+                        )
+    parser.add_argument("--render-workers",
+                        help="processes rendering the QC images in the background (overrides parameters.py)",
+                        type=int,
+                        default=None,
+                        )
+    parser.add_argument("--render-only",
+                        help="only regenerate the QC images and gallery of the completed cases, in parallel",
+                        action="store_true",
+                        )
+    parser.add_argument("--shard",
+                        help="i/N: only run shard i (1 to N) of the cases, with its own outputs, e.g. "
+                             "--shard $SLURM_ARRAY_TASK_ID/8 (merge them with merge_shards.py)",
+                        default=None,
+                        )
+    args = parser.parse_args()
+
+    config = Config()
+    if args.workers is not None:
+        config.workers = args.workers
+    if args.force:
+        config.resume = False
+    if args.resegment:
+        config.warp_seg_dice = False
+    if args.shard is not None:
+        try:
+            parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+        config.shard = args.shard
+    if args.render_workers is not None:
+        config.render_workers = args.render_workers
+    if args.profile is not None:
+        config.profile_stages = args.profile
+    if args.profile_mode is not None:
+        config.profile_mode = args.profile_mode
+
+    directory_registration = DirectoryRegistration(config)
+    if args.render_only:
+        directory_registration.render_only()
+        print("\nQC Images Rendered")
+        return
+
     print("Directory Registration Initiated\n")
 
-    directory_registration = DirectoryRegistration()
     directory_registration.directory_registration()
 
     print("\nDirectory Registration Complete")
@@ -13,8 +86,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
-
-
-
-
@@ -0,0 +1,137 @@
+import os
+import json
+import hashlib
+
+
+class CaseManifest:
+
+    """
+    Completion manifest of the MRI QC pipeline, stored as json next to the QC matrix in save_dir.
+
+    For every completed case it records:
+    1) the stage reached ("complete")
+    2) size, mtime and sha256 of every input file of the case (anat and dwi folders)
+    3) the paths of every output written for the case
+    4) the case result (matrix row and gallery items) used to rebuild the gallery
+
+    A case is skipped on a rerun if its inputs are unchanged and all of its outputs still exist.
+    Hashes are only recomputed when size or mtime changed, so checking an unchanged site is cheap.
+    """
+
+    def __init__(self, manifest_pth):
+
+        self.manifest_pth = manifest_pth
+        self.cases = self.load()
+
+    def load(self):
+
+        try:
+            with open(self.manifest_pth, 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save(self):
+        # write to a temporary file and rename, so an interrupted run never leaves a truncated manifest
+        tmp_pth = self.manifest_pth + ".tmp"
+        with open(tmp_pth, 'w') as file:
+            json.dump(self.cases, file, indent=4)
+        os.replace(tmp_pth, self.manifest_pth)
+
+    @staticmethod
+    def file_hash(pth, chunk_size=1024 * 1024):
+
+        sha = hashlib.sha256()
+        with open(pth, 'rb') as file:
+            for chunk in iter(lambda: file.read(chunk_size), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def file_record(self, pth, previous=None):
+        """
+        :param pth: input file path
+        :param previous: record of the same file from the manifest, its hash is reused if size and mtime match
+        :return: dict with size, mtime and sha256 of the file
+        """
+        stat = os.stat(pth)
+        if (previous is not None and previous["sha256"] is not None
+                and previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime):
+            return previous
+        return {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": self.file_hash(pth)}
+
+    def input_records(self, case, input_pths):
+        """
+        :param case: BIDS case name
+        :param input_pths: all input files of the case
+        :return: dict of file records, taken before the case is run
+        """
+        previous = self.cases.get(case, {}).get("inputs", {})
+        records = {}
+        for pth in input_pths:
+            if pth in previous:
+                records[pth] = self.file_record(pth, previous[pth])
+            else:
+                # new file, the case runs anyway: it is hashed once the case is recorded
+                stat = os.stat(pth)
+                records[pth] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": None}
+        return records
+
+    def is_complete(self, case, input_records):
+
+        entry = self.cases.get(case)
+        if entry is None or entry["stage"] != "complete":
+            return False
+        if set(entry["inputs"]) != set(input_records):
+            return False
+        if any(record["sha256"] is None or entry["inputs"][pth]["sha256"] != record["sha256"]
+               for pth, record in input_records.items()):
+            return False
+        if not all(os.path.exists(pth) for pth in entry["outputs"]):
+            return False
+
+        # same content with a new mtime (e.g. re-exported BIDS): keep the new stats to avoid rehashing next time
+        entry["inputs"] = input_records
+        return True
+
+    def stale_outputs(self, case):
+
+        entry = self.cases.get(case)
+        return [] if entry is None else [pth for pth in entry["outputs"] if os.path.isfile(pth)]
+
+    def record(self, case, input_records, output_pths, case_result):
+
+        for pth, record in input_records.items():
+            if record["sha256"] is None and os.path.isfile(pth):
+                stat = os.stat(pth)
+                # only trust the hash if the file was not modified while the case was running
+                if stat.st_size == record["size"] and stat.st_mtime == record["mtime"]:
+                    record["sha256"] = self.file_hash(pth)
+
+        self.cases[case] = {"stage": "complete",
+                            "inputs": input_records,
+                            "outputs": sorted(set(output_pths)),
+                            "result": case_result}
+        self.save()
+
+    def discard(self, case):
+
+        if self.cases.pop(case, None) is not None:
+            self.save()
+
+    def sort(self, order):
+        """
+        Put the entries of the given cases in this order, within the positions they hold (e.g. the cases of a
+        parallel run, recorded as they completed), so that the gallery order does not depend on scheduling.
+        """
+        cases = list(self.cases)
+        rank = {case: i for i, case in enumerate(order)}
+        positions = [i for i, case in enumerate(cases) if case in rank]
+        for i, case in zip(positions, sorted((cases[i] for i in positions), key=rank.get)):
+            cases[i] = case
+        if cases != list(self.cases):
+            self.cases = {case: self.cases[case] for case in cases}
+            self.save()
+
+    def case_results(self):
+        # in order of first completion, a rerun case keeps its position
+        return [entry["result"] for entry in self.cases.values() if entry["stage"] == "complete"]
@@ -0,0 +1,88 @@
+import os
+import re
+import glob
+import pstats
+import argparse
+import numpy as np
+
+
+def profile_files(folders, suffix):
+    # <name>__<stage><suffix> files under the folders, grouped by stage
+    files = {}
+    for folder in folders:
+        for pth in sorted(glob.glob(os.path.join(folder, "**", f"*__*{suffix}"), recursive=True)):
+            stage = os.path.basename(pth)[:-len(suffix)].rsplit("__", 1)[1]
+            files.setdefault(stage, []).append(pth)
+    return files
+
+
+def alloc_peaks(pths):
+
+    peaks = []
+    for pth in pths:
+        with open(pth, 'r') as file:
+            match = re.search(r"Peak traced memory: ([\d.]+) MB", file.read())
+        if match is not None:
+            peaks.append(float(match.group(1)))
+    return peaks
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Merge the per-case stage profiles (<case>__<stage>.prof, see "
+                                                 "StageProfiler) of one or several runs, per stage")
+    parser.add_argument("folders",
+                        help="folders searched recursively for profiles e.g. qc_images and synthseg of a site",
+                        nargs="+",
+                        )
+    parser.add_argument("--stage",
+                        help="only merge the profiles of these stages",
+                        nargs="+",
+                        default=None,
+                        )
+    parser.add_argument("--sort",
+                        help="pstats sort key",
+                        default="cumulative",
+                        )
+    parser.add_argument("--top",
+                        help="number of functions printed per stage",
+                        type=int,
+                        default=30,
+                        )
+    parser.add_argument("-o", "--output_dir",
+                        help="folder of the merged profiles <stage>.prof (e.g. for snakeviz)",
+                        default=None,
+                        )
+    args = parser.parse_args()
+
+    profiles = profile_files(args.folders, ".prof")
+    allocs = profile_files(args.folders, "_alloc.txt")
+    stages = sorted(set(profiles) | set(allocs))
+    if args.stage is not None:
+        stages = [stage for stage in stages if stage in args.stage]
+    if not stages:
+        print("No stage profiles found")
+        return
+
+    for stage in stages:
+        print(f"\n===== {stage} =====")
+        if stage in allocs:
+            peaks = alloc_peaks(allocs[stage])
+            if peaks:
+                print(f"{len(peaks)} allocation reports, peak traced memory (MB): median {np.median(peaks):.1f}, "
+                      f"max {max(peaks):.1f}")
+        if stage not in profiles:
+            continue
+
+        print(f"{len(profiles[stage])} profiles merged")
+        stats = pstats.Stats(*profiles[stage])
+        stats.files = []  # not one header line per case
+        stats.sort_stats(args.sort).print_stats(args.top)
+        if args.output_dir is not None:
+            os.makedirs(args.output_dir, exist_ok=True)
+            stats.dump_stats(os.path.join(args.output_dir, f"{stage}.prof"))
+            print(f"Merged profile saved at {os.path.join(args.output_dir, stage + '.prof')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+import os
+import csv
+import argparse
+
+from qc_matrix import QCMatrix
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Merge the QC matrices of several batches (e.g. into df_qc_all_<site>.csv)")
+    parser.add_argument("-o", "--output",
+                        help="merged QC matrix, only the rows added to the sources since the last merge are read",
+                        required=True,
+                        )
+    parser.add_argument("sources",
+                        help="QC matrices to merge, a subject in several matrices keeps the row of the last one",
+                        nargs="+",
+                        )
+    args = parser.parse_args()
+
+    columns = None
+    if not os.path.exists(args.output):
+        with open(args.sources[0], 'r', newline='') as file:
+            columns = next(csv.reader(file))
+
+    qc_matrix = QCMatrix(args.output, columns)
+    qc_matrix.merge(args.sources)
+    qc_matrix.compact()
+
+    print(f"Merged {len(args.sources)} QC matrices into {args.output}")
+
+
+if __name__ == "__main__":
+    main()
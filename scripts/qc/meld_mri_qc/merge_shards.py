@@ -0,0 +1,63 @@
+import os
+import csv
+import argparse
+
+from parameters import Config
+from qc_matrix import QCMatrix
+from manifest import CaseManifest
+from gallery import QCGallery
+from shards import shard_name
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Merge the outputs of the shards of a site (main.py --shard i/N) "
+                                                 "into the QC matrix, manifest and gallery of parameters.py")
+    parser.add_argument("-n", "--shards",
+                        help="number of shards N",
+                        type=int,
+                        required=True,
+                        )
+    args = parser.parse_args()
+
+    config = Config()
+    shards = [f"{i}/{args.shards}" for i in range(1, args.shards + 1)]
+
+    matrix_pth = os.path.join(config.save_dir, config.matrix_save_name)
+    sources = [os.path.join(config.save_dir, shard_name(config.matrix_save_name, shard)) for shard in shards]
+    missing = [pth for pth in sources if not os.path.exists(pth)]
+    if missing:
+        print(f"Warning: no QC matrix for {len(missing)} shard(s) (not run yet?): {', '.join(missing)}")
+    sources = [pth for pth in sources if os.path.exists(pth)]
+    if not sources:
+        return
+
+    # rows of every shard, only the rows added since the last merge are read
+    columns = None
+    if not os.path.exists(matrix_pth):
+        with open(sources[0], 'r', newline='') as file:
+            columns = next(csv.reader(file))
+    qc_matrix = QCMatrix(matrix_pth, columns)
+    qc_matrix.merge(sources)
+
+    # completed cases of every shard, so that an unsharded rerun (or another sharding) resumes from them
+    manifest = CaseManifest(os.path.join(config.save_dir, config.matrix_save_name.replace(".csv", "_manifest.json")))
+    for shard in shards:
+        shard_manifest_pth = os.path.join(config.save_dir, shard_name(config.matrix_save_name, shard).replace(
+            ".csv", "_manifest.json"))
+        if os.path.exists(shard_manifest_pth):
+            manifest.cases.update(CaseManifest(shard_manifest_pth).cases)
+    manifest.save()
+
+    # rows in case order (the order of an unsharded run) rather than grouped by shard
+    qc_matrix.compact(order=sorted(manifest.cases))
+
+    # the fragments of the cases were written by the shards, only the pages and index are assembled
+    gallery = QCGallery(config.img_save_dir, config.html_file, config.gallery_title, config.cases_per_page)
+    gallery.update(sorted(manifest.case_results(), key=lambda case_result: case_result["case"]))
+
+    print(f"Merged {len(sources)} shards into {matrix_pth} and {os.path.join(config.img_save_dir, config.html_file)}")
+
+
+if __name__ == "__main__":
+    main()
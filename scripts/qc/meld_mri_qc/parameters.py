@@ -1,3 +1,6 @@
+import os
+
+
 class Config:
 
     def __init__(self):
@@ -15,6 +18,10 @@ class Config:
 
         self.synth_save_dir = f'/home/mathilde/Documents/RDS/MELD_FE/DATA/MELD_{site}/MELD_BIDS_QC/synthseg/'  # None
 
+        # outputs of SynthSR, SynthSeg and EasyReg stored by input content and FreeSurfer version, shared by all batches
+        # and sites (None: no cache)
+        self.tool_cache_dir = '/home/mathilde/Documents/RDS/MELD_FE/DATA/freesurfer_cache/'
+
         self.mask_in_flair = False
 
         self.t1_tail = "_preop_T1w.nii.gz"
@@ -27,15 +34,96 @@ class Config:
         self.preop_dwi_tail = "_preop_DWI.nii.gz"
         self.preop_DWInegPE_tail = "_preop_DWInegPE.nii.gz"
 
+        self.flair_2d_tail = "_preop_2DFLAIR.nii.gz"  # only indexed, not registered
+
+        # index of the BIDS folder files (in save_dir), only folders modified since the last run are listed again
+        self.bids_index_name = "bids_inventory.sqlite"
+
         self.matrix_save_name = f"df_qc_{batch}.csv"
 
-        self.markdown_title = "MELD_QC"
-        self.markdown_file = f"image_gallery_{batch}.md"
+        # "i/N" to only run shard i of N of the cases (e.g. one array job of a cluster), None runs every case
+        self.shard = None
 
+        # QC gallery (in img_save_dir): html_file is the index, the cases are shown on pages of cases_per_page cases
+        self.gallery_title = "MELD_QC"
         self.html_file = f"image_gallery_{batch}.html"
+        self.cases_per_page = 50
+        # modality and lesion overlay QC images rendered from the numpy slices (without matplotlib), at qc_image_width
+        # pixels wide (None for one pixel per voxel), False for the matplotlib figures
+        self.fast_qc_images = True
+        self.qc_image_width = 2400
+        # only outline the lesion on the overlay QC images (fast_qc_images), instead of a transparent fill
+        self.overlay_contours = False
+        # memory cap (MB) of the images of a case kept in memory, so that each file is read at most once per case
+        # (per worker), 0 to read every image from disk
+        self.volume_cache_mb = 2048
+        # processes rendering the QC images in the background while the registration goes on (per worker process),
+        # 0 renders them within the qc_png stages
+        self.render_workers = 0
 
         self.use_synthseg = True
 
+        # number of cases registered in parallel (one process per case), 1 runs cases serially
+        self.workers = 1
+        # run the cases in threads of the driver process instead, the FreeSurfer tool limits below then apply to
+        # every case in flight (with processes, each worker process has its own limits)
+        self.worker_threads = False
+        # with workers > 1, dispatch the cases with the highest estimated cost first (from their modalities and the
+        # stage traces of previous runs)
+        self.longest_first = True
+
+        # skip cases recorded as complete in the manifest (next to matrix_save_name) whose inputs are unchanged
+        self.resume = True
+
+        # budget shared by the stages of one case: independent modalities are registered concurrently within it
+        # (with workers > 1 every worker process has its own budget)
+        self.case_cpus = os.cpu_count()
+        self.case_memory_gb = 32
+        # cpus and memory reserved by each stage, the cpus are passed to the FreeSurfer tools as --threads
+        self.stage_resources = {"synthsr": {"cpus": 4, "memory_gb": 8},
+                                "synthseg": {"cpus": 4, "memory_gb": 8},
+                                "easyreg": {"cpus": 4, "memory_gb": 12},
+                                "easywarp": {"cpus": 1, "memory_gb": 2},
+                                "dice": {"cpus": 1, "memory_gb": 2},
+                                "qc_png": {"cpus": 1, "memory_gb": 2}}
+
+        # maximum number of FreeSurfer commands of each tool running at once, and their timeout (seconds)
+        self.tool_concurrency = {"synthsr": 2, "synthseg": 2, "easyreg": 2, "easywarp": 8}
+        self.tool_timeouts = {"synthsr": 3600, "synthseg": 3600, "easyreg": 7200, "easywarp": 1800}
+        # images segmented (synthesised) by one mri_synthseg (mri_synthsr) command, the model is loaded once per batch.
+        # A batch collects the images requested within tool_batch_linger seconds (full batches start at once), timeouts
+        # are per image. Every batch waits the whole linger: a longer one gathers more images (fewer model loads) but
+        # delays each command by as much. None picks 2 s when the cases share the tools (worker_threads with several
+        # workers), otherwise 0.05 s, enough to batch the modalities of a case whose stages start together
+        self.tool_batch_sizes = {"synthseg": 16, "synthsr": 8}
+        self.tool_batch_linger = None
+        # UNIX socket of a running tool service (tool_service.py) keeping the tools warm between commands,
+        # None (or a service not running) runs every command in a new process
+        self.tool_service_socket = None
+
+        # warp the images, segmentations and lesion masks with the EasyReg field in process (the field is read once
+        # per modality), False runs mri_easywarp for every image
+        self.warp_in_process = True
+
+        # registration QC dice from the floating segmentation warped with the registration field (nearest neighbour),
+        # False runs SynthSeg again on every registered image instead
+        self.warp_seg_dice = True
+        # cases always re-segmented after registration, e.g. flagged at a previous QC
+        self.resegment_cases = []
+        # average dice of the warped segmentation below which the registered image is re-segmented (None: never)
+        self.resegment_dice_below = 0.7
+
+        # trace every stage of every case (duration, exit code, peak RSS, io) as json lines next to matrix_save_name
+        # e.g. df_qc_hs_trace.jsonl, summarised per site and stage by summarise_traces.py
+        self.trace_stages = True
+
+        # stages profiled for every case (qc_imgs, overlay_qc, dice_calc, fill_3d or "all"), [] for none; the profiles
+        # (<case>__<stage>.prof) and allocation reports are written next to the outputs of the stage, see merge_profiles.py
+        self.profile_stages = []
+        # "cprofile", "tracemalloc" (allocation report with the top profile_top sites) or "both"
+        self.profile_mode = "cprofile"
+        self.profile_top = 25
+
 
 
 
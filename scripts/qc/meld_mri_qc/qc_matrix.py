@@ -0,0 +1,224 @@
+import os
+import io
+import csv
+import json
+
+
+class QCMatrix:
+
+    """
+    Append-only QC matrix (csv), written case by case instead of once at the end of the run.
+
+    Rows are accumulated in a columnar buffer and appended to the csv on flush. A checkpoint json next to the csv
+    records the size of the file after the last complete flush:
+    1) a flush interrupted by a crash leaves the checkpoint "pending", the partial rows are truncated on the next open
+    2) a file modified since the last flush (e.g. QC columns filled in by hand) is kept as it is
+
+    A rerun case is appended again, compact() keeps the last row of every subject (the position of the rerun).
+    """
+
+    def __init__(self, matrix_pth, columns=None, first_rows=()):
+        """
+        :param matrix_pth: path of the csv
+        :param columns: columns of a new matrix (ignored if the csv exists, its header is used)
+        :param first_rows: rows written after the header of a new matrix e.g. the descriptions of the QC values
+        """
+        self.matrix_pth = matrix_pth
+        self.checkpoint_pth = matrix_pth.replace(".csv", "_checkpoint.json")
+
+        self.checkpoint = self.read_checkpoint(self.checkpoint_pth)
+        self.subjects = set()
+        if os.path.exists(self.matrix_pth):
+            self.recover()
+            with open(self.matrix_pth, 'r', newline='') as file:
+                self.columns = next(csv.reader(file))
+            self.subjects = set(self.read_column("Subject"))
+        else:
+            self.columns = list(columns)
+            with open(self.matrix_pth, 'w', newline='') as file:
+                self.writer(file).writerow(self.columns)
+            self.save_checkpoint(pending=False)
+            self.buffer_init()
+            for row in first_rows:
+                self.append(row)
+            self.flush()
+
+        self.buffer_init()
+
+    def writer(self, file):
+        # same format as DataFrame.to_csv
+        return csv.writer(file, lineterminator=os.linesep)
+
+    def buffer_init(self):
+
+        self.buffer = {column: [] for column in self.columns}
+
+    @staticmethod
+    def read_checkpoint(checkpoint_pth):
+
+        try:
+            with open(checkpoint_pth, 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def save_checkpoint(self, pending, generation=None):
+        # generation changes when the file is rewritten (not appended), see merge
+        stat = os.stat(self.matrix_pth)
+        if generation is None:
+            generation = 0 if self.checkpoint is None else self.checkpoint["generation"]
+        self.checkpoint = {"offset": stat.st_size, "mtime_ns": stat.st_mtime_ns, "pending": pending,
+                           "generation": generation}
+
+        tmp_pth = self.checkpoint_pth + ".tmp"
+        with open(tmp_pth, 'w') as file:
+            json.dump(self.checkpoint, file)
+        os.replace(tmp_pth, self.checkpoint_pth)
+
+    def recover(self):
+
+        stat = os.stat(self.matrix_pth)
+        if self.checkpoint is not None and self.checkpoint["pending"] and stat.st_size >= self.checkpoint["offset"]:
+            print(f"Removing rows of an interrupted write from {self.matrix_pth}")
+            with open(self.matrix_pth, 'r+b') as file:
+                file.truncate(self.checkpoint["offset"])
+        elif self.checkpoint is None or stat.st_mtime_ns != self.checkpoint["mtime_ns"]:
+            # first run with a checkpoint or file edited by hand: the file is complete as it is
+            with open(self.matrix_pth, 'rb+') as file:
+                if file.seek(0, os.SEEK_END) > 0:
+                    file.seek(-1, os.SEEK_END)
+                    if file.read(1) not in [b'\n', b'\r']:
+                        file.write(os.linesep.encode())
+            generation = None if self.checkpoint is None else self.checkpoint["generation"] + 1
+            self.save_checkpoint(pending=False, generation=generation)
+            return
+        self.save_checkpoint(pending=False)
+
+    def read_column(self, column):
+
+        if column not in self.columns:
+            return []
+        index = self.columns.index(column)
+        with open(self.matrix_pth, 'r', newline='') as file:
+            reader = csv.reader(file)
+            next(reader)
+            return [row[index] for row in reader if len(row) > index]
+
+    def has_subject(self, subject):
+
+        return subject in self.subjects
+
+    def append(self, row):
+        """
+        :param row: dict column -> value, missing columns are left empty and unknown columns are ignored
+        """
+        for column in self.columns:
+            self.buffer[column].append(row.get(column))
+        self.subjects.add(self.csv_value(row.get("Subject")))
+
+    @staticmethod
+    def is_description(subject):
+        # rows without subject e.g. the descriptions of the QC values (written as "nan" by older versions)
+        return subject in ["", "nan"]
+
+    @staticmethod
+    def csv_value(value):
+        # empty cells for None and NaN, as written by pandas
+        if value is None or (isinstance(value, float) and value != value):
+            return ""
+        return value
+
+    def flush(self):
+
+        n_rows = len(self.buffer[self.columns[0]])
+        if n_rows == 0:
+            return
+
+        self.save_checkpoint(pending=True)
+        with open(self.matrix_pth, 'a', newline='') as file:
+            writer = self.writer(file)
+            for i in range(n_rows):
+                writer.writerow([self.csv_value(self.buffer[column][i]) for column in self.columns])
+            file.flush()
+            os.fsync(file.fileno())
+        self.save_checkpoint(pending=False)
+        self.buffer_init()
+
+    def compact(self, order=()):
+        """
+        Rewrite the csv without the rows superseded by a rerun of the same subject (only if there are some, or if the
+        rows are not in order).
+        :param order: subjects whose rows are sorted in this order, within the positions they hold (e.g. the cases of
+        a parallel run, appended as they completed)
+        """
+        self.flush()
+
+        index = self.columns.index("Subject")
+        with open(self.matrix_pth, 'r', newline='') as file:
+            rows = list(csv.reader(file))[1:]
+
+        last_row = {row[index]: i for i, row in enumerate(rows) if not self.is_description(row[index])}
+        kept_rows = [row for i, row in enumerate(rows) if self.is_description(row[index]) or last_row[row[index]] == i]
+
+        rank = {subject: i for i, subject in enumerate(order)}
+        positions = [i for i, row in enumerate(kept_rows) if row[index] in rank and not self.is_description(row[index])]
+        ordered_rows = sorted((kept_rows[i] for i in positions), key=lambda row: rank[row[index]])
+        for i, row in zip(positions, ordered_rows):
+            kept_rows[i] = row
+        if kept_rows == rows:
+            return
+
+        tmp_pth = self.matrix_pth + ".tmp"
+        with open(tmp_pth, 'w', newline='') as file:
+            writer = self.writer(file)
+            writer.writerow(self.columns)
+            writer.writerows(kept_rows)
+        os.replace(tmp_pth, self.matrix_pth)
+        self.save_checkpoint(pending=False, generation=self.checkpoint["generation"] + 1)
+
+    def merge(self, source_pths):
+        """
+        Append the rows of other QC matrices (e.g. the batches of a site into df_qc_all), only reading what was
+        appended to each source since the last merge. A source rewritten since (compacted or edited by hand) is read
+        again entirely, its rows then supersede the ones merged before at the next compact().
+        Columns of the sources which are not in this matrix are ignored.
+        :param source_pths: csv paths of the QC matrices to merge
+        """
+        merged_pth = self.matrix_pth.replace(".csv", "_merged_sources.json")
+        try:
+            with open(merged_pth, 'r') as file:
+                merged = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            merged = {}
+
+        for source_pth in source_pths:
+            # the source may be written by a running batch: only read up to its last complete flush
+            checkpoint = self.read_checkpoint(source_pth.replace(".csv", "_checkpoint.json"))
+            stat = os.stat(source_pth)
+            end, version = stat.st_size, None
+            if checkpoint is not None and (checkpoint["pending"] or checkpoint["mtime_ns"] == stat.st_mtime_ns):
+                end, version = checkpoint["offset"], checkpoint["generation"]
+
+            previous = merged.get(source_pth)
+            offset = 0
+            if previous is not None and version is not None and previous["generation"] == version:
+                offset = previous["offset"]
+
+            with open(source_pth, 'rb') as file:
+                header = next(csv.reader([file.readline().decode()]))
+                offset = max(offset, file.tell())
+                file.seek(offset)
+                data = file.read(max(end - offset, 0)).decode()
+
+            for values in csv.reader(io.StringIO(data, newline='')):
+                row = dict(zip(header, values))
+                # the description rows of every batch are the same, only keep the first one
+                if self.is_description(row.get("Subject", "")) and any(map(self.is_description, self.subjects)):
+                    continue
+                self.append(row)
+
+            merged[source_pth] = {"offset": end, "generation": version}
+
+        self.flush()
+        with open(merged_pth, 'w') as file:
+            json.dump(merged, file, indent=4)
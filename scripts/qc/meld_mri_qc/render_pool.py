@@ -0,0 +1,126 @@
+import os
+import threading
+import multiprocessing
+from multiprocessing import util
+import traceback
+import matplotlib
+from concurrent.futures import ProcessPoolExecutor
+from displaymod import DisplayModalities
+from stage_profile import StageProfiler, profiled
+
+
+# display helper of a render worker process, see _init_render_worker
+_display_helper = None
+
+
+def _init_render_worker(fast_render, png_width, overlay_contours, profile_settings):
+    global _display_helper
+    matplotlib.use("Agg")  # the workers never open a window
+    _display_helper = DisplayModalities(fast_render, png_width, overlay_contours)
+    # the stages rendered here are profiled here, as they would be in the submitting process
+    if profile_settings is not None:
+        StageProfiler.configure(*profile_settings)
+
+
+@profiled("qc_imgs", lambda name, kwargs: (os.path.dirname(kwargs["save_name"]), name))
+def _render_image(name, kwargs):
+
+    _display_helper.display_image_sag_coron(**kwargs)
+
+
+@profiled("overlay_qc", lambda name, kwargs: (os.path.dirname(kwargs["save_name"]), name))
+def _render_overlay(name, kwargs):
+
+    _display_helper.display_overlay_sag_coron(**kwargs)
+
+
+def _render(kind, name, kwargs):
+    # (save_name, error) of one job, the traceback is returned as text so that a failed image does not stop the pool
+    try:
+        if kind == "image":
+            _render_image(name, kwargs)
+        else:
+            _render_overlay(name, kwargs)
+        return kwargs["save_name"], None
+    except Exception:
+        return kwargs["save_name"], traceback.format_exc()
+
+
+class RenderPool:
+
+    """
+    QC images rendered by a pool of worker processes (matplotlib Agg backend in each), so that the stages of the cases
+    do not wait for them: a job is the volume(s) to draw and the PNG to write, submitted per case.
+
+    A case waits for its images (wait) before it is recorded as complete. The workers read the volumes themselves,
+    the VolumeCache of the case is not shared with them. The qc_imgs and overlay_qc profiles (see StageProfiler) are
+    written by the workers, with the profiler settings of the submitting process.
+
+    The cases of a process (worker threads) share one pool, shut down when the process exits: a worker process of
+    the parallel mode would otherwise wait forever for its idle render processes.
+    """
+
+    # pool of the process, see shared()
+    instance = None
+    instance_lock = threading.Lock()
+
+    def __init__(self, workers, fast_render=True, png_width=2400, overlay_contours=False, profile_settings=None):
+        """
+        :param workers: number of render processes (started at the first job)
+        :param profile_settings: StageProfiler.configure arguments of the workers (StageProfiler.settings()), None if
+        the submitting process profiles nothing (the workers then only follow the MELD_QC_PROFILE variables, as it does)
+        """
+        self.workers = workers
+        # spawned, not forked: jobs are submitted from stage threads, a fork could copy locks held by the other threads
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=_init_render_worker,
+                                            initargs=(fast_render, png_width, overlay_contours, profile_settings))
+        self.lock = threading.Lock()
+        self.pending = {}  # case -> futures of its jobs
+        self.pid = os.getpid()
+        # run at the exit of a multiprocessing worker too, before it joins its child processes, and before the
+        # finalizers of the pool queues (exitpriority 10) close them, so that the render processes are told to stop
+        util.Finalize(None, self.shutdown, exitpriority=100)
+
+    @classmethod
+    def shared(cls, workers, fast_render=True, png_width=2400, overlay_contours=False, profile_settings=None):
+        """
+        Pool of the current process (created on first use, and again in a forked worker process).
+        """
+        with cls.instance_lock:
+            if cls.instance is None or cls.instance.pid != os.getpid():
+                cls.instance = cls(workers, fast_render, png_width, overlay_contours, profile_settings)
+            return cls.instance
+
+    def submit(self, case, kind, name, **kwargs):
+        """
+        :param case: case the image belongs to
+        :param kind: "image" (display_image_sag_coron) or "overlay" (display_overlay_sag_coron)
+        :param name: prefix of the profiles of the job e.g. <case>_<modality>
+        :param kwargs: arguments of the display method, save_name included
+        """
+        future = self.executor.submit(_render, kind, name, kwargs)
+        with self.lock:
+            self.pending.setdefault(case, []).append(future)
+        return future
+
+    def wait(self, case):
+        """
+        Wait for the images of a case.
+        :return: PNGs which could not be rendered
+        """
+        with self.lock:
+            futures = self.pending.pop(case, [])
+
+        failed = []
+        for future in futures:
+            save_name, error = future.result()
+            if error is not None:
+                print(f"QC IMAGE FAILED: {save_name}")
+                print(error)
+                failed.append(save_name)
+        return failed
+
+    def shutdown(self):
+
+        self.executor.shutdown(wait=True)
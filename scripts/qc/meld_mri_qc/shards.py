@@ -0,0 +1,35 @@
+import hashlib
+
+
+def parse_shard(shard):
+    """
+    :param shard: "i/N", shard i (1 to N) of N e.g. "3/8" for the array job 3 of 8
+    :return: (i, N)
+    """
+    try:
+        index, count = (int(value) for value in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard {shard} is not of the form i/N")
+    if not 1 <= index <= count:
+        raise ValueError(f"Shard {shard}: i must be between 1 and N")
+    return index, count
+
+
+def case_shard(case, count):
+    # stable across runs, machines and python versions (unlike hash()), independent of the other cases of the list
+    return int(hashlib.sha1(case.encode()).hexdigest(), 16) % count + 1
+
+
+def in_shard(case, shard):
+
+    index, count = parse_shard(shard)
+    return case_shard(case, count) == index
+
+
+def shard_name(name, shard):
+    # per-shard file name e.g. df_qc_hs.csv -> df_qc_hs_shard3of8.csv, unchanged without shard
+    if shard is None:
+        return name
+    index, count = parse_shard(shard)
+    stem, dot, extension = name.rpartition(".")
+    return f"{stem}_shard{index}of{count}{dot}{extension}"
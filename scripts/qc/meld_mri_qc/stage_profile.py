@@ -0,0 +1,150 @@
+import os
+import cProfile
+import functools
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+
+# stages which can be profiled (functions decorated with profiled)
+PROFILED_STAGES = ["qc_imgs", "overlay_qc", "dice_calc", "fill_3d"]
+
+PROFILE_MODES = ["cprofile", "tracemalloc", "both"]
+
+
+class StageProfiler:
+
+    """
+    Opt-in cProfile and/or tracemalloc around chosen stages, for every case.
+
+    A profiled stage writes next to its outputs:
+    1) <name>__<stage>.prof (cProfile), to be merged across cases with merge_profiles.py
+    2) <name>__<stage>_alloc.txt (tracemalloc): peak traced memory of the stage and the top_n allocation sites still
+       holding memory at its end
+
+    cProfile and tracemalloc are process-wide, profiled stages of concurrent cases or modalities of a process take
+    turns (the other stages keep running concurrently).
+
+    The profiler of a process is set from the Config (DirectoryRegistration) or, for standalone scripts and if it was
+    not configured, from the environment:
+    MELD_QC_PROFILE=qc_imgs,dice_calc (or all), MELD_QC_PROFILE_MODE=cprofile|tracemalloc|both, MELD_QC_PROFILE_TOP=25,
+    MELD_QC_PROFILE_DIR=<folder> to write every profile there instead of next to the outputs.
+    """
+
+    # profiler of the process, see shared()
+    instance = None
+    configured = False
+    lock = threading.Lock()
+
+    def __init__(self, stages, mode="cprofile", top_n=25, profile_dir=None):
+        """
+        :param stages: names of the stages to profile (see PROFILED_STAGES), or ["all"]
+        :param mode: "cprofile", "tracemalloc" or "both"
+        :param top_n: number of allocation sites in the tracemalloc reports
+        :param profile_dir: folder of every profile, None to write them next to the outputs of the stages
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode {mode}, expected one of {PROFILE_MODES}")
+        unknown = set(stages) - set(PROFILED_STAGES + ["all"])
+        if unknown:
+            raise ValueError(f"Unknown profiled stages {sorted(unknown)}, expected some of {PROFILED_STAGES}")
+
+        self.stages = set(PROFILED_STAGES) if "all" in stages else set(stages)
+        self.mode = mode
+        self.top_n = top_n
+        self.profile_dir = profile_dir
+
+    @classmethod
+    def configure(cls, stages, mode="cprofile", top_n=25, profile_dir=None):
+        """
+        Set the profiler of the process, no profiling if stages is empty.
+        """
+        cls.instance = cls(stages, mode, top_n, profile_dir) if stages else None
+        cls.configured = True
+
+    @classmethod
+    def shared(cls):
+
+        if not cls.configured:
+            stages = [stage for stage in os.environ.get("MELD_QC_PROFILE", "").split(",") if stage]
+            cls.configure(stages, os.environ.get("MELD_QC_PROFILE_MODE", "cprofile"),
+                          int(os.environ.get("MELD_QC_PROFILE_TOP", "25")), os.environ.get("MELD_QC_PROFILE_DIR"))
+        return cls.instance
+
+    @classmethod
+    def settings(cls):
+        # configure() arguments of the profiler of the process, to set up another process alike (e.g. render workers),
+        # None if the process profiles nothing
+        profiler = cls.shared()
+        if profiler is None:
+            return None
+        return sorted(profiler.stages), profiler.mode, profiler.top_n, profiler.profile_dir
+
+    def enabled(self, stage):
+
+        return stage in self.stages
+
+    def write_alloc_report(self, pth, stage, snapshot, peak):
+
+        statistics = snapshot.statistics("lineno")
+        with open(pth, 'w') as file:
+            file.write(f"Stage: {stage}\n")
+            file.write(f"Peak traced memory: {peak / 2 ** 20:.1f} MB\n")
+            file.write(f"Top {self.top_n} allocation sites still holding memory at the end of the stage:\n")
+            for statistic in statistics[:self.top_n]:
+                file.write(f"{statistic}\n")
+
+    @contextmanager
+    def profile(self, stage, save_dir, name):
+        """
+        :param stage: stage name e.g. "dice_calc"
+        :param save_dir: folder of the outputs of the stage (ignored if profile_dir is set)
+        :param name: prefix of the profile files e.g. the case
+        """
+        save_dir = self.profile_dir if self.profile_dir is not None else save_dir
+        os.makedirs(save_dir, exist_ok=True)
+        prefix = os.path.join(save_dir, f"{name}__{stage}")
+
+        with self.lock:
+            profile = cProfile.Profile() if self.mode in ["cprofile", "both"] else None
+            # a tracemalloc started by the user is left running
+            trace_memory = self.mode in ["tracemalloc", "both"]
+            was_tracing = tracemalloc.is_tracing()
+            if trace_memory:
+                if not was_tracing:
+                    tracemalloc.start()
+                tracemalloc.reset_peak()
+            if profile is not None:
+                profile.enable()
+            try:
+                yield
+            finally:
+                if profile is not None:
+                    profile.disable()
+                    profile.dump_stats(prefix + ".prof")
+                if trace_memory:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    self.write_alloc_report(prefix + "_alloc.txt", stage, tracemalloc.take_snapshot(), peak)
+                    if not was_tracing:
+                        tracemalloc.stop()
+
+
+def profiled(stage, where):
+    """
+    Profile the decorated method as stage when the profiler of the process is enabled for it.
+    :param stage: stage name, one of PROFILED_STAGES
+    :param where: function of the arguments of the method (self included) -> (save_dir, name) of the profiles
+    """
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = StageProfiler.shared()
+            if profiler is None or not profiler.enabled(stage):
+                return func(*args, **kwargs)
+            with profiler.profile(stage, *where(*args, **kwargs)):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,109 @@
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class StageScheduler:
+
+    """
+    Runs the stages of one case as a dependency graph.
+
+    A stage is a function which returns False on failure (like the SynthSegRegistration methods).
+    It runs once all of its dependencies have succeeded and is skipped if one of them failed.
+    Ready stages run concurrently in threads (the heavy work is done in FreeSurfer subprocesses), in the order they
+    were added, as long as the sum of their cpu and memory requirements fits the budget of the case.
+    With a StageTrace, every stage run is recorded as a trace event (stage "easyreg[FLAIR]" as stage easyreg of
+    modality FLAIR).
+    """
+
+    def __init__(self, cpus, memory_gb, trace=None, case=None):
+        """
+        :param cpus: number of cpus available to the stages of the case
+        :param memory_gb: memory (GB) available to the stages of the case
+        :param trace: StageTrace of the run, None to not trace the stages
+        :param case: case of the stages, for the trace
+        """
+        self.cpus = cpus
+        self.memory_gb = memory_gb
+        self.trace = trace
+        self.case = case
+
+        self.stages = {}  # name -> stage, in insertion order
+        self.status = {}  # name -> "done", "failed" or "skipped"
+        self.results = {}  # name -> value returned by the stage
+
+    def add(self, name, func, deps=(), cpus=1, memory_gb=0):
+        """
+        :param name: unique stage name e.g. "easyreg[FLAIR]"
+        :param func: function without arguments, returning False on failure
+        :param deps: names of the stages that must succeed first
+        :param cpus: cpus reserved while the stage runs
+        :param memory_gb: memory (GB) reserved while the stage runs
+        :return: the stage name, to be used in the deps of later stages
+        """
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"Unknown dependency {dep} for stage {name}")
+
+        # requirements are capped to the budget so that every stage can run on its own
+        self.stages[name] = {"func": func, "deps": list(deps),
+                             "cpus": min(cpus, self.cpus), "memory_gb": min(memory_gb, self.memory_gb)}
+        return name
+
+    def traced(self, name):
+
+        if self.trace is None:
+            return nullcontext({})
+        stage, _, modality = name.partition("[")
+        return self.trace.stage(self.case, stage, modality.rstrip("]") or None)
+
+    def run_stage(self, name):
+
+        with self.traced(name) as record:
+            try:
+                result = self.stages[name]["func"]()
+            except Exception as e:
+                print(f'STAGE FAILED: {name} with error {e}')
+                result = False
+            record["ok"] = result is not False
+        return result
+
+    def run(self):
+        """
+        Run all stages.
+        :return: True if every stage succeeded
+        """
+        pending = list(self.stages)
+        running = {}
+        used_cpus = 0
+        used_memory_gb = 0
+
+        with ThreadPoolExecutor(max_workers=max(len(self.stages), 1)) as executor:
+            while pending or running:
+
+                for name in list(pending):
+                    stage = self.stages[name]
+                    if any(self.status.get(dep) in ["failed", "skipped"] for dep in stage["deps"]):
+                        self.status[name] = "skipped"
+                        pending.remove(name)
+
+                    elif (all(self.status.get(dep) == "done" for dep in stage["deps"])
+                          and used_cpus + stage["cpus"] <= self.cpus
+                          and used_memory_gb + stage["memory_gb"] <= self.memory_gb):
+                        running[executor.submit(self.run_stage, name)] = name
+                        used_cpus += stage["cpus"]
+                        used_memory_gb += stage["memory_gb"]
+                        pending.remove(name)
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    used_cpus -= self.stages[name]["cpus"]
+                    used_memory_gb -= self.stages[name]["memory_gb"]
+
+                    self.results[name] = future.result()
+                    self.status[name] = "failed" if self.results[name] is False else "done"
+
+        return all(status == "done" for status in self.status.values())
@@ -0,0 +1,180 @@
+import os
+import re
+import sys
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+
+# record of the stage running in the current thread, for annotate()
+_current = threading.local()
+
+
+def case_site(case):
+    # sub-MELDH16P0101 -> H16
+    match = re.match(r"sub-MELD(H\d+)", case)
+    return match.group(1) if match is not None else "unknown"
+
+
+def _read_proc(pth):
+
+    try:
+        with open(pth, 'r') as file:
+            return file.read()
+    except OSError:
+        return None
+
+
+def _children(pid):
+    # child processes of every thread of pid, recursively (e.g. mri_synthseg -> fspython)
+    pids = []
+    try:
+        tids = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return pids
+    for tid in tids:
+        content = _read_proc(f"/proc/{pid}/task/{tid}/children")
+        for child in (content or "").split():
+            pids.append(int(child))
+            pids += _children(int(child))
+    return pids
+
+
+def _rss_bytes(pid):
+
+    content = _read_proc(f"/proc/{pid}/statm")
+    return int(content.split()[1]) * os.sysconf("SC_PAGE_SIZE") if content else 0
+
+
+def _io_bytes(pid):
+    # (read_bytes, write_bytes) actually read from and written to storage
+    content = _read_proc(f"/proc/{pid}/io")
+    if not content:
+        return 0, 0
+    fields = dict(line.split(": ") for line in content.splitlines())
+    return int(fields["read_bytes"]), int(fields["write_bytes"])
+
+
+class StageTrace:
+
+    """
+    Per-stage trace events of the cases, appended as json lines (one event per stage) to trace_pth.
+
+    An event has the case, site, modality, stage, start (epoch seconds), duration, exit code (of the FreeSurfer tool
+    if one ran, otherwise 0 or 1), peak RSS (MB) of the process and its tool subprocesses, and the bytes read from and
+    written to storage by the process during the stage (tool subprocesses included once they exit: the kernel adds
+    the io of a reaped child to its parent).
+    RSS is sampled from /proc every sample_interval seconds while stages run, io is read at the start and end of the
+    stage: stages running at the same time in a process (modalities of a case, cases in threads) share the samples of
+    the process. Without /proc (not Linux) the peak RSS is the high-water mark of the process and io is not recorded.
+
+    Every process of a run (workers included) appends to the same file, one write per event.
+    """
+
+    def __init__(self, trace_pth, sample_interval=0.2):
+
+        self.trace_pth = trace_pth
+        self.sample_interval = sample_interval
+        self.has_proc = os.path.exists(f"/proc/{os.getpid()}/io")
+
+        self.lock = threading.Lock()
+        self.active = {}  # id -> record of the stages running in this process
+        self.sampler = None
+
+    def sample(self):
+        # rss of the process tree, into every running stage
+        pid = os.getpid()
+        rss = sum(_rss_bytes(child) for child in [pid] + _children(pid))
+        with self.lock:
+            for record in self.active.values():
+                record["_peak_rss"] = max(record["_peak_rss"], rss)
+
+    def sample_loop(self):
+
+        while True:
+            with self.lock:
+                if not self.active:
+                    self.sampler = None
+                    return
+            self.sample()
+            time.sleep(self.sample_interval)
+
+    def start_sampler(self):
+
+        with self.lock:
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self.sample_loop, name="stage-trace", daemon=True)
+                self.sampler.start()
+
+    @contextmanager
+    def stage(self, case, stage, modality=None):
+        """
+        Trace a stage: record["ok"] = False marks it failed, tools run within it can annotate() the record.
+        :param case: BIDS case name
+        :param stage: stage name e.g. "easyreg"
+        :param modality: e.g. "FLAIR", None for stages of the whole case
+        """
+        record = {"case": case, "site": case_site(case), "modality": modality, "stage": stage,
+                  "start": time.time(), "exit_code": None, "pid": os.getpid(),
+                  "_peak_rss": 0, "_io": _io_bytes("self") if self.has_proc else (0, 0)}
+        start_time = time.perf_counter()
+        previous = getattr(_current, "record", None)
+        _current.record = record
+        if self.has_proc:
+            with self.lock:
+                self.active[id(record)] = record
+            self.sample()
+            self.start_sampler()
+        try:
+            yield record
+        except BaseException:
+            record["ok"] = False
+            raise
+        finally:
+            _current.record = previous
+            record["duration"] = time.perf_counter() - start_time
+            if self.has_proc:
+                self.sample()
+                with self.lock:
+                    del self.active[id(record)]
+            self.write(record)
+
+    @staticmethod
+    def annotate(**fields):
+        """
+        Add fields (e.g. exit_code of a tool) to the record of the stage running in the current thread, if any.
+        """
+        record = getattr(_current, "record", None)
+        if record is not None:
+            record.update(fields)
+
+    def write(self, record):
+
+        ok = record.pop("ok", True)
+        if record["exit_code"] is None or (record["exit_code"] == 0 and not ok):
+            record["exit_code"] = 0 if ok else 1
+
+        peak_rss = record.pop("_peak_rss")
+        io_start = record.pop("_io")
+        if self.has_proc:
+            io_end = _io_bytes("self")
+            record["peak_rss_mb"] = round(peak_rss / 2 ** 20, 1)
+            record["read_bytes"] = io_end[0] - io_start[0]
+            record["write_bytes"] = io_end[1] - io_start[1]
+        else:
+            usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+            record["peak_rss_mb"] = round(usage / (2 ** 20 if sys.platform == "darwin" else 2 ** 10), 1)
+            record["read_bytes"] = None
+            record["write_bytes"] = None
+        record["duration"] = round(record["duration"], 4)
+
+        # one write per line, the processes of a run append to the same file
+        line = (json.dumps(record) + "\n").encode()
+        fd = os.open(self.trace_pth, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
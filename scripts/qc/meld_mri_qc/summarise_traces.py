@@ -0,0 +1,84 @@
+import json
+import argparse
+import pandas as pd
+
+
+def read_traces(trace_pths):
+
+    events = []
+    for trace_pth in trace_pths:
+        with open(trace_pth, 'r') as file:
+            # the last line may be incomplete if the run is still going
+            for line in file:
+                try:
+                    events.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return pd.DataFrame(events)
+
+
+def summarise(events, by_modality=False):
+    """
+    :param events: DataFrame of trace events (see StageTrace)
+    :param by_modality: one row per modality of each stage instead of per stage
+    :return: DataFrame per site and stage: runs, failures, total hours, duration percentiles (s), peak RSS (MB) and
+    median io (MB)
+    """
+    keys = ["site", "stage"] + (["modality"] if by_modality else [])
+    events = events.copy()
+    events["modality"] = events["modality"].fillna("")
+    events["failed"] = events["exit_code"] != 0
+    events["read_mb"] = events["read_bytes"] / 2 ** 20
+    events["write_mb"] = events["write_bytes"] / 2 ** 20
+
+    groups = events.groupby(keys)
+    summary = pd.DataFrame({"runs": groups.size(),
+                            "failed": groups["failed"].sum(),
+                            "total_hours": groups["duration"].sum() / 3600.})
+    for q in [0.5, 0.9, 0.99]:
+        summary[f"p{int(q * 100)}_s"] = groups["duration"].quantile(q)
+    summary["max_s"] = groups["duration"].max()
+    summary["peak_rss_mb"] = groups["peak_rss_mb"].max()
+    summary["median_read_mb"] = groups["read_mb"].median()
+    summary["median_write_mb"] = groups["write_mb"].median()
+
+    # the case stage covers the others, it is not part of the share of time
+    stage_hours = summary["total_hours"].where(summary.index.get_level_values("stage") != "case", 0.)
+    summary["share"] = stage_hours / stage_hours.groupby(level="site").transform("sum")
+
+    return summary.round(3).sort_values(["site", "total_hours"], ascending=[True, False])
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Per-stage duration percentiles of the MRI QC runs, per site, from "
+                                                 "the stage traces (e.g. df_qc_hs_trace.jsonl)")
+    parser.add_argument("traces",
+                        help="trace files (json lines) of one or several runs and sites",
+                        nargs="+",
+                        )
+    parser.add_argument("--modality",
+                        help="one row per modality of each stage",
+                        action="store_true",
+                        )
+    parser.add_argument("-o", "--output",
+                        help="csv of the summary",
+                        default=None,
+                        )
+    args = parser.parse_args()
+
+    events = read_traces(args.traces)
+    if events.empty:
+        print("No trace events found")
+        return
+
+    summary = summarise(events, args.modality)
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 250):
+        print(summary)
+    if args.output is not None:
+        summary.to_csv(args.output)
+        print(f"Summary saved at {args.output}")
+
+
+if __name__ == "__main__":
+    main()
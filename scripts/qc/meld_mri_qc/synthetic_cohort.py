@@ -0,0 +1,234 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+
+# size (voxels), spacing (mm) and tissue intensities (csf, grey matter, white matter, scalp, lesion) of every modality
+MODALITIES = {"preop_T1w": {"field": "3T", "folder": "anat", "size": (176, 256, 256), "spacing": (1., 1., 1.),
+                            "intensities": (300, 600, 1000, 800, 500), "sidecar": {"RepetitionTime": 2.3,
+                                                                                  "EchoTime": 0.00296}},
+              "preop_FLAIR": {"field": "3T", "folder": "anat", "size": (160, 256, 256), "spacing": (1.1, 1., 1.),
+                              "intensities": (100, 900, 600, 500, 1400), "sidecar": {"RepetitionTime": 5.0,
+                                                                                    "EchoTime": 0.395}},
+              "preop_T2w": {"field": "3T", "folder": "anat", "size": (176, 256, 256), "spacing": (1., 1., 1.),
+                            "intensities": (1500, 800, 500, 700, 1100), "sidecar": {"RepetitionTime": 3.2,
+                                                                                   "EchoTime": 0.408}},
+              "postop_T1w": {"field": "15T", "folder": "anat", "size": (160, 240, 240), "spacing": (1.2, 1.05, 1.05),
+                             "intensities": (300, 600, 1000, 800, 300), "sidecar": {"RepetitionTime": 2.4,
+                                                                                   "EchoTime": 0.0035}},
+              "preop_DWI": {"field": "3T", "folder": "dwi", "size": (96, 96, 60), "spacing": (2.5, 2.5, 2.5),
+                            "intensities": (1200, 700, 600, 200, 900), "sidecar": {"RepetitionTime": 8.4,
+                                                                                  "EchoTime": 0.089}}}
+
+
+class SyntheticCohort:
+
+    """
+    Synthetic MELD BIDS cohort, to run and benchmark the QC pipeline without patient data.
+
+    Every image is sampled from the same analytic head (scalp, cortex, white matter, ventricles and a lesion for the
+    patients) in world coordinates, on its own grid: size, spacing and a small rotation and shift per modality, as
+    acquisitions of the same subject. The cohort folder has the layout of a converted site:
+    <bids_folder>/sub-MELD<site><P|C><number>/{anat,dwi}/<case>_<field>_<modality>.nii.gz (and .json sidecars), the
+    lesion masks of the patients and <folder name>_participants_info.csv.
+    """
+
+    def __init__(self, bids_folder, site="H99", scale=1., dwi_volumes=33, seed=0):
+        """
+        :param bids_folder: folder of the cohort e.g. ./MELD_H99
+        :param site: site code of the subject ids
+        :param scale: image sizes are multiplied by scale (and spacings divided), e.g. 0.5 for quicker runs
+        :param dwi_volumes: number of volumes of the DWI (1 writes a 3D image)
+        :param seed: random seed of the subjects
+        """
+        self.bids_folder = bids_folder
+        self.site = site
+        self.scale = scale
+        self.dwi_volumes = dwi_volumes
+        self.rng = np.random.default_rng(seed)
+
+    def subject_id(self, number, patient):
+        # MELD_H99_P_0001, as in the participants csv (sub-MELDH99P0001 in the BIDS folder)
+        return f"MELD_{self.site}_{'P' if patient else 'C'}_{number:04d}"
+
+    @staticmethod
+    def bids_case(subject_id):
+
+        return "sub-" + subject_id.replace("_", "")
+
+    def grid(self, modality):
+        # grid of a modality centred on the head, slightly rotated and shifted as in a separate acquisition
+        size = [max(int(round(n * self.scale)), 8) for n in MODALITIES[modality]["size"]]
+        spacing = [s * n / m for s, n, m in zip(MODALITIES[modality]["spacing"], MODALITIES[modality]["size"], size)]
+
+        angles = self.rng.normal(0., 0.05, 3)
+        transform = sitk.Euler3DTransform((0., 0., 0.), *angles)
+        direction = np.array(transform.GetMatrix()).reshape(3, 3)
+        origin = -direction @ (np.array(size) * np.array(spacing) / 2.) + self.rng.normal(0., 2., 3)
+
+        image = sitk.Image(size, sitk.sitkInt16)
+        image.SetSpacing(spacing)
+        image.SetDirection(direction.ravel().tolist())
+        image.SetOrigin(origin.tolist())
+        return image
+
+    @staticmethod
+    def world_points(image):
+        # LPS point (mm) of every voxel, (z, y, x, 3)
+        size = image.GetSize()
+        matrix = np.array(image.GetDirection()).reshape(3, 3) * np.array(image.GetSpacing())
+        axes = [np.arange(n, dtype=np.float32) for n in size]
+        points = np.empty((size[2], size[1], size[0], 3), dtype=np.float32)
+        for i in range(3):
+            points[..., i] = (matrix[i, 0] * axes[0][None, None, :] + matrix[i, 1] * axes[1][None, :, None]
+                              + matrix[i, 2] * axes[2][:, None, None] + image.GetOrigin()[i])
+        return points
+
+    @staticmethod
+    def tissues(points, lesion):
+        """
+        :param points: LPS points (mm)
+        :param lesion: (centre, radius) of the lesion or None
+        :return: label array: 0 background, 1 csf, 2 grey matter, 3 white matter, 4 scalp, 5 lesion
+        """
+        x, y, z = points[..., 0], points[..., 1], points[..., 2]
+        head = np.sqrt((x / 75.) ** 2 + (y / 95.) ** 2 + (z / 80.) ** 2)
+        # folded cortex: the white matter surface oscillates
+        folds = 0.04 * np.sin(x / 4.) * np.sin(y / 5.) * np.sin(z / 4.5)
+
+        labels = np.zeros(head.shape, dtype=np.uint8)
+        labels[head < 1.] = 4
+        labels[head < 0.9] = 1
+        labels[head < 0.86] = 2
+        labels[head < 0.7 + folds] = 3
+        ventricles = np.sqrt(((np.abs(x) - 12.) / 7.) ** 2 + (y / 30.) ** 2 + ((z - 10.) / 12.) ** 2) < 1.
+        labels[ventricles] = 1
+        if lesion is not None:
+            centre, radius = lesion
+            labels[np.sum((points - np.array(centre, dtype=np.float32)) ** 2, axis=-1) < radius ** 2] = 5
+        return labels
+
+    def image(self, modality, lesion):
+
+        grid = self.grid(modality)
+        labels = self.tissues(self.world_points(grid), lesion)
+        intensities = np.array((0,) + MODALITIES[modality]["intensities"], dtype=np.float32)
+        array = intensities[labels]
+        array += self.rng.normal(0., 0.03 * intensities.max(), array.shape).astype(np.float32)
+        array = np.clip(array, 0, None).astype(np.int16)
+
+        if modality == "preop_DWI" and self.dwi_volumes > 1:
+            # b0 followed by diffusion weighted volumes, attenuated
+            volumes = [array] + [(array * self.rng.uniform(0.3, 0.6)).astype(np.int16)
+                                 for _ in range(self.dwi_volumes - 1)]
+            image = sitk.JoinSeries([self.array_image(volume, grid) for volume in volumes])
+        else:
+            image = self.array_image(array, grid)
+        return image, grid, labels
+
+    @staticmethod
+    def array_image(array, grid):
+
+        image = sitk.GetImageFromArray(array)
+        image.CopyInformation(grid)
+        return image
+
+    def subject(self, subject_id, patient):
+        """
+        Write the images, sidecars and lesion mask of a subject.
+        :return: row of the participants csv
+        """
+        case = self.bids_case(subject_id)
+        lesion = None
+        if patient:
+            # in the cortex of one hemisphere
+            side = self.rng.choice([-1., 1.])
+            centre = np.array([45. * side, 0., 20.]) + self.rng.uniform(-1., 1., 3) * np.array([10., 40., 20.])
+            lesion = (centre.tolist(), float(self.rng.uniform(5., 12.)))
+
+        modalities = list(MODALITIES) if patient else ["preop_T1w", "preop_FLAIR", "preop_T2w", "preop_DWI"]
+        for modality in modalities:
+            folder = os.path.join(self.bids_folder, case, MODALITIES[modality]["folder"])
+            os.makedirs(folder, exist_ok=True)
+            name = f"{case}_{MODALITIES[modality]['field']}_{modality}"
+
+            # no lesion after the resection
+            image, grid, labels = self.image(modality, None if modality == "postop_T1w" else lesion)
+            sitk.WriteImage(image, os.path.join(folder, name + ".nii.gz"))
+            sidecar = {"Modality": "MR", "MagneticFieldStrength": 1.5 if MODALITIES[modality]["field"] == "15T" else 3,
+                       "Manufacturer": "Synthetic", **MODALITIES[modality]["sidecar"]}
+            with open(os.path.join(folder, name + ".json"), 'w') as file:
+                json.dump(sidecar, file, indent=4)
+
+            if modality == "preop_T1w" and lesion is not None:
+                mask_name = f"{case}_{MODALITIES[modality]['field']}_lesion_mask"
+                mask = self.array_image((labels == 5).astype(np.uint8), grid)
+                sitk.WriteImage(mask, os.path.join(folder, mask_name + ".nii.gz"))
+                with open(os.path.join(folder, mask_name + ".json"), 'w') as file:
+                    json.dump({"Description": "lesion mask in preop_T1w space"}, file, indent=4)
+
+        return {"id": subject_id, "group": "patient" if patient else "control",
+                "age_at_preop": int(self.rng.integers(3, 60)), "sex": str(self.rng.choice(["male", "female"])),
+                "field_strength": "3T", "lesion_radius_mm": None if lesion is None else round(lesion[1], 1)}
+
+    def generate(self, n_subjects, patient_fraction=0.7):
+        """
+        :param n_subjects: number of subjects
+        :param patient_fraction: fraction of patients (with a lesion mask and post-op T1), the others are controls
+        :return: participants DataFrame
+        """
+        os.makedirs(self.bids_folder, exist_ok=True)
+        n_patients = int(round(n_subjects * patient_fraction))
+        rows = []
+        for i in range(n_subjects):
+            patient = i < n_patients
+            number = i + 1 if patient else i - n_patients + 1
+            rows.append(self.subject(self.subject_id(number, patient), patient))
+            print(f"Written {self.bids_case(rows[-1]['id'])} ({i + 1}/{n_subjects})")
+
+        participants = pd.DataFrame(rows)
+        csv_name = os.path.basename(os.path.normpath(self.bids_folder)) + "_participants_info.csv"
+        participants.to_csv(os.path.join(self.bids_folder, csv_name), index=False)
+        return participants
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Write a synthetic MELD BIDS cohort (images, lesion masks, sidecars "
+                                                 "and participants csv)")
+    parser.add_argument("bids_folder",
+                        help="folder of the cohort e.g. ./MELD_H99",
+                        )
+    parser.add_argument("-n", "--subjects",
+                        help="number of subjects",
+                        type=int,
+                        default=10,
+                        )
+    parser.add_argument("--site",
+                        help="site code of the subject ids",
+                        default="H99",
+                        )
+    parser.add_argument("--scale",
+                        help="image size factor (1: realistic sizes, e.g. 0.5 for a quicker run)",
+                        type=float,
+                        default=1.,
+                        )
+    parser.add_argument("--dwi-volumes",
+                        help="number of DWI volumes (1 writes a 3D DWI)",
+                        type=int,
+                        default=33,
+                        )
+    parser.add_argument("--seed",
+                        type=int,
+                        default=0,
+                        )
+    args = parser.parse_args()
+
+    SyntheticCohort(args.bids_folder, args.site, args.scale, args.dwi_volumes, args.seed).generate(args.subjects)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,21 @@
-import subprocess
 import os
+import threading
 import numpy as np
 import SimpleITK as sitk
+from tool_runner import ToolRunner
+from dice_metrics import dice_table
+from field_warper import FieldWarper
+from volume_cache import read_image
+from stage_trace import StageTrace
+from stage_profile import profiled
 
 
 class SynthSegRegistration:
 
-    def __init__(self):
+    def __init__(self, tool_runner=None):
+
+        # FreeSurfer commands are run by the runner of the process, shared by every case and modality in flight
+        self.tool_runner = ToolRunner.shared() if tool_runner is None else tool_runner
 
         self.ref = None
         self.ref_seg = None
@@ -23,16 +32,24 @@ class SynthSegRegistration:
 
         self.synthsr_pth = None
 
-        self.flo_seg_warp = None
+        self.flo_seg_warp = None  # segmentation of the registered image
+        self.flo_seg_warped = None  # floating segmentation warped with the registration field
+
+        self.is_postop = False
 
-        self.t1_seg_exist = False
+        self.tool_threads = {}  # e.g. {"synthseg": 4}, passed to the FreeSurfer tools as --threads
 
-        self.t1_suffix = "preop_T1w_synthseg.nii.gz"  # change if needed
+        self.tool_cache = None  # ToolCache of the outputs, shared across batches and sites
 
-        self.is_postop = False
+        self.volume_cache = None  # VolumeCache of the case, images read by the dice and written by the in-process warp
+
+        # warp with the field in process (loaded once for the image, its segmentation and the mask) or mri_easywarp
+        self.warp_in_process = True
+        self.field_warper = None
+        self.field_warper_lock = threading.Lock()
 
     def set_params(self, fixed_img_pth, moving_img_pth, save_moving_img_pth,
-                   synth_save_dir, fwd_field_pth, is_postop=False):
+                   synth_save_dir, fwd_field_pth, is_postop=False, ref_seg_pth=None):
 
         self.ref = fixed_img_pth
         self.flo = moving_img_pth
@@ -45,200 +62,216 @@ class SynthSegRegistration:
 
         self.is_postop = is_postop
 
-        self.t1_seg_exist = any(fname.endswith(self.t1_suffix) for fname in os.listdir(self.synth_save_dir))
+        # the T1 segmentation can be shared between modalities saved in different folders (anat/dwi)
+        self.ref_seg = ref_seg_pth if ref_seg_pth is not None else \
+            os.path.join(self.synth_save_dir, os.path.basename(self.ref)).replace(".nii.gz", "_synthseg.nii.gz")
+
+        if self.flo is not None:
+            # example: sub-MELDH14P0013_3T_postop_T1w.nii.gz  -> sub-MELDH14P0013_3T_postop_T1w_synthsr.nii.gz
+            self.synthsr_pth = os.path.join(self.synth_save_dir,
+                                            os.path.basename(self.flo)).replace(".nii.gz", "_synthsr.nii.gz") \
+                if self.is_postop else None
+            flo_seg_input = self.synthsr_pth if self.is_postop else self.flo
+            self.flo_seg = os.path.join(self.synth_save_dir,
+                                        os.path.basename(flo_seg_input)).replace(".nii.gz", "_synthseg.nii.gz")
+            self.flo_seg_warp = os.path.join(self.synth_save_dir,
+                                             os.path.basename(self.flo)).replace(".nii.gz", "_synthseg_warp.nii.gz")
+            self.flo_seg_warped = os.path.join(self.synth_save_dir,
+                                               os.path.basename(self.flo)).replace(".nii.gz", "_synthseg_warped.nii.gz")
+        else:
+            self.synthsr_pth = None
+            self.flo_seg = None
+            self.flo_seg_warp = None
+            self.flo_seg_warped = None
+
+    def threads_flag(self, tool):
+
+        return f" --threads {self.tool_threads[tool]}" if tool in self.tool_threads else ""
+
+    def run_command(self, tool, cmnd, output_pth, batch=None, cache=None):
+        # run a FreeSurfer command unless its output already exists
+        # batch: (command, options, (input, output, resampled image)) to process the image in a batch if the tool is
+        # batched, see ToolRunner.run_batched
+        # cache: (input images, options changing the result) to take the output from the tool cache if computed before
+        if os.path.isfile(output_pth):
+            StageTrace.annotate(tool=tool, reused=True)
+            return True
+
+        key = None
+        if cache is not None and self.tool_cache is not None and self.tool_cache.enabled:
+            key = self.tool_cache.key(tool, *cache)
+            if self.tool_cache.fetch(key, output_pth):
+                StageTrace.annotate(tool=tool, cached=True)
+                return True
+
+        if batch is not None and self.tool_runner.batching(tool):
+            result = self.tool_runner.run_batched(tool, *batch)
+        else:
+            result = self.tool_runner.run(tool, cmnd.split())  # all extras saved to synth_sr_folder
+        # 124 (as timeout(1)) for a timed out command, 127 for a command which could not run
+        StageTrace.annotate(tool=tool, tool_seconds=round(result["duration"], 3),
+                            exit_code=result["returncode"] if result["returncode"] is not None else
+                            124 if result["timed_out"] else 127)
+        if result["returncode"] != 0 or not os.path.isfile(output_pth):
+            reason = "timed out" if result["timed_out"] else f"return code {result['returncode']}"
+            print(f'COMMAND FAILED ({reason}): {result["cmd"]}')
+            print('\n'.join(result["output"].splitlines()[-20:]))
+            # a partial output would be reused by the "file exists" check of the next run
+            if os.path.isfile(output_pth):
+                os.remove(output_pth)
+            return False
+
+        if key is not None:
+            self.tool_cache.store(key, output_pth, result["cmd"])
+        return True
 
     def synthsr(self):
-        
-        self.synthsr_pth = os.path.join(self.synth_save_dir,
-                                        os.path.basename(self.flo)).replace(".nii.gz", "_synthsr.nii.gz")
-        if not os.path.isfile(self.synthsr_pth):
-            cmnd = f"mri_synthsr --i {self.flo} --o {self.synth_save_dir}"
-            try:
-                subprocess.run(cmnd.split())  # all extras saved to synth_sr_folder
-            except OSError as e:
-                print(f'COMMAND FAILED: {cmnd} with error {e}')
-                return False
 
-        #check that is has been created and return false if not
-        if not os.path.isfile(self.synthsr_pth):
-            print(f'COMMAND FAILED: {cmnd}')
+        cmnd = f"mri_synthsr --i {self.flo} --o {self.synth_save_dir}" + self.threads_flag("synthsr")
+        batch = ("mri_synthsr", self.threads_flag("synthsr").split(), (self.flo, self.synthsr_pth, None))
+        return self.run_command("synthsr", cmnd, self.synthsr_pth, batch, ([self.flo], []))
+
+    def segment(self, input_img, seg_pth):
+
+        seg_dir = os.path.dirname(seg_pth)
+        cmnd = f"mri_synthseg --i {input_img} --o {seg_dir} --parc --robust --resample {seg_dir}" + \
+            self.threads_flag("synthseg")
+        # in a batch the paths are listed explicitly, with the names mri_synthseg gives in a folder
+        resample_pth = os.path.join(seg_dir, os.path.basename(input_img).replace(".nii.gz", "_resampled.nii.gz"))
+        batch = ("mri_synthseg", ["--parc", "--robust"] + self.threads_flag("synthseg").split(),
+                 (input_img, seg_pth, resample_pth))
+        return self.run_command("synthseg", cmnd, seg_pth, batch, ([input_img], ["--parc", "--robust"]))
+
+    def ref_synthseg(self):
+
+        return self.segment(self.ref, self.ref_seg)
+
+    def flo_synthseg(self):
+
+        return self.segment(self.synthsr_pth if self.is_postop else self.flo, self.flo_seg)
+
+    def synthseg(self):
+
+        output = self.ref_synthseg()
+        if output==False:
             return False
-            
-        return True
-        # example: sub-MELDH14P0013_3T_postop_T1w.nii.gz  -> sub-MELDH14P0013_3T_postop_T1w_synthsr.nii.gz
-
-    def synthseg(self, input_flo_img):
-        self.ref_seg = os.path.join(self.synth_save_dir,
-                                        os.path.basename(self.ref)).replace(".nii.gz", "_synthseg.nii.gz")
-        self.flo_seg = os.path.join(self.synth_save_dir,
-                                        os.path.basename(input_flo_img)).replace(".nii.gz", "_synthseg.nii.gz")
-
-        if not self.t1_seg_exist:
-            if not os.path.isfile(self.ref_seg):
-                cmnd = f"mri_synthseg --i {self.ref} --o {self.synth_save_dir} --parc --robust --resample {self.synth_save_dir}"
-                try:
-                    subprocess.run(cmnd.split())  # all extras saved to synth_sr_folder
-                except OSError as e:
-                    print(f'COMMAND FAILED: {cmnd} with error {e}')
-                    return False
-            #check that is has been created and return false if not
-            if not os.path.isfile(self.ref_seg):
-                print(f'COMMAND FAILED: {cmnd}')
-                return False
-             
-            if not os.path.isfile(self.flo_seg):
-                cmnd = f"mri_synthseg --i {input_flo_img} --o {self.synth_save_dir} --parc --robust --resample {self.synth_save_dir}"
-                try:
-                    subprocess.run(cmnd.split())  # all extras saved to synth_sr_folder
-                except OSError as e:
-                    print(f'COMMAND FAILED: {cmnd} with error {e}')
-                    return False
-            #check that is has been created and return false if not
-            if not os.path.isfile(self.flo_seg):
-                print(f'COMMAND FAILED: {cmnd}')
-                return False
-    
-        else:
-            if not os.path.isfile(self.ref_seg):
-                cmnd = f"mri_synthseg --i {input_flo_img} --o {self.synth_save_dir} --parc --robust --resample {self.synth_save_dir}"
-                try:
-                    subprocess.run(cmnd.split())  # all extras saved to synth_sr_folder
-                except OSError as e:
-                    print(f'COMMAND FAILED: {cmnd} with error {e}')
-                    return False
-            #check that is has been created and return false if not
-            if not os.path.isfile(self.ref_seg):
-                print(f'COMMAND FAILED: {cmnd}')
-                return False
+        return self.flo_synthseg()
 
-        return True
-    
     def easyreg(self):
-        if not self.is_postop:
-            if not os.path.isfile(self.fwd_field):
-                cmnd = f"mri_easyreg --ref {self.ref} --flo {self.flo} \
-                --ref_seg {self.ref_seg} --flo_seg {self.flo_seg} \
-                --fwd_field {self.fwd_field}"
-                try:
-                    subprocess.run(cmnd.split())  # all extras saved to synth_sr_folder
-                except:
-                    print(f'COMMAND FAILED: {cmnd} ')
-                    return False
-        #check that is has been created and return false if not
-            if not os.path.isfile(self.fwd_field):
-                print(f'COMMAND FAILED: {cmnd}')
-                return False
-        else:
-            if not os.path.isfile(self.fwd_field):
-                cmnd = f"mri_easyreg --ref {self.ref} --flo {self.synthsr_pth} \
+
+        # post-op images are registered through their synthsr version
+        flo = self.synthsr_pth if self.is_postop else self.flo
+        cmnd = f"mri_easyreg --ref {self.ref} --flo {flo} \
                 --ref_seg {self.ref_seg} --flo_seg {self.flo_seg} \
-                --fwd_field {self.fwd_field}"
-                try:
-                    subprocess.run(cmnd.split())  # all extras saved to synth_sr_folder
-                except:
-                    print(f'COMMAND FAILED: {cmnd}')
-                    return False
-
-            #check that is has been created and return false if not
-            if not os.path.isfile(self.fwd_field):
-                print(f'COMMAND FAILED: {cmnd}')
-                return False
+                --fwd_field {self.fwd_field}" + self.threads_flag("easyreg")
+        return self.run_command("easyreg", cmnd, self.fwd_field,
+                                cache=([self.ref, flo, self.ref_seg, self.flo_seg], []))
+
+    def field_warp(self, moving_pth, save_pth, interpolation):
+        # in-process equivalent of mri_easywarp, unless its output already exists
+        if os.path.isfile(save_pth):
+            return True
+
+        try:
+            with self.field_warper_lock:
+                if self.field_warper is None or self.field_warper.field_pth != self.fwd_field:
+                    self.field_warper = FieldWarper(self.fwd_field, self.volume_cache)
+            self.field_warper.warp(moving_pth, save_pth, interpolation)
+        except (RuntimeError, ValueError) as e:
+            print(f"WARP FAILED: {moving_pth} with {self.fwd_field}")
+            print(e)
+            return False
+
         return True
-    
+
     def easywarp(self):
-        # if not self.is_postop:
         # use field to warp vol
-        if not os.path.isfile(self.save_moving_img_pth):
-            cmnd = f"mri_easywarp --i {self.flo} --o {self.save_moving_img_pth} \
-            --field {self.fwd_field} --nearest"
-            try:
-                subprocess.run(cmnd.split())  # all extras saved to synth_sr_folder
-            except OSError as e:
-                print(f'COMMAND FAILED: {cmnd} with error {e}')
-                return False
-        
-        #check that is has been created and return false if not
-        if not os.path.isfile(self.save_moving_img_pth):
-            print(f'COMMAND FAILED: {cmnd}')
-            return False
-    
+        if self.warp_in_process:
+            return self.field_warp(self.flo, self.save_moving_img_pth, "nearest")
+        cmnd = f"mri_easywarp --i {self.flo} --o {self.save_moving_img_pth} \
+            --field {self.fwd_field} --nearest" + self.threads_flag("easywarp")
+        return self.run_command("easywarp", cmnd, self.save_moving_img_pth)
+
+    def warp_synthseg(self):
         # produce final warped seg
         # note: all outputs are at 1mm ... hence t1seg may differ in dimension from actual t1
         # hence now will produce segmentation of transformed image by re-executing segmentation on transformed image.
-        self.flo_seg_warp = os.path.join(self.synth_save_dir,
-                                            os.path.basename(self.flo)).replace(".nii.gz", "_synthseg_warp.nii.gz")
-        if not os.path.isfile(self.flo_seg_warp):
-            cmnd = f"mri_synthseg --i {self.save_moving_img_pth} --o {self.flo_seg_warp} --parc"
-            try:
-                subprocess.run(cmnd.split())  # all extras saved to synth_sr_folder
-            except OSError as e:
-                print(f'COMMAND FAILED: {cmnd} with error {e}')
-                return False
-        
-        return True
-    
+        cmnd = f"mri_synthseg --i {self.save_moving_img_pth} --o {self.flo_seg_warp} --parc" + \
+            self.threads_flag("synthseg")
+        batch = ("mri_synthseg", ["--parc"] + self.threads_flag("synthseg").split(),
+                 (self.save_moving_img_pth, self.flo_seg_warp, None))
+        return self.run_command("synthseg", cmnd, self.flo_seg_warp, batch, ([self.save_moving_img_pth], ["--parc"]))
+
+    def warp_flo_seg(self):
+        # QC without a second SynthSeg pass: the floating segmentation is warped with the same field (nearest
+        # neighbour, labels are not interpolated)
+        if self.warp_in_process:
+            return self.field_warp(self.flo_seg, self.flo_seg_warped, "nearest")
+        cmnd = f"mri_easywarp --i {self.flo_seg} --o {self.flo_seg_warped} \
+            --field {self.fwd_field} --nearest" + self.threads_flag("easywarp")
+        return self.run_command("easywarp", cmnd, self.flo_seg_warped)
+
     def register(self, fixed_img_pth, moving_img_pth, save_moving_img_pth,
-                 synth_save_dir, fwd_field_pth, is_postop=False):
+                 synth_save_dir, fwd_field_pth, is_postop=False, ref_seg_pth=None):
 
         self.set_params(fixed_img_pth, moving_img_pth, save_moving_img_pth,
-                        synth_save_dir, fwd_field_pth, is_postop)
+                        synth_save_dir, fwd_field_pth, is_postop, ref_seg_pth)
+
+        stages = ([self.synthsr] if is_postop else []) + [self.synthseg, self.easyreg, self.easywarp,
+                                                          self.warp_synthseg]
+        for stage in stages:
+            output = stage()
+            if output==False:
+                return False
 
-        output = self.synthsr() if is_postop else None
-        if output==False:
-            return False
-        output = self.synthseg(self.synthsr_pth) if is_postop else self.synthseg(self.flo)
-        if output==False:
-            return False
-        output = self.easyreg()
-        if output==False:
-            return False
-        output = self.easywarp()
-        if output==False:
-            return False
-        
         return self.dice_calc()
 
+    def output_pths(self):
+        # intermediate files written for the last registration
+        pths = [self.synthsr_pth, self.ref_seg, self.flo_seg, self.fwd_field]
+        for seg_pth in [self.flo_seg_warp, self.flo_seg_warped]:
+            if seg_pth is not None:
+                pths += [seg_pth, self.dice_table_pth(seg_pth)]
+        return [pth for pth in pths if pth is not None and os.path.isfile(pth)]
+
     def register_label(self, moving_label_pth, save_moving_label_pth):
 
-        if not os.path.isfile(save_moving_label_pth):
-            cmnd = f"mri_easywarp --i {moving_label_pth} --o {save_moving_label_pth} \
-            --field {self.fwd_field} --nearest"
-            try:
-                subprocess.run(cmnd.split())  # all extras saved to synth_sr_folder
-            except OSError as e:
-                print(f'COMMAND FAILED: {cmnd} with error {e}')
-                return False
-        
-        #check that is has been created and return false if not
-        if not os.path.isfile(self.save_moving_img_pth):
-            print(f'COMMAND FAILED: {cmnd}')
-            return False
-    
-    
-    def calculate_dice(self, volume1, volume2, label):
-        intersection = np.sum((volume1 == label) & (volume2 == label))
-        volume1_count = np.sum(volume1 == label)
-        volume2_count = np.sum(volume2 == label)
+        if self.warp_in_process:
+            return self.field_warp(moving_label_pth, save_moving_label_pth, "nearest")
+        cmnd = f"mri_easywarp --i {moving_label_pth} --o {save_moving_label_pth} \
+            --field {self.fwd_field} --nearest" + self.threads_flag("easywarp")
+        return self.run_command("easywarp", cmnd, save_moving_label_pth)
+
+    def dice_table(self, flo_seg_pth=None):
+        # per-label volumes, intersection and dice between the T1 segmentation and the warped segmentation
+        # flo_seg_pth: flo_seg_warp (default) or flo_seg_warped
+        flo_seg_pth = self.flo_seg_warp if flo_seg_pth is None else flo_seg_pth
+        ref_seg = read_image(self.ref_seg, volume_cache=self.volume_cache)
+        flo_seg = read_image(flo_seg_pth, volume_cache=self.volume_cache)
+        # a segmentation warped with the field is on the grid of the field, not necessarily the 1mm grid of ref_seg
+        if (flo_seg.GetSize() != ref_seg.GetSize() or not np.allclose(flo_seg.GetSpacing(), ref_seg.GetSpacing())
+                or not np.allclose(flo_seg.GetOrigin(), ref_seg.GetOrigin())
+                or not np.allclose(flo_seg.GetDirection(), ref_seg.GetDirection())):
+            flo_seg = sitk.Resample(flo_seg, ref_seg, sitk.Transform(), sitk.sitkNearestNeighbor, 0)
 
-        # Calculate Dice score
-        dice = (2. * intersection) / (volume1_count + volume2_count)
-        return dice
+        return dice_table(sitk.GetArrayFromImage(ref_seg), sitk.GetArrayFromImage(flo_seg))
 
-    def dice_calc(self):
-        volume1_sitk = sitk.ReadImage(self.ref_seg)
-        volume2_sitk = sitk.ReadImage(self.flo_seg_warp)
+    def dice_table_pth(self, flo_seg_pth=None):
 
-        volume1_np = sitk.GetArrayFromImage(volume1_sitk)
-        volume2_np = sitk.GetArrayFromImage(volume2_sitk)
+        flo_seg_pth = self.flo_seg_warp if flo_seg_pth is None else flo_seg_pth
+        return flo_seg_pth.replace(".nii.gz", "_dice.csv")
 
-        # Assuming the volumes contain the same set of labels, we can get the unique labels from one of the volumes
-        labels = np.unique(volume1_np)
+    @profiled("dice_calc", lambda self, flo_seg_pth=None: (
+        os.path.dirname(self.dice_table_pth(flo_seg_pth)),
+        os.path.basename(self.dice_table_pth(flo_seg_pth)).replace("_dice.csv", "")))
+    def dice_calc(self, flo_seg_pth=None):
 
-        dice_scores = [round(self.calculate_dice(volume1_np, volume2_np, label), 3) for label in labels if label != 0]
+        table = self.dice_table(flo_seg_pth)
+        table.to_csv(self.dice_table_pth(flo_seg_pth))
+
+        dice_scores = [round(dice, 3) for dice in table["dice"]]
 
         dice_average = round(np.mean(dice_scores), 3)
         dice_stdev = round(np.std(dice_scores), 3)
 
         return dice_scores, dice_average, dice_stdev
-
-
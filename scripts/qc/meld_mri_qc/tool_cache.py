@@ -0,0 +1,127 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from manifest import CaseManifest
+
+
+class ToolCache:
+
+    """
+    Content-addressed store of FreeSurfer tool outputs, shared by every batch and site using the same cache folder.
+
+    An output is keyed on the sha256 of the input images, the tool name, the FreeSurfer version (build-stamp.txt of
+    FREESURFER_HOME) and the options changing the result (not the paths or --threads). Moving a site folder, changing
+    the batch or re-exporting identical images therefore finds the outputs already computed, which are materialised
+    at the expected paths by hardlink (or copy across file systems).
+
+    Entries are written in a temporary folder and renamed, so several processes (or nodes) can fill the same cache.
+    Without a FreeSurfer version the cache is disabled, outputs of different versions are never mixed.
+    """
+
+    def __init__(self, cache_dir, freesurfer_home=None):
+        """
+        :param cache_dir: folder of the store e.g. on a file system shared by the cluster
+        :param freesurfer_home: FreeSurfer installation (default: FREESURFER_HOME)
+        """
+        self.cache_dir = cache_dir
+        self.version = self.freesurfer_version(os.environ.get("FREESURFER_HOME") if freesurfer_home is None
+                                               else freesurfer_home)
+        if self.version is None:
+            print(f"FreeSurfer version unknown (no build-stamp.txt in FREESURFER_HOME), {cache_dir} is not used")
+        elif not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+        self.hashes = {}  # (path, size, mtime_ns) -> sha256, images are hashed once per process
+        self.hashes_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+
+        return self.version is not None
+
+    @staticmethod
+    def freesurfer_version(freesurfer_home):
+
+        if freesurfer_home is None:
+            return None
+        try:
+            with open(os.path.join(freesurfer_home, "build-stamp.txt"), 'r') as file:
+                return file.read().strip()
+        except OSError:
+            return None
+
+    def input_hash(self, pth):
+
+        stat = os.stat(pth)
+        key = (pth, stat.st_size, stat.st_mtime_ns)
+        if key not in self.hashes:
+            sha256 = CaseManifest.file_hash(pth)
+            with self.hashes_lock:
+                self.hashes[key] = sha256
+        return self.hashes[key]
+
+    def key(self, tool, input_pths, options=()):
+        """
+        :param tool: tool name e.g. "synthseg"
+        :param input_pths: input images, in the order of the command
+        :param options: options changing the result e.g. ["--parc", "--robust"]
+        :return: key of the output
+        """
+        content = {"tool": tool, "version": self.version, "options": list(options),
+                   "inputs": [self.input_hash(pth) for pth in input_pths]}
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def entry_dir(self, key):
+
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    @staticmethod
+    def materialise(source_pth, target_pth):
+
+        try:
+            os.link(source_pth, target_pth)
+        except OSError:
+            # other file system, or links not supported
+            shutil.copy2(source_pth, target_pth)
+
+    def fetch(self, key, output_pth):
+        """
+        :return: True if the output was in the store and is now at output_pth
+        """
+        cached_pth = os.path.join(self.entry_dir(key), "output.nii.gz")
+        if not os.path.isfile(cached_pth):
+            return False
+
+        if not os.path.exists(os.path.dirname(output_pth)):
+            os.makedirs(os.path.dirname(output_pth), exist_ok=True)
+        tmp_pth = os.path.join(os.path.dirname(output_pth), "tmp_" + os.path.basename(output_pth))
+        if os.path.exists(tmp_pth):
+            os.remove(tmp_pth)
+        self.materialise(cached_pth, tmp_pth)
+        os.replace(tmp_pth, output_pth)
+        return True
+
+    def store(self, key, output_pth, description=None):
+        """
+        Add an output to the store (nothing is done if another process stored it first).
+        :param description: recorded next to the output e.g. the command, for inspection only
+        """
+        entry_dir = self.entry_dir(key)
+        if os.path.isdir(entry_dir):
+            return
+
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix="tmp_", dir=os.path.dirname(entry_dir))
+        try:
+            self.materialise(output_pth, os.path.join(tmp_dir, "output.nii.gz"))
+            with open(os.path.join(tmp_dir, "entry.json"), 'w') as file:
+                json.dump({"version": self.version, "output": os.path.basename(output_pth),
+                           "description": description}, file, indent=4)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # stored by another process in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
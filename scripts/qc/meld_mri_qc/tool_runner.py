@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import asyncio
+import tempfile
+import threading
+
+
+class SubprocessBackend:
+
+    """
+    Runs every command in a new process (each FreeSurfer tool then loads TensorFlow and its model at every run).
+    """
+
+    async def execute(self, args, timeout):
+        """
+        :param args: command as a list of arguments
+        :param timeout: seconds before the command is killed (None: no timeout)
+        :return: (return code or None if it could not run or timed out, output, timed out)
+        """
+        try:
+            process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.STDOUT)
+        except OSError as e:
+            return None, str(e), False
+
+        try:
+            output, _ = await asyncio.wait_for(process.communicate(), timeout=timeout)
+            return process.returncode, output.decode(errors="replace"), False
+        except asyncio.TimeoutError:
+            process.kill()
+            output, _ = await process.communicate()
+            return None, output.decode(errors="replace"), True
+
+
+class ServiceBackend:
+
+    """
+    Sends the commands to a tool service (tool_service.py) listening on a UNIX socket, which runs them in warm worker
+    processes. Commands the service does not run, or every command if it is not running, fall back to subprocesses.
+
+    A command timing out is reported as such, but keeps running in its service worker until it completes.
+    """
+
+    def __init__(self, socket_pth, fallback=None):
+
+        self.socket_pth = socket_pth
+        self.fallback = SubprocessBackend() if fallback is None else fallback
+        self.warned = False
+
+    async def execute(self, args, timeout):
+
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.socket_pth)
+        except OSError as e:
+            if not self.warned:
+                print(f"Tool service not available on {self.socket_pth} ({e}), running the tools as subprocesses")
+                self.warned = True
+            return await self.fallback.execute(args, timeout)
+
+        try:
+            writer.write((json.dumps({"args": args, "cwd": os.getcwd()}) + "\n").encode())
+            await writer.drain()
+            line = await asyncio.wait_for(reader.readline(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None, "", True
+        except OSError as e:
+            return None, f"tool service connection lost: {e}", False
+        finally:
+            writer.close()
+
+        if not line:
+            return None, "tool service closed the connection", False
+        response = json.loads(line)
+        if not response["served"]:
+            return await self.fallback.execute(args, timeout)
+        return response["returncode"], response["output"], False
+
+
+class ToolRunner:
+
+    """
+    Runs the FreeSurfer commands of a process on one asyncio event loop (in a background thread).
+
+    1) per-tool semaphores bound how many commands of a tool run at once (e.g. SynthSeg and EasyReg are memory-hungry,
+       easywarp is cheap), across every case and modality in flight in the process
+    2) commands exceeding the timeout of their tool are killed
+    3) return code and output (stdout and stderr) are captured instead of going to the terminal
+    4) tools accepting text files of inputs and outputs (mri_synthseg, mri_synthsr) can be batched: the images
+       requested within batch_linger seconds with the same options are processed by one command, so the model is
+       loaded once per batch instead of once per image
+    5) the commands are executed by a backend: a new process per command (SubprocessBackend, default) or a tool
+       service keeping warm workers (ServiceBackend)
+
+    Commands can be run from any thread: run() blocks until the command is done, submit() returns a future.
+    """
+
+    # one runner per process, see shared()
+    instance = None
+    instance_lock = threading.Lock()
+
+    def __init__(self, concurrency=None, timeouts=None, batch_sizes=None, batch_linger=2., backend=None):
+        """
+        :param concurrency: dict tool -> maximum number of commands running at once, tools not listed are unbounded
+        :param timeouts: dict tool -> timeout in seconds (per image for a batch), tools not listed have no timeout
+        :param batch_sizes: dict tool -> maximum number of images per command, tools not listed are not batched
+        :param batch_linger: seconds a batch waits for more images after its first one
+        :param backend: executes the commands, SubprocessBackend if None
+        """
+        self.concurrency = {} if concurrency is None else concurrency
+        self.timeouts = {} if timeouts is None else timeouts
+        self.batch_sizes = {} if batch_sizes is None else batch_sizes
+        self.batch_linger = batch_linger
+        self.backend = SubprocessBackend() if backend is None else backend
+        self.pid = os.getpid()
+
+        self.loop = asyncio.new_event_loop()
+        self.semaphores = {}
+        self.batches = {}  # (tool, command, options, resample) -> batch being collected
+        self.thread = threading.Thread(target=self.loop.run_forever, name="tool-runner", daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def shared(cls, concurrency=None, timeouts=None, batch_sizes=None, batch_linger=2., backend=None):
+        """
+        Runner of the current process (created on first use, and again in a forked worker process).
+        """
+        with cls.instance_lock:
+            if cls.instance is None or cls.instance.pid != os.getpid():
+                cls.instance = cls(concurrency, timeouts, batch_sizes, batch_linger, backend)
+            return cls.instance
+
+    def semaphore(self, tool):
+        # created on the loop thread
+        if tool not in self.semaphores:
+            self.semaphores[tool] = asyncio.Semaphore(self.concurrency[tool])
+        return self.semaphores[tool]
+
+    async def run_async(self, tool, args):
+        """
+        :param tool: tool name e.g. "synthseg", for the concurrency and timeout limits
+        :param args: command as a list of arguments
+        :return: dict with cmd, returncode (None if it could not run or timed out), output, duration and timed_out
+        """
+        return await self.run_limited(tool, args)
+
+    async def run_limited(self, tool, args, n_images=1):
+
+        if tool in self.concurrency:
+            async with self.semaphore(tool):
+                return await self.execute(tool, args, n_images)
+        return await self.execute(tool, args, n_images)
+
+    def batching(self, tool):
+
+        return self.batch_sizes.get(tool, 1) > 1
+
+    async def run_batched_async(self, tool, command, options, item):
+        """
+        :param tool: tool name e.g. "synthseg"
+        :param command: executable e.g. "mri_synthseg"
+        :param options: options shared by the images of the batch e.g. ["--parc", "--threads", "4"]
+        :param item: (input image, output path, resampled image path or None)
+        :return: result of the command which processed the image (see run_async)
+        """
+        key = (tool, command, tuple(options), item[2] is not None)
+        if key not in self.batches:
+            self.batches[key] = {"items": [], "futures": []}
+            self.loop.call_later(self.batch_linger, self.flush_batch, key)
+
+        batch = self.batches[key]
+        future = self.loop.create_future()
+        batch["items"].append(item)
+        batch["futures"].append(future)
+        if len(batch["items"]) >= self.batch_sizes[tool]:
+            self.flush_batch(key)
+
+        return await future
+
+    def flush_batch(self, key):
+        # called on the loop thread, the timer of a batch already flushed because it was full does nothing
+        batch = self.batches.pop(key, None)
+        if batch is not None:
+            self.loop.create_task(self.run_batch(key, batch))
+
+    @staticmethod
+    def single_args(command, options, item):
+
+        args = [command, "--i", item[0], "--o", item[1]]
+        if item[2] is not None:
+            args += ["--resample", item[2]]
+        return args + list(options)
+
+    async def run_batch(self, key, batch):
+
+        tool, command, options, _ = key
+        items = batch["items"]
+        try:
+            if len(items) == 1:
+                batch["futures"][0].set_result(await self.run_limited(tool, self.single_args(command, options,
+                                                                                             items[0])))
+                return
+
+            with tempfile.TemporaryDirectory() as list_dir:
+                args = [command]
+                for flag, column in [("--i", 0), ("--o", 1), ("--resample", 2)]:
+                    if items[0][column] is None:
+                        continue
+                    list_pth = os.path.join(list_dir, f"{flag.strip('-')}.txt")
+                    with open(list_pth, 'w') as file:
+                        file.write("\n".join(item[column] for item in items) + "\n")
+                    args += [flag, list_pth]
+                result = await self.run_limited(tool, args + list(options), n_images=len(items))
+
+            if result["returncode"] == 0:
+                for future in batch["futures"]:
+                    future.set_result(result)
+                return
+
+            # e.g. one unreadable image stops the whole batch: run the images one by one so only its case fails
+            print(f"BATCH FAILED, running its {len(items)} images separately: {result['cmd']}")
+            for item in items:
+                if os.path.isfile(item[1]):
+                    os.remove(item[1])
+            results = await asyncio.gather(*[self.run_limited(tool, self.single_args(command, options, item))
+                                             for item in items])
+            for future, item_result in zip(batch["futures"], results):
+                future.set_result(item_result)
+        except Exception as e:
+            for future in batch["futures"]:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def execute(self, tool, args, n_images=1):
+
+        start_time = time.time()
+        timeout = self.timeouts[tool] * n_images if tool in self.timeouts else None
+        returncode, output, timed_out = await self.backend.execute(args, timeout)
+
+        return {"cmd": " ".join(args), "returncode": returncode, "output": output,
+                "duration": time.time() - start_time, "timed_out": timed_out}
+
+    def submit(self, tool, args):
+        """
+        :return: concurrent.futures.Future of the result of run_async
+        """
+        return asyncio.run_coroutine_threadsafe(self.run_async(tool, args), self.loop)
+
+    def run(self, tool, args):
+
+        return self.submit(tool, args).result()
+
+    def run_batched(self, tool, command, options, item):
+
+        return asyncio.run_coroutine_threadsafe(self.run_batched_async(tool, command, options, item),
+                                                self.loop).result()
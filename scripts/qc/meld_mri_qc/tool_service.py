@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import runpy
+import signal
+import asyncio
+import argparse
+import tempfile
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+# tools of the worker process: None runs the FreeSurfer scripts, FakeTools in --fake mode
+worker_tools = None
+
+
+def warm_worker(fake_delay):
+    # run once per worker process, everything imported here stays loaded for the following commands
+    global worker_tools
+    if fake_delay is not None:
+        from fake_tools import FakeTools
+        worker_tools = FakeTools(fake_delay)
+        return
+    try:
+        import tensorflow  # the FreeSurfer tools are keras models
+    except ImportError:
+        pass
+
+
+def run_script(args):
+    # run the python script of a FreeSurfer tool in this process, as $FREESURFER_HOME/bin/<tool> does with fspython
+    script = os.path.join(os.environ.get("FREESURFER_HOME", ""), "python", "scripts", os.path.basename(args[0]))
+    if not os.path.isfile(script):
+        return 127, f"{script} not found"
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = os.dup(1), os.dup(2)
+    with tempfile.TemporaryFile() as log:
+        # the output of TensorFlow is written by its C++ code, the file descriptors are redirected
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        sys.argv = [script] + list(args[1:])
+        try:
+            runpy.run_path(script, run_name="__main__")
+            returncode = 0
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except Exception:
+            traceback.print_exc()
+            returncode = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            for fd in saved_fds:
+                os.close(fd)
+
+        log.seek(0)
+        output = log.read().decode(errors="replace")
+
+    if "tensorflow" in sys.modules:
+        # the models of every run would otherwise accumulate in the session
+        sys.modules["tensorflow"].keras.backend.clear_session()
+    return returncode, output
+
+
+def run_job(args, cwd):
+    # relative paths of the command are relative to the directory of the client
+    os.chdir(cwd)
+    if worker_tools is not None:
+        return worker_tools.run(args)
+    return run_script(args)
+
+
+class ToolService:
+
+    """
+    Local service running FreeSurfer tool commands in warm worker processes, see ServiceBackend in tool_runner.
+
+    Every tool has its own pool of worker processes, started once: TensorFlow (and the Python environment of the tools)
+    is imported at start-up instead of at every command. The commands are received on a UNIX socket, one json line
+    {"args": [...], "cwd"} per connection, and answered with {"served", "returncode", "output"}. Commands of tools without
+    workers are answered served=False, the client then runs them itself.
+
+    With fake_delay the workers run FakeTools instead of FreeSurfer, to test the pipeline without FreeSurfer.
+    """
+
+    def __init__(self, socket_pth, workers, fake_delay=None):
+        """
+        :param socket_pth: UNIX socket to listen on
+        :param workers: dict command -> number of worker processes e.g. {"mri_synthseg": 1}
+        :param fake_delay: None to run FreeSurfer, seconds per image to run FakeTools
+        """
+        self.socket_pth = socket_pth
+        self.workers = workers
+        self.fake_delay = fake_delay
+        self.pools = {}
+
+    def start_pools(self):
+
+        context = multiprocessing.get_context("spawn")
+        for command, n_workers in self.workers.items():
+            self.pools[command] = ProcessPoolExecutor(max_workers=n_workers, mp_context=context,
+                                                      initializer=warm_worker, initargs=(self.fake_delay,))
+            # start the workers now rather than at the first command
+            for future in [self.pools[command].submit(os.getpid) for _ in range(n_workers)]:
+                future.result()
+
+    async def handle(self, reader, writer):
+
+        try:
+            request = json.loads(await reader.readline())
+            command = os.path.basename(request["args"][0])
+            if command in self.pools:
+                returncode, output = await asyncio.get_running_loop().run_in_executor(self.pools[command], run_job,
+                                                                                      request["args"], request["cwd"])
+                response = {"served": True, "returncode": returncode, "output": output}
+            else:
+                response = {"served": False, "returncode": None, "output": ""}
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            print(f"Request failed: {e}")
+        finally:
+            writer.close()
+
+    async def serve(self):
+
+        if os.path.exists(self.socket_pth):
+            os.remove(self.socket_pth)
+        server = await asyncio.start_unix_server(self.handle, path=self.socket_pth)
+        print(f"Tool service listening on {self.socket_pth}, workers: {self.workers}")
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+
+        self.start_pools()
+        # stopped by SIGTERM (e.g. kill, the end of a cluster job) as by ctrl-c, the socket is removed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for pool in self.pools.values():
+                pool.shutdown()
+            if os.path.exists(self.socket_pth):
+                os.remove(self.socket_pth)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Keep FreeSurfer tool workers warm for the MRI QC pipeline "
+                                                 "(set tool_service_socket in parameters.py). Run with fspython.")
+    parser.add_argument("--socket",
+                        help="UNIX socket to listen on",
+                        default="/tmp/meld_tool_service.sock",
+                        )
+    parser.add_argument("--workers",
+                        help="worker processes per tool e.g. mri_synthseg=2",
+                        nargs="+",
+                        default=["mri_synthseg=1", "mri_synthsr=1", "mri_easyreg=1"],
+                        )
+    parser.add_argument("--fake",
+                        help="run fake tools instead of FreeSurfer (see fake_tools.py)",
+                        action="store_true",
+                        )
+    parser.add_argument("--fake-delay",
+                        help="seconds per image of the fake tools",
+                        type=float,
+                        default=0.,
+                        )
+    args = parser.parse_args()
+
+    workers = {}
+    for worker in args.workers:
+        command, n_workers = worker.split("=")
+        workers[command] = int(n_workers)
+
+    ToolService(args.socket, workers, args.fake_delay if args.fake else None).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import os
+import threading
+import SimpleITK as sitk
+from collections import OrderedDict
+
+
+class VolumeCache:
+
+    """
+    Images of the running case kept in memory, so that each file is decompressed at most once per case (e.g. the T1
+    by its QC image and the overlay, the T1 segmentation by the dice of every modality, an in-process warp output by
+    its QC image).
+
+    Images are keyed by path and stored with their pixel type as read; a file modified since (size or mtime) is read
+    again. Least recently used images are evicted above max_mb (the last image read is always kept). The cached images
+    are shared: stages take arrays from them with sitk.GetArrayFromImage (a copy), or keep the image referenced while
+    using a sitk.GetArrayViewFromImage view, and never modify them in place.
+    """
+
+    def __init__(self, max_mb=2048):
+        """
+        :param max_mb: memory cap of the cached images, 0 disables the cache
+        """
+        self.max_bytes = max_mb * 2 ** 20
+        self.entries = OrderedDict()  # path -> (signature, image, bytes)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        self.loading = {}  # path -> lock, concurrent stages wait for the image instead of reading it again
+
+    @staticmethod
+    def signature(pth):
+
+        stat = os.stat(pth)
+        return stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def image_bytes(image):
+
+        return image.GetNumberOfPixels() * image.GetNumberOfComponentsPerPixel() * image.GetSizeOfPixelComponent()
+
+    def cached(self, pth, signature):
+
+        with self.lock:
+            entry = self.entries.get(pth)
+            if entry is None or entry[0] != signature:
+                return None
+            self.entries.move_to_end(pth)
+            self.hits += 1
+            return entry[1]
+
+    def store(self, pth, signature, image):
+
+        if self.max_bytes <= 0:
+            return
+        with self.lock:
+            if pth in self.entries:
+                self.bytes -= self.entries.pop(pth)[2]
+            self.entries[pth] = (signature, image, self.image_bytes(image))
+            self.bytes += self.entries[pth][2]
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                self.bytes -= self.entries.popitem(last=False)[1][2]
+
+    def image(self, pth, pixel_type=None) -> sitk.Image:
+        """
+        :param pth: image path
+        :param pixel_type: e.g. sitk.sitkFloat32, the cached image is cast to it (None for the type of the file)
+        """
+        pth = os.path.abspath(pth)
+        with self.lock:
+            loading = self.loading.setdefault(pth, threading.Lock())
+
+        with loading:
+            signature = self.signature(pth)
+            image = self.cached(pth, signature)
+            if image is None:
+                image = sitk.ReadImage(pth)
+                with self.lock:
+                    self.misses += 1
+                self.store(pth, signature, image)
+
+        if pixel_type is not None and image.GetPixelID() != pixel_type:
+            image = sitk.Cast(image, pixel_type)
+        return image
+
+    def put(self, pth, image):
+        """
+        Cache an image just written to pth (e.g. a warped image), it is not read back.
+        """
+        self.store(os.path.abspath(pth), self.signature(pth), image)
+
+    def stats(self):
+
+        with self.lock:
+            return {"volume_cache_hits": self.hits, "volume_cache_misses": self.misses,
+                    "volume_cache_mb": round(self.bytes / 2 ** 20, 1)}
+
+    def clear(self):
+        # at the end of a case
+        with self.lock:
+            self.entries.clear()
+            self.loading.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+def read_image(pth, pixel_type=None, volume_cache=None) -> sitk.Image:
+    # through the cache when there is one
+    if volume_cache is not None:
+        return volume_cache.image(pth, pixel_type)
+    return sitk.ReadImage(pth, pixel_type) if pixel_type is not None else sitk.ReadImage(pth)
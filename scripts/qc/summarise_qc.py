@@ -94,7 +94,71 @@ def color_dataframe(row):
         color = 'lightgreen'
         
     return [f'background-color: {color}'] * len(row) 
-            
+
+
+def mri_qc_summary(subject_array, df_mri, df_qc, mods):
+    # MRI QC of every subject of the demographics: (mri_qc_array, note_mri_array, mod_qc_correct, mask_qc_correct)
+    mod_qc_correct = {mod: [] for mod in mods}
+    mri_qc_array = []
+    note_mri_array = []
+    mask_qc_correct = []
+    for subject in subject_array:
+        bids_id = 'sub-'+''.join(subject.split('_'))
+        if not bids_id in df_mri['Subject'].values:
+            mri_qc_array.append(0)
+            note_mri_array.append('QC not done or have failed')
+            [mod_qc_correct[mod].append(np.nan) for mod in mods]
+            mask_qc_correct.append(np.nan)
+        else:
+            if df_mri[df_mri['Subject']==bids_id]['T1-Preop Correct Mod.'].values[0] is np.nan:
+                mri_qc_array.append(0)
+                note_mri_array.append('QC not done')
+                [mod_qc_correct[mod].append(np.nan) for mod in mods]
+                mask_qc_correct.append(np.nan)
+            else:
+                mri_qc_array.append(1)
+                note_mri=''
+                #check modalities
+                for mod in mods :
+                    if int(df_mri[df_mri['Subject']==bids_id][f'{mod} Present'].values[0])==1:
+                        return_code, error = check_mod_qc(df_mri[df_mri['Subject']==bids_id][[f'{mod} Correct Mod.',f'{mod} Artefact',f'{mod} FOV',f'{mod} Defacing']].values[0], mod)
+                        if return_code == 0:
+                            mod_qc_correct[mod].append(0)
+                            note_mri = note_mri + ';' + error
+                        else:
+                            mod_qc_correct[mod].append(1)
+                    else:
+                        mod_qc_correct[mod].append(np.nan)
+                #check lesion mask
+                if int(df_mri[df_mri['Subject']==bids_id]['Mask Present'].values[0])==0:
+                    if df_qc[df_qc['study ID']==subject]['need_mask'].values[0]==1:
+                        if mod_qc_correct['T1-Postop'][-1]==1:
+                            note_mri = note_mri + ';' + 'mask missing. If not provided, postop will be used as ground truth, but for evaluation only'
+                            mask_qc_correct.append(3)
+                        else:
+                            note_mri = note_mri + ';' + 'mask needed. Patient cannot be included as no ground truth is provided'
+                            mask_qc_correct.append(4)                                        
+                    else:
+                        mask_qc_correct.append(np.nan)
+                else:
+                    if df_mri[df_mri['Subject']==bids_id]['Mask QC'].values[0] is np.nan: 
+                        mask_qc_correct.append(0)
+                        note_mri = note_mri + ';' + 'mask present but not QCed'
+                    elif int(df_mri[df_mri['Subject']==bids_id]['Mask QC'].values[0])==1: 
+                        mask_qc_correct.append(1)
+                    elif int(df_mri[df_mri['Subject']==bids_id]['Mask QC'].values[0])==2: 
+                        mask_qc_correct.append(2)
+                    elif int(df_mri[df_mri['Subject']==bids_id]['Mask QC'].values[0])==6: 
+                        mask_qc_correct.append(5)
+                        note_mri = note_mri + ';' + 'mask is resection cavity' 
+                    elif int(df_mri[df_mri['Subject']==bids_id]['Mask QC'].values[0])>2: 
+                        mask_qc_correct.append(0)
+                        note_mri = note_mri + ';' + 'Error with mask'     
+                note_mri_array.append(note_mri)
+
+    return mri_qc_array, note_mri_array, mod_qc_correct, mask_qc_correct
+
+
 if __name__ == '__main__':
     # parse commandline arguments
     parser = argparse.ArgumentParser(description="Main pipeline to predict on subject with MELD classifier")
@@ -164,62 +228,8 @@ if __name__ == '__main__':
             mod_qc_correct = {'T1-Preop':[],'FLAIR':[], 'T2':[], 'T1-Postop':[]}
             if len(csv_mri)==1:
                 df_mri = pd.read_csv(csv_mri[0])
-                mri_qc_array = []
-                note_mri_array = []
-                mask_qc_correct = []
-                for subject in subject_array:
-                    bids_id = 'sub-'+''.join(subject.split('_'))
-                    if not bids_id in df_mri['Subject'].values:
-                        mri_qc_array.append(0)
-                        note_mri_array.append('QC not done or have failed')
-                        [mod_qc_correct[mod].append(np.nan) for mod in mods]
-                        mask_qc_correct.append(np.nan)
-                    else:
-                        if df_mri[df_mri['Subject']==bids_id]['T1-Preop Correct Mod.'].values[0] is np.nan:
-                            mri_qc_array.append(0)
-                            note_mri_array.append('QC not done')
-                            [mod_qc_correct[mod].append(np.nan) for mod in mods]
-                            mask_qc_correct.append(np.nan)
-                        else:
-                            mri_qc_array.append(1)
-                            note_mri=''
-                            #check modalities
-                            for mod in mods :
-                                if int(df_mri[df_mri['Subject']==bids_id][f'{mod} Present'].values[0])==1:
-                                    return_code, error = check_mod_qc(df_mri[df_mri['Subject']==bids_id][[f'{mod} Correct Mod.',f'{mod} Artefact',f'{mod} FOV',f'{mod} Defacing']].values[0], mod)
-                                    if return_code == 0:
-                                        mod_qc_correct[mod].append(0)
-                                        note_mri = note_mri + ';' + error
-                                    else:
-                                        mod_qc_correct[mod].append(1)
-                                else:
-                                    mod_qc_correct[mod].append(np.nan)
-                            #check lesion mask
-                            if int(df_mri[df_mri['Subject']==bids_id]['Mask Present'].values[0])==0:
-                                if df_qc[df_qc['study ID']==subject]['need_mask'].values[0]==1:
-                                    if mod_qc_correct['T1-Postop'][-1]==1:
-                                        note_mri = note_mri + ';' + 'mask missing. If not provided, postop will be used as ground truth, but for evaluation only'
-                                        mask_qc_correct.append(3)
-                                    else:
-                                        note_mri = note_mri + ';' + 'mask needed. Patient cannot be included as no ground truth is provided'
-                                        mask_qc_correct.append(4)                                        
-                                else:
-                                    mask_qc_correct.append(np.nan)
-                            else:
-                                if df_mri[df_mri['Subject']==bids_id]['Mask QC'].values[0] is np.nan: 
-                                    mask_qc_correct.append(0)
-                                    note_mri = note_mri + ';' + 'mask present but not QCed'
-                                elif int(df_mri[df_mri['Subject']==bids_id]['Mask QC'].values[0])==1: 
-                                    mask_qc_correct.append(1)
-                                elif int(df_mri[df_mri['Subject']==bids_id]['Mask QC'].values[0])==2: 
-                                    mask_qc_correct.append(2)
-                                elif int(df_mri[df_mri['Subject']==bids_id]['Mask QC'].values[0])==6: 
-                                    mask_qc_correct.append(5)
-                                    note_mri = note_mri + ';' + 'mask is resection cavity' 
-                                elif int(df_mri[df_mri['Subject']==bids_id]['Mask QC'].values[0])>2: 
-                                    mask_qc_correct.append(0)
-                                    note_mri = note_mri + ';' + 'Error with mask'     
-                            note_mri_array.append(note_mri)
+                mri_qc_array, note_mri_array, mod_qc_correct, mask_qc_correct = mri_qc_summary(
+                    subject_array, df_mri, df_qc, mods)
             else:   
                 mri_qc_array = [0]*len(subject_array)
                 for mod in mods:
@@ -1,9 +1,14 @@
+import os
+import sys
 import numpy as np
 import SimpleITK as sitk
 from scipy.ndimage import binary_dilation, binary_erosion, gaussian_filter
 from scipy.ndimage import label
 from scipy.ndimage import sum as ndi_sum
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "qc", "meld_mri_qc"))
+from stage_profile import profiled
+
 
 class SegmentationFill:
     """"""
@@ -12,12 +17,20 @@ class SegmentationFill:
         self.orig_sitk_seg = None
         self.seg_array = None
         self.sitk_seg = None
+        self.save_pth = None  # output of fill_segmentation, the profiles of fill_3d are written next to it
 
     def get_sitk_array(self, seg_pth):
 
         self.orig_sitk_seg = sitk.ReadImage(seg_pth, sitk.sitkInt8)
         self.seg_array = sitk.GetArrayFromImage(self.orig_sitk_seg)
 
+    def profile_target(self):
+        # folder and name of the fill_3d profiles: next to the filled mask, or in the working directory
+        if self.save_pth is None:
+            return os.getcwd(), "fill_3d"
+        return os.path.dirname(os.path.abspath(self.save_pth)), os.path.basename(self.save_pth).replace(".nii.gz", "")
+
+    @profiled("fill_3d", lambda self, *args, **kwargs: self.profile_target())
     def fill_3d(self, iterations=10, sigma=1):
         # Convert to integer and add a border of zeros around the array
         arr = np.pad(self.seg_array.astype(int), pad_width=1, mode='constant', constant_values=0)
@@ -53,6 +66,7 @@ class SegmentationFill:
     def fill_segmentation(self, seg_pth, save_pth):
 
         self.get_sitk_array(seg_pth)
+        self.save_pth = save_pth
 
         self.sitk_seg = sitk.GetImageFromArray(self.fill_3d())
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the QC scripts import each other by module name (run from their folder)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "scripts", "qc", "meld_mri_qc"))
@@ -0,0 +1,109 @@
+import os
+
+import pytest
+
+from bids_inventory import BidsInventory
+
+
+TAILS = [("t1", "_preop_T1w.nii.gz"), ("flair", "_preop_FLAIR.nii.gz"), ("t1_postop", "_postop_T1w.nii.gz")]
+
+
+def touch(pth):
+
+    os.makedirs(os.path.dirname(pth), exist_ok=True)
+    with open(pth, 'wb') as file:
+        file.write(b"")
+
+
+@pytest.fixture
+def site(tmp_path):
+
+    bids_folder = tmp_path / "bids"
+    for case in ["sub-MELDH99P0001", "sub-MELDH99C0002"]:
+        touch(bids_folder / case / "anat" / f"{case}_preop_T1w.nii.gz")
+        touch(bids_folder / case / "anat" / f"{case}_preop_T1w.json")
+    touch(bids_folder / "sub-MELDH99P0001" / "anat" / "sub-MELDH99P0001_preop_FLAIR.nii.gz")
+    touch(bids_folder / "sub-MELDH99P0001" / "dwi" / "notes.txt")
+    return str(bids_folder), str(tmp_path / "bids_inventory.sqlite")
+
+
+def inventory(site):
+
+    bids_inventory = BidsInventory(*site, TAILS)
+    # the directories were just written, they are not racy for the test
+    bids_inventory.racy_seconds = -1
+    return bids_inventory
+
+
+def test_files_are_classified(site):
+
+    bids_inventory = inventory(site)
+    bids_inventory.refresh()
+
+    assert bids_inventory.subjects() == ["sub-MELDH99C0002", "sub-MELDH99P0001"]
+    files = {file["filename"]: (file["folder"], file["kind"], bool(file["sidecar"]))
+             for file in bids_inventory.case_files("sub-MELDH99P0001")}
+    assert files == {"sub-MELDH99P0001_preop_T1w.nii.gz": ("anat", "t1", False),
+                     "sub-MELDH99P0001_preop_T1w.json": ("anat", "t1", True),
+                     "sub-MELDH99P0001_preop_FLAIR.nii.gz": ("anat", "flair", False),
+                     "notes.txt": ("dwi", None, False)}
+    assert [file["folder"] for file in bids_inventory.case_files("sub-MELDH99P0001", ["dwi"])] == ["dwi"]
+
+
+def test_unchanged_site_is_not_listed_again(site):
+
+    inventory(site).refresh()
+    assert inventory(site).refresh() == 0
+
+
+def test_modified_folder_is_listed_again(site):
+
+    bids_folder, _ = site
+    inventory(site).refresh()
+
+    added = os.path.join(bids_folder, "sub-MELDH99C0002", "anat", "sub-MELDH99C0002_postop_T1w.nii.gz")
+    touch(added)
+    anat = os.path.dirname(added)
+    stat = os.stat(anat)
+    # a new mtime even on storage with a coarse mtime tick
+    os.utime(anat, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    bids_inventory = inventory(site)
+    assert bids_inventory.refresh() == 1
+    assert "t1_postop" in [file["kind"] for file in bids_inventory.case_files("sub-MELDH99C0002")]
+
+
+def test_removed_subject_leaves_the_index(site):
+
+    bids_folder, _ = site
+    inventory(site).refresh()
+
+    for root, dirs, files in os.walk(os.path.join(bids_folder, "sub-MELDH99C0002"), topdown=False):
+        for name in files:
+            os.remove(os.path.join(root, name))
+        os.rmdir(root)
+    stat = os.stat(bids_folder)
+    os.utime(bids_folder, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    bids_inventory = inventory(site)
+    bids_inventory.refresh()
+    assert bids_inventory.subjects() == ["sub-MELDH99P0001"]
+    assert bids_inventory.case_files("sub-MELDH99C0002") == []
+
+
+def test_racy_directories_are_listed_again(site):
+    # modified within racy_seconds of the scan: files added in the same mtime tick would be missed
+    BidsInventory(*site, TAILS).refresh()
+    assert BidsInventory(*site, TAILS).refresh() > 0
+
+
+def test_new_tails_reclassify_without_listing(site):
+
+    inventory(site).refresh()
+
+    bids_inventory = BidsInventory(site[0], site[1], TAILS[:1])
+    bids_inventory.racy_seconds = -1
+    assert bids_inventory.refresh() == 0
+    kinds = {file["filename"]: file["kind"] for file in bids_inventory.case_files("sub-MELDH99P0001")}
+    assert kinds["sub-MELDH99P0001_preop_FLAIR.nii.gz"] is None
+    assert kinds["sub-MELDH99P0001_preop_T1w.nii.gz"] == "t1"
@@ -0,0 +1,139 @@
+import os
+import json
+
+import pytest
+
+from manifest import CaseManifest
+
+
+CASE = "sub-MELDH99P0001"
+
+
+@pytest.fixture
+def case_files(tmp_path):
+    # inputs and outputs of a completed case, recorded in a manifest
+    anat = tmp_path / "bids" / CASE / "anat"
+    anat.mkdir(parents=True)
+    inputs = [anat / f"{CASE}_preop_T1w.nii.gz", anat / f"{CASE}_preop_FLAIR.nii.gz"]
+    for i, pth in enumerate(inputs):
+        pth.write_bytes(bytes([i]) * 1000)
+    output = tmp_path / "qc" / f"{CASE}_T1_sagittal_coronal.png"
+    output.parent.mkdir()
+    output.write_bytes(b"png")
+
+    manifest_pth = str(tmp_path / "df_qc_manifest.json")
+    manifest = CaseManifest(manifest_pth)
+    input_pths = [str(pth) for pth in inputs]
+    manifest.record(CASE, manifest.input_records(CASE, input_pths), [str(output)], {"case": CASE, "output": True})
+    return manifest_pth, input_pths, output
+
+
+def is_complete(manifest_pth, input_pths):
+    # as checked by a rerun
+    manifest = CaseManifest(manifest_pth)
+    return manifest.is_complete(CASE, manifest.input_records(CASE, input_pths))
+
+
+def shift_mtime(pth, seconds=10):
+
+    stat = os.stat(pth)
+    os.utime(pth, ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds * 10 ** 9))
+
+
+def test_recorded_case_is_complete(case_files):
+
+    manifest_pth, input_pths, _ = case_files
+    assert is_complete(manifest_pth, input_pths)
+    with open(manifest_pth, 'r') as file:
+        entry = json.load(file)[CASE]
+    assert entry["stage"] == "complete"
+    assert all(record["sha256"] is not None for record in entry["inputs"].values())
+
+
+def test_size_change_invalidates(case_files):
+
+    manifest_pth, input_pths, _ = case_files
+    with open(input_pths[1], 'ab') as file:
+        file.write(b"more")
+    assert not is_complete(manifest_pth, input_pths)
+
+
+def test_content_change_invalidates(case_files):
+    # same size, new mtime: the file is hashed again
+    manifest_pth, input_pths, _ = case_files
+    with open(input_pths[0], 'r+b') as file:
+        file.write(b"\xff")
+    shift_mtime(input_pths[0])
+    assert not is_complete(manifest_pth, input_pths)
+
+
+def test_mtime_change_with_same_content_is_complete(case_files):
+    # e.g. a re-exported BIDS folder, the new stats are kept
+    manifest_pth, input_pths, _ = case_files
+    shift_mtime(input_pths[0])
+
+    manifest = CaseManifest(manifest_pth)
+    input_records = manifest.input_records(CASE, input_pths)
+    assert manifest.is_complete(CASE, input_records)
+    assert manifest.cases[CASE]["inputs"][input_pths[0]]["mtime"] == os.stat(input_pths[0]).st_mtime
+
+
+def test_added_or_removed_input_invalidates(case_files):
+
+    manifest_pth, input_pths, _ = case_files
+    assert not is_complete(manifest_pth, input_pths[:1])
+
+    added = os.path.join(os.path.dirname(input_pths[0]), f"{CASE}_preop_T2w.nii.gz")
+    with open(added, 'wb') as file:
+        file.write(b"t2")
+    assert not is_complete(manifest_pth, input_pths + [added])
+
+
+def test_missing_output_invalidates(case_files):
+
+    manifest_pth, input_pths, output = case_files
+    output.unlink()
+    assert not is_complete(manifest_pth, input_pths)
+    assert CaseManifest(manifest_pth).stale_outputs(CASE) == []
+
+
+def test_input_modified_while_running_is_not_trusted(tmp_path):
+    # the hash of a new input is only recorded if the file is unchanged since the case started
+    pth = tmp_path / f"{CASE}_preop_T1w.nii.gz"
+    pth.write_bytes(b"t1")
+    manifest = CaseManifest(str(tmp_path / "df_qc_manifest.json"))
+    input_records = manifest.input_records(CASE, [str(pth)])
+
+    pth.write_bytes(b"t1 modified")
+    manifest.record(CASE, input_records, [], {"case": CASE, "output": True})
+    assert manifest.cases[CASE]["inputs"][str(pth)]["sha256"] is None
+    assert not manifest.is_complete(CASE, manifest.input_records(CASE, [str(pth)]))
+
+
+def test_save_is_atomic_and_reloads(case_files):
+
+    manifest_pth, _, _ = case_files
+    assert not os.path.exists(manifest_pth + ".tmp")
+    manifest = CaseManifest(manifest_pth)
+    assert list(manifest.cases) == [CASE]
+
+    manifest.discard(CASE)
+    assert CaseManifest(manifest_pth).cases == {}
+
+
+def test_corrupt_manifest_starts_empty(tmp_path):
+
+    pth = tmp_path / "df_qc_manifest.json"
+    pth.write_text('{"sub-1": ')
+    assert CaseManifest(str(pth)).cases == {}
+
+
+def test_sort_orders_within_positions(tmp_path):
+
+    manifest = CaseManifest(str(tmp_path / "df_qc_manifest.json"))
+    for case in ["sub-9", "sub-3", "sub-1"]:
+        manifest.record(case, {}, [], {"case": case, "output": True})
+    manifest.sort(["sub-1", "sub-3"])
+
+    assert [case_result["case"] for case_result in manifest.case_results()] == ["sub-9", "sub-1", "sub-3"]
+    assert list(CaseManifest(manifest.manifest_pth).cases) == ["sub-9", "sub-1", "sub-3"]
@@ -0,0 +1,98 @@
+import os
+import sys
+import glob
+
+import pytest
+
+import merge_shards
+from parameters import Config
+from directory_registration import DirectoryRegistration
+from fake_tools import FakeTools
+from synthetic_cohort import SyntheticCohort
+
+
+SHARDS = 2
+
+
+def site_config(bids_folder, save_dir, shard=None):
+    # the pipeline on the synthetic cohort with the fake FreeSurfer tools, serial and without the caches of the site
+    config = Config()
+    config.orig_bids_folder = bids_folder
+    config.list_subjects = None
+    config.save_dir = save_dir
+    config.img_save_dir = os.path.join(save_dir, "qc_images")
+    config.synth_save_dir = os.path.join(save_dir, "synthseg")
+    config.workers = 1
+    config.render_workers = 0
+    config.resume = False
+    config.tool_cache_dir = None
+    config.tool_service_socket = None
+    config.shard = shard
+    return config
+
+
+@pytest.fixture(scope="module")
+def runs(tmp_path_factory):
+
+    work_dir = tmp_path_factory.mktemp("merge_shards")
+    bids_folder = str(work_dir / "MELD_H99")
+    # sub-MELDH99C0002 is in shard 2 and the other cases in shard 1: the shards interleave in case order
+    SyntheticCohort(bids_folder, scale=0.3).generate(4, patient_fraction=0.5)
+
+    bin_dir = str(work_dir / "fake_freesurfer")
+    FakeTools.install(bin_dir)
+    path = os.environ["PATH"]
+    os.environ["PATH"] = bin_dir + os.pathsep + path
+    try:
+        unsharded = site_config(bids_folder, str(work_dir / "unsharded"))
+        DirectoryRegistration(unsharded).directory_registration()
+
+        sharded = site_config(bids_folder, str(work_dir / "sharded"))
+        for index in range(1, SHARDS + 1):
+            DirectoryRegistration(site_config(bids_folder, sharded.save_dir, f"{index}/{SHARDS}")).directory_registration()
+    finally:
+        os.environ["PATH"] = path
+
+    return unsharded, sharded
+
+
+def merge(config, monkeypatch):
+
+    monkeypatch.setattr(merge_shards, "Config", lambda: config)
+    monkeypatch.setattr(sys, "argv", ["merge_shards.py", "--shards", str(SHARDS)])
+    merge_shards.main()
+
+
+def read(pth):
+
+    with open(pth, 'r') as file:
+        return file.read()
+
+
+def gallery_files(img_save_dir, html_file):
+
+    pths = [os.path.join(img_save_dir, html_file)]
+    pths += sorted(glob.glob(os.path.join(img_save_dir, html_file.replace(".html", "_page*.html"))))
+    pths += sorted(glob.glob(os.path.join(img_save_dir, "gallery_fragments", "*.html")))
+    return {os.path.relpath(pth, img_save_dir): read(pth) for pth in pths}
+
+
+def test_merged_shards_match_an_unsharded_run(runs, monkeypatch):
+
+    unsharded, sharded = runs
+    merge(sharded, monkeypatch)
+
+    assert read(os.path.join(sharded.save_dir, sharded.matrix_save_name)) == \
+        read(os.path.join(unsharded.save_dir, unsharded.matrix_save_name))
+    assert gallery_files(sharded.img_save_dir, sharded.html_file) == \
+        gallery_files(unsharded.img_save_dir, unsharded.html_file)
+
+
+def test_merge_again_adds_no_rows(runs, monkeypatch):
+
+    unsharded, sharded = runs
+    merge(sharded, monkeypatch)
+    merge(sharded, monkeypatch)
+
+    assert read(os.path.join(sharded.save_dir, sharded.matrix_save_name)) == \
+        read(os.path.join(unsharded.save_dir, unsharded.matrix_save_name))
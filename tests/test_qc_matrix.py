@@ -0,0 +1,181 @@
+import os
+import csv
+
+from qc_matrix import QCMatrix
+
+
+COLUMNS = ["Subject", "T1-Preop Present", "FLAIR Present"]
+DESCRIPTIONS = [{"Subject": None, "T1-Preop Present": "1-yes, 0-no", "FLAIR Present": "1-yes, 0-no"}]
+
+
+def read_rows(pth):
+
+    with open(pth, 'r', newline='') as file:
+        return list(csv.reader(file))
+
+
+def subjects(pth):
+
+    return [row[0] for row in read_rows(pth)[1:]]
+
+
+def row(subject, t1=1, flair=0):
+
+    return {"Subject": subject, "T1-Preop Present": t1, "FLAIR Present": flair}
+
+
+def new_matrix(pth, cases):
+
+    qc_matrix = QCMatrix(str(pth), COLUMNS, DESCRIPTIONS)
+    for case in cases:
+        qc_matrix.append(row(case))
+    qc_matrix.flush()
+    return qc_matrix
+
+
+def test_new_matrix_has_header_and_descriptions(tmp_path):
+
+    pth = tmp_path / "df_qc.csv"
+    new_matrix(pth, ["sub-1", "sub-2"])
+
+    rows = read_rows(pth)
+    assert rows[0] == COLUMNS
+    assert rows[1] == ["", "1-yes, 0-no", "1-yes, 0-no"]
+    assert subjects(pth) == ["", "sub-1", "sub-2"]
+
+
+def test_reopen_continues_the_matrix(tmp_path):
+
+    pth = tmp_path / "df_qc.csv"
+    new_matrix(pth, ["sub-1"])
+
+    qc_matrix = QCMatrix(str(pth))
+    assert qc_matrix.has_subject("sub-1")
+    qc_matrix.append(row("sub-2"))
+    qc_matrix.flush()
+    assert subjects(pth) == ["", "sub-1", "sub-2"]
+
+
+def test_interrupted_flush_is_truncated(tmp_path):
+
+    pth = tmp_path / "df_qc.csv"
+    qc_matrix = new_matrix(pth, ["sub-1", "sub-2"])
+    complete_size = os.path.getsize(pth)
+
+    # killed during a flush: checkpoint pending, part of a row written
+    qc_matrix.save_checkpoint(pending=True)
+    with open(pth, 'a') as file:
+        file.write("sub-3,1")
+
+    qc_matrix = QCMatrix(str(pth))
+    assert os.path.getsize(pth) == complete_size
+    assert subjects(pth) == ["", "sub-1", "sub-2"]
+    assert not qc_matrix.has_subject("sub-3")
+
+    # the rerun case is appended after the recovered rows
+    qc_matrix.append(row("sub-3"))
+    qc_matrix.flush()
+    assert subjects(pth) == ["", "sub-1", "sub-2", "sub-3"]
+    assert all(len(values) == len(COLUMNS) for values in read_rows(pth))
+
+
+def test_matrix_edited_by_hand_is_kept(tmp_path):
+
+    pth = tmp_path / "df_qc.csv"
+    new_matrix(pth, ["sub-1"])
+
+    # QC values filled in by hand (no trailing newline), after the last flush
+    with open(pth, 'a') as file:
+        file.write("sub-2,1,1")
+    stat = os.stat(pth)
+    os.utime(pth, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    qc_matrix = QCMatrix(str(pth))
+    qc_matrix.append(row("sub-3"))
+    qc_matrix.flush()
+    assert subjects(pth) == ["", "sub-1", "sub-2", "sub-3"]
+    assert read_rows(pth)[3] == ["sub-2", "1", "1"]
+
+
+def test_compact_keeps_the_last_row_of_a_rerun(tmp_path):
+
+    pth = tmp_path / "df_qc.csv"
+    qc_matrix = new_matrix(pth, ["sub-1", "sub-2", "sub-3"])
+    qc_matrix.append(row("sub-2", flair=1))
+    qc_matrix.compact()
+
+    rows = read_rows(pth)
+    assert subjects(pth) == ["", "sub-1", "sub-3", "sub-2"]
+    assert rows[-1] == ["sub-2", "1", "1"]
+
+    # appends after the rewrite are not lost
+    qc_matrix = QCMatrix(str(pth))
+    qc_matrix.append(row("sub-4"))
+    qc_matrix.flush()
+    assert subjects(pth) == ["", "sub-1", "sub-3", "sub-2", "sub-4"]
+
+
+def test_compact_order_sorts_within_positions(tmp_path):
+
+    pth = tmp_path / "df_qc.csv"
+    qc_matrix = new_matrix(pth, ["sub-9", "sub-3", "sub-1", "sub-2"])
+    qc_matrix.compact(order=["sub-1", "sub-2", "sub-3"])
+
+    # sub-9 is not ordered and keeps its position
+    assert subjects(pth) == ["", "sub-9", "sub-1", "sub-2", "sub-3"]
+
+
+def test_merge_reads_each_source_row_once(tmp_path):
+
+    batch1 = tmp_path / "df_qc_batch1.csv"
+    batch2 = tmp_path / "df_qc_batch2.csv"
+    source1 = new_matrix(batch1, ["sub-1", "sub-2"])
+    new_matrix(batch2, ["sub-3"])
+
+    target = tmp_path / "df_qc_all.csv"
+    qc_matrix = QCMatrix(str(target), COLUMNS)
+    qc_matrix.merge([str(batch1), str(batch2)])
+    qc_matrix.compact()
+    # one description row for both batches
+    assert subjects(target) == ["", "sub-1", "sub-2", "sub-3"]
+
+    # merged again after a batch went on: only its new rows are added
+    source1.append(row("sub-4"))
+    source1.flush()
+    qc_matrix = QCMatrix(str(target))
+    qc_matrix.merge([str(batch1), str(batch2)])
+    qc_matrix.compact()
+    assert subjects(target) == ["", "sub-1", "sub-2", "sub-3", "sub-4"]
+
+    # a compacted source (rewritten) is read again, its rows supersede the merged ones
+    source1.append(row("sub-1", flair=1))
+    source1.compact()
+    qc_matrix = QCMatrix(str(target))
+    qc_matrix.merge([str(batch1), str(batch2)])
+    qc_matrix.compact()
+    assert sorted(subjects(target)) == ["", "sub-1", "sub-2", "sub-3", "sub-4"]
+    assert [values for values in read_rows(target) if values[0] == "sub-1"] == [["sub-1", "1", "1"]]
+
+
+def test_merge_skips_an_interrupted_source_write(tmp_path):
+
+    batch = tmp_path / "df_qc_batch.csv"
+    source = new_matrix(batch, ["sub-1"])
+    # the batch is killed while flushing sub-2
+    source.save_checkpoint(pending=True)
+    with open(batch, 'a') as file:
+        file.write("sub-2,1")
+
+    target = tmp_path / "df_qc_all.csv"
+    qc_matrix = QCMatrix(str(target), COLUMNS)
+    qc_matrix.merge([str(batch)])
+    assert subjects(target) == ["", "sub-1"]
+
+    # the batch recovers and completes sub-2
+    source = QCMatrix(str(batch))
+    source.append(row("sub-2"))
+    source.flush()
+    qc_matrix = QCMatrix(str(target))
+    qc_matrix.merge([str(batch)])
+    qc_matrix.compact()
+    assert subjects(target) == ["", "sub-1", "sub-2"]
@@ -0,0 +1,39 @@
+import pytest
+
+from shards import parse_shard, case_shard, in_shard, shard_name
+
+
+CASES = [f"sub-MELDH{site:02d}{group}{number:04d}" for site in [1, 16, 99] for group in "PC" for number in range(1, 40)]
+
+
+def test_parse_shard():
+
+    assert parse_shard("3/8") == (3, 8)
+    assert parse_shard("1/1") == (1, 1)
+    for shard in ["0/8", "9/8", "3", "a/b", "3/8/1"]:
+        with pytest.raises(ValueError):
+            parse_shard(shard)
+
+
+def test_shard_name():
+
+    assert shard_name("df_qc_hs.csv", None) == "df_qc_hs.csv"
+    assert shard_name("df_qc_hs.csv", "3/8") == "df_qc_hs_shard3of8.csv"
+    assert shard_name("MELD_H16_QC.html", "1/2") == "MELD_H16_QC_shard1of2.html"
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 8])
+def test_shards_cover_every_case_once(count):
+
+    shards = [f"{index}/{count}" for index in range(1, count + 1)]
+    for case in CASES:
+        assert sum(in_shard(case, shard) for shard in shards) == 1
+    if count > 1:
+        # no shard is left empty on a site of this size
+        assert all(any(in_shard(case, shard) for case in CASES) for shard in shards)
+
+
+def test_shard_is_stable():
+    # the shard of a case does not depend on the run, the machine or the other cases (unlike hash())
+    assert [case_shard(case, 8) for case in ["sub-MELDH16P0001", "sub-MELDH16C0002", "sub-MELDH99P0003"]] == [2, 8, 2]
+    assert [case_shard(case, 8) for case in CASES[::-1]] == [case_shard(case, 8) for case in CASES][::-1]